@@ -0,0 +1,236 @@
+"""csvsc の処理性能を計測するベンチマーク
+
+generate_large_csv でデータセット（行数・列数・CSV/TSV・エンコーディング）を作成し、
+代表的な設定で process_files を実行して以下を出力する。
+
+-   rows_per_sec: 入力行数 / 処理時間
+-   peak_rss_mb: 実行したプロセスの最大メモリ使用量（resource モジュールがない環境では null）
+-   parse_sec / evaluate_sec / write_sec: 処理時間の内訳
+    -   parse_sec は入力ファイルをcsv.readerで読むだけの時間、write_sec は出力された行を
+        同じ設定のcsv.writerで書くだけの時間を別に計測したもの。
+    -   evaluate_sec は処理時間からその2つを引いた残り（フィルタ・追加列の計算と行の処理）。
+
+結果はJSONで保存し、--compare で以前の結果と比較できる。
+
+    python benchmarks/bench_csvsc.py --rows 200000 --output results/v1.json
+    python benchmarks/bench_csvsc.py --rows 200000 --compare results/v1.json
+"""
+import io
+import os
+import sys
+import csv
+import json
+import time
+import shutil
+import argparse
+import datetime
+import platform
+import tempfile
+import subprocess
+import multiprocessing
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+from generate_test_csv import generate_large_csv
+
+# (名前, 列数, 拡張子, エンコーディング)
+DATASETS = [
+    ("csv_utf8_10col", 10, "csv", "utf-8"),
+    ("csv_utf8_100col", 100, "csv", "utf-8"),
+    ("tsv_utf8_10col", 10, "tsv", "utf-8"),
+    ("csv_cp932_10col", 10, "csv", "cp932"),
+]
+
+# (名前, 設定) 設定は入出力のディレクトリ以外の部分
+CASES = [
+    ("noop", {}),
+    ("filter", {"filter_conditions": ["@[column1] > 500"]}),
+    ("add_columns", {"add_columns": {"sum": "@[column1] + @[column2]", "label": "$[column3] + '-' + $#"}}),
+    ("add_columns_fn", {"add_columns": {"f1": "fnc1($[column1])", "f2": "fnc2(@#, $[column2])"}}),
+    ("split_output", {"max_rows_per_file": 10000}),
+]
+
+def build_dataset(data_dir, name, rows, columns, extension, encoding):
+    """データセットのディレクトリを作成する（作成済みの場合は再利用する）"""
+    dataset_dir = os.path.join(data_dir, f"{name}_{rows}")
+    file_path = os.path.join(dataset_dir, f"data.{extension}")
+    if not os.path.exists(file_path):
+        os.makedirs(dataset_dir, exist_ok=True)
+        delimiter = '\t' if extension == 'tsv' else ','
+        generate_large_csv(file_path + ".tmp", rows, columns, delimiter=delimiter, encoding=encoding)
+        os.replace(file_path + ".tmp", file_path)
+    return dataset_dir
+
+def _peak_rss_mb():
+    if resource is None:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    usage = max(usage, children)
+    # Linux は KB、macOS はバイト単位
+    if sys.platform == 'darwin':
+        return usage / (1024 * 1024)
+    return usage / 1024
+
+def _time_parse(input_files, encoding):
+    """入力ファイルをcsv.readerで読むだけの時間と、データ行の数"""
+    rows = 0
+    start = time.perf_counter()
+    for file_path in input_files:
+        delimiter = '\t' if file_path.lower().endswith('.tsv') else ','
+        with open(file_path, 'r', encoding=encoding, newline='') as f:
+            rows += sum(1 for row in csv.reader(f, delimiter=delimiter, quotechar='"')) - 1
+    return time.perf_counter() - start, rows
+
+def _time_write(output_dir, config):
+    """出力された行を同じ設定のcsv.writerで書くだけの時間（出力先はメモリ上）"""
+    from csvsc import get_quoting
+    rows = []
+    for name in sorted(os.listdir(output_dir)):
+        with open(os.path.join(output_dir, name), 'r', encoding=config["output_encoding"], newline='') as f:
+            rows.extend(csv.reader(f))
+    sink = io.StringIO()
+    writer = csv.writer(sink, quotechar=config.get("output_quotechar", '"'),
+                        quoting=get_quoting(config.get("output_quotemode")))
+    start = time.perf_counter()
+    for row in rows:
+        writer.writerow(row)
+        if sink.tell() > 1 << 24:
+            sink.seek(0)
+            sink.truncate()
+    return time.perf_counter() - start, len(rows)
+
+def run_case(config, work_dir, result_queue):
+    """1つのケースを実行する（計測のため別プロセスで呼び出す）"""
+    os.chdir(work_dir)
+    # fnフォルダは実行ファイルの位置を基準に探すため、csvsc.py から実行した場合と同じにする
+    sys.argv[0] = os.path.join(REPO_DIR, 'csvsc.py')
+    import csvsc
+    from csvsc import get_input_files
+
+    input_files = get_input_files(config["input_dir"])
+    parse_sec, rows = _time_parse(input_files, config["input_encoding"])
+
+    start = time.perf_counter()
+    csvsc.process_files(config)
+    total_sec = time.perf_counter() - start
+    peak_rss_mb = _peak_rss_mb()
+
+    write_sec, output_rows = _time_write(config["output_dir"], config)
+    result_queue.put({
+        "input_rows": rows,
+        "output_rows": output_rows,
+        "total_sec": total_sec,
+        "rows_per_sec": rows / total_sec if total_sec else None,
+        "peak_rss_mb": peak_rss_mb,
+        "parse_sec": parse_sec,
+        "write_sec": write_sec,
+        "evaluate_sec": max(total_sec - parse_sec - write_sec, 0.0),
+    })
+
+def measure(config, work_dir):
+    """新しいプロセスでケースを実行し、結果を返す"""
+    context = multiprocessing.get_context('spawn')
+    result_queue = context.Queue()
+    process = context.Process(target=run_case, args=(config, work_dir, result_queue))
+    process.start()
+    result = result_queue.get()
+    process.join()
+    return result
+
+def _git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except Exception:
+        return None
+
+def run_benchmarks(rows, data_dir, datasets=None, cases=None, repeat=1, workers=1):
+    """ベンチマークを実行し、結果の辞書を返す"""
+    results = []
+    for name, columns, extension, encoding in DATASETS:
+        if datasets and name not in datasets:
+            continue
+        dataset_dir = build_dataset(data_dir, name, rows, columns, extension, encoding)
+        for case_name, case_config in CASES:
+            if cases and case_name not in cases:
+                continue
+            best = None
+            for i in range(repeat):
+                work_dir = tempfile.mkdtemp(prefix="csvsc_bench_")
+                try:
+                    config = {
+                        "input_dir": dataset_dir,
+                        "input_encoding": encoding,
+                        "output_encoding": encoding,
+                        "output_dir": os.path.join(work_dir, "output"),
+                        "output_filename": "output.csv",
+                        "output_quotemode": "all",
+                        "workers": workers,
+                    }
+                    config.update(case_config)
+                    result = measure(config, work_dir)
+                finally:
+                    shutil.rmtree(work_dir, ignore_errors=True)
+                if best is None or result["total_sec"] < best["total_sec"]:
+                    best = result
+            best.update({"dataset": name, "case": case_name, "rows": rows, "columns": columns,
+                         "format": extension, "encoding": encoding})
+            results.append(best)
+            print(f"{name:<18} {case_name:<16} {best['rows_per_sec']:>12,.0f} rows/s  "
+                  f"total {best['total_sec']:.3f}s  parse {best['parse_sec']:.3f}s  "
+                  f"evaluate {best['evaluate_sec']:.3f}s  write {best['write_sec']:.3f}s  "
+                  f"rss {best['peak_rss_mb'] or 0:.1f}MB")
+    return {
+        "created": datetime.datetime.now().isoformat(timespec='seconds'),
+        "revision": _git_revision(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "rows": rows,
+        "repeat": repeat,
+        "workers": workers,
+        "results": results,
+    }
+
+def compare(current, baseline):
+    """以前の結果と比較して表示する（rows/sec の比率）"""
+    previous = {(r["dataset"], r["case"]): r for r in baseline["results"]}
+    print(f"\n比較対象: {baseline.get('revision')} ({baseline.get('created')})")
+    for r in current["results"]:
+        old = previous.get((r["dataset"], r["case"]))
+        if old is None or not old.get("rows_per_sec"):
+            continue
+        ratio = r["rows_per_sec"] / old["rows_per_sec"]
+        print(f"{r['dataset']:<18} {r['case']:<16} {old['rows_per_sec']:>12,.0f} -> {r['rows_per_sec']:>12,.0f} rows/s "
+              f"({ratio:.2f}x)")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="csvsc のベンチマーク")
+    parser.add_argument("--rows", type=int, default=100000, help="データセットの行数")
+    parser.add_argument("--data-dir", default=os.path.join(tempfile.gettempdir(), "csvsc_bench_data"),
+                        help="データセットを作成するディレクトリ（作成済みのものは再利用する）")
+    parser.add_argument("--dataset", action="append", help="実行するデータセット（複数指定可）")
+    parser.add_argument("--case", action="append", help="実行するケース（複数指定可）")
+    parser.add_argument("--repeat", type=int, default=1, help="各ケースの実行回数（最も速い結果を使う）")
+    parser.add_argument("--workers", type=int, default=1, help="process_files の workers")
+    parser.add_argument("--output", help="結果を保存するJSONファイル")
+    parser.add_argument("--compare", help="比較する以前の結果のJSONファイル")
+    args = parser.parse_args(argv)
+
+    current = run_benchmarks(args.rows, args.data_dir, args.dataset, args.case, args.repeat, args.workers)
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(current, f, ensure_ascii=False, indent=2)
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            compare(current, json.load(f))
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,29 @@
 import json
 import os
+import sys
+import argparse
 import csv
-import datetime
 import re
-from utils.expression_evaluator import ExpressionEvaluator
+import io
+import collections
+import itertools
+import contextlib
+import threading
+import signal
+import time
+import operator
+from utils.fast_reader import FastCSVReader, is_fast_encoding
+from utils.log_writer import LogWriter, RateLimiter, timestamp
+from utils.profiler import RunMetrics, TimedWriter, write_report
+from utils.async_writer import AsyncRowWriter
+from utils.sinks import open_sink, normalize_format, format_extension, format_codecs, is_text_format
+from utils.manifest import RunManifest, config_hash, fn_hash
+from utils.compression import (
+    open_input, split_compression, normalize_codec, compression_extension,
+)
+from utils.csv_chunks import (
+    CHUNK_SENTINEL, is_chunkable_encoding, find_chunk_boundaries, read_chunk_rows, read_chunk_header,
+)
 
 def load_config(config_path):
     """設定ファイルを読み込む"""
@@ -17,17 +37,24 @@ def load_config(config_path):
         log_error(f"設定ファイルのJSON形式が不正です: {config_path}")
         return None
 
+# process_files の実行中は、ログをバッファ付きで書き込む（実行中以外は1件ごとに追記する）
+_error_log = None
+_debug_log = None
+_debug_limiter = RateLimiter()
+
 def log_error(message, file_path=None, line_number=None):
     """エラーログをファイルに出力する"""
-    timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     error_log_path = "error.txt"
-    log_entry = f"{timestamp}\t{file_path or 'N/A'}\t{line_number or 'N/A'}\t{message}\n"
+    log_entry = f"{timestamp()}\t{file_path or 'N/A'}\t{line_number or 'N/A'}\t{message}\n"
     try:
         #print(f"エラーログ出力先: {os.path.abspath(error_log_path)}")
+        if _error_log is not None:
+            _error_log.write(log_entry)
+            return
         with open(error_log_path, 'a', encoding='utf-8') as f:
             f.write(log_entry)
     except Exception as e:
-        print(f"エラーログの書き込みに失敗しました: {e}")
+        print(f"エラーログの書き込みに失敗しました: {e}", file=sys.stderr)
 
 def init_debug_log():
     """デバッグログファイルを初期化する"""
@@ -36,31 +63,72 @@ def init_debug_log():
         with open(debug_log_path, 'w', encoding='utf-8') as f:
             f.write("デバッグログ開始\n")
     except Exception as e:
-        print(f"デバッグログファイルの初期化に失敗しました: {e}")
+        print(f"デバッグログファイルの初期化に失敗しました: {e}", file=sys.stderr)
 
 def write_debug_log(message, file_path=None, line_number=None):
     """デバッグログをファイルに書き込む"""
     debug_log_path = "debug.log"
     try:
-        timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        log_entry = f"{timestamp}\t{file_path or 'N/A'}\t{line_number or 'N/A'}\t{message}\n"
+        log_entry = f"{timestamp()}\t{file_path or 'N/A'}\t{line_number or 'N/A'}\t{message}\n"
+        if _debug_log is not None:
+            _debug_log.write(log_entry)
+            return
         with open(debug_log_path, 'a', encoding='utf-8') as f:
             f.write(log_entry)
     except Exception as e:
-        print(f"デバッグログの書き込みに失敗しました: {e}")
+        print(f"デバッグログの書き込みに失敗しました: {e}", file=sys.stderr)
+
+def open_logs(debug, flush_interval=1.0, background=False, debug_rate_limit=0):
+    """error.txt と debug.log を開いたままにし、バッファ付きで書き込む
+
+    debug_rate_limit が 0 より大きい場合、行ごとのデバッグログを1秒あたりその件数までに制限する。
+    """
+    global _error_log, _debug_log, _debug_limiter
+    close_logs()
+    if debug:
+        init_debug_log()
+    try:
+        _error_log = LogWriter("error.txt", flush_interval=flush_interval, background=background)
+        if debug:
+            _debug_log = LogWriter("debug.log", flush_interval=flush_interval, background=background)
+    except Exception as e:
+        print(f"ログファイルを開けませんでした: {e}", file=sys.stderr)
+        close_logs()
+    _debug_limiter = RateLimiter(debug_rate_limit)
+
+def close_logs():
+    """バッファのログを書き出してファイルを閉じる"""
+    global _error_log, _debug_log
+    if _debug_limiter.suppressed:
+        write_debug_log(f"debug_rate_limit により {_debug_limiter.suppressed} 件のデバッグログを省略しました。")
+        _debug_limiter.suppressed = 0
+    for writer in (_debug_log, _error_log):
+        if writer is not None:
+            try:
+                writer.close()
+            except Exception as e:
+                print(f"ログの書き込みに失敗しました: {e}", file=sys.stderr)
+    _error_log = None
+    _debug_log = None
 
 def get_input_files(input_dir):
     """入力ディレクトリ内のCSV/TSVファイルをリストアップする"""
     files = []
-    for filename in os.listdir(input_dir):
-        if filename.lower().endswith(('.csv', '.tsv')):
+    # 処理順序（行番号・出力順）が環境に依存しないようにファイル名順で処理する
+    # 圧縮されたファイル（.csv.gz など）は展開しながら読み込む
+    for filename in sorted(os.listdir(input_dir)):
+        if is_input_filename(filename):
             files.append(os.path.join(input_dir, filename))
     return files
 
+def is_input_filename(filename):
+    """入力ファイルとして処理するファイル名か（.csv・.tsv と、それを圧縮したファイル）"""
+    return split_compression(filename)[0].lower().endswith(('.csv', '.tsv'))
+
 def read_header(file_path, encoding, delimiter):
     """CSV/TSVファイルのヘッダー行を読み込む"""
     try:
-        with open(file_path, 'r', encoding=encoding, newline='') as f:
+        with io.TextIOWrapper(open_input(file_path), encoding=encoding, newline='') as f:
             reader = csv.reader(f, delimiter=delimiter, quotechar='"')
             for row in reader:
                 return row
@@ -68,39 +136,1499 @@ def read_header(file_path, encoding, delimiter):
         log_error(f"ヘッダー行の読み込みに失敗しました: {e}", file_path)
         return None
 
-def process_files(config):
-    """設定に基づいてファイルを処理する"""
-    input_dir = config.get('input_dir')
-    input_encoding = config.get('input_encoding', 'UTF-8')
-    output_encoding = config.get('output_encoding', 'auto')
-    output_dir = config.get('output_dir')
-    output_filename = config.get('output_filename')
-    max_rows_per_file = config.get('max_rows_per_file', 0)
-    output_columns = config.get('output_columns', [])
-    add_columns = config.get('add_columns', {})
-    filter_conditions = config.get('filter_conditions', [])
-    output_quotechar = config.get('output_quotechar', '"')
-    output_quote = config.get('output_quotemode')
-    debug = config.get('debug', False)
+class _RowVariables:
+    """列名（小文字）から行の値を参照する（デバッグログ用に行ごとの辞書を作らない）"""
 
-    if debug:
-        init_debug_log()
+    def __init__(self, positions, values):
+        self.positions = positions
+        self.values = values
 
+    def __contains__(self, name):
+        return name in self.positions
+
+    def __getitem__(self, name):
+        return self.values[self.positions[name]]
+
+def debug_columns(header):
+    """デバッグログ用の列名（小文字）から列の位置への対応を返す"""
+    return {h.lower(): i for i, h in enumerate(header)}
+
+def debug_expression(expression, sequence_number, columns, values):
+    """デバッグログ用に列名・行番号を値に置換した式を返す"""
+    from utils.expression_evaluator import substitute_expression
+    return substitute_expression(expression, sequence_number, _RowVariables(columns, values))
+
+def get_quoting(output_quote):
+    """output_quotemode の設定値をcsvモジュールのクォートモードに変換する"""
     if output_quote:
         output_quote = output_quote.lower()
     if output_quote == 'minimal':
-        output_quote = csv.QUOTE_MINIMAL
+        return csv.QUOTE_MINIMAL
     elif output_quote == 'numeric':
-        output_quote = csv.QUOTE_NONNUMERIC
+        return csv.QUOTE_NONNUMERIC
     elif output_quote == 'none':
-        output_quote = csv.QUOTE_NONE
+        return csv.QUOTE_NONE
     else:
-        output_quote = csv.QUOTE_ALL
-        
+        return csv.QUOTE_ALL
+
+# 一括評価されなかった式を表す値
+_NOT_BATCHED = object()
+
+class _Failed:
+    """評価に失敗した共通部分式・共有する式の値"""
+    __slots__ = ('error',)
+
+    def __init__(self, error):
+        self.error = error
+
+def _identity(row):
+    return row
+
+def _shared_evaluate(evaluate, results, current):
+    """評価の結果を行番号（current[0]）ごとに results に保持し、同じ行では保持した結果を返す関数を返す"""
+    def evaluate_shared(values, sequence_number):
+        line_num = current[0]
+        try:
+            result = results[line_num]
+        except KeyError:
+            try:
+                result = results[line_num] = evaluate(values, sequence_number)
+            except Exception as e:
+                results[line_num] = _Failed(e)
+                raise
+            return result
+        if type(result) is _Failed:
+            raise result.error
+        return result
+    return evaluate_shared
+
+class RowPlan:
+    """1行ごとの処理（フィルタリング・追加列の計算・出力列の抽出）
+
+    式は生成時に一度だけコンパイルし、ファイルごとにヘッダーの列位置へ束縛する。
+    defer_sequence が True の場合、行番号(@#、$#)を参照する追加列は計算せず、
+    行番号が確定した後に finalize() で計算する（並列処理用）。
+    profile が True の場合、metrics に段階ごと・式ごと・関数ごとの時間と行数を記録する。
+    pure と宣言された fnフォルダの関数の結果は fn_cache_size 件までキャッシュする
+    （行番号を参照する式からの呼び出しはキャッシュしない）。
+    column_types（{列名（小文字）: 型}、推定済みのもの）の列は、式で @[列名] として参照する場合に
+    行ごとに一度だけ変換する（空文字は数値の型では 0、date では変換できない値）。変換できない値がある行は
+    スキップし、列ごとの件数を type_errors に数える。
+    lookups（utils.lookups.parse_lookups() の定義）の表は式の lookup() で参照し、join を指定した表の列は
+    入力の行の後ろに追加する（inner の表にキーの行がない行はスキップする）。
+    """
+
+    def __init__(self, filter_conditions, add_columns, output_header, fn_dir=None, fn_reload_interval=1.0, debug=False,
+                 batch_size=0, filter_reorder=False, fast_reader=False, profile=False, fn_cache_size=1024,
+                 column_types=None, lookups=None):
+        # 式がない場合は、式の評価・fnフォルダの関数に関するモジュールを読み込まない
+        self.uses_expressions = bool(filter_conditions or add_columns)
+        self.filters = []
+        self.add_columns = []
+        if self.uses_expressions:
+            from utils.expression_evaluator import compile_expression
+            self.filters = [compile_expression(condition) for condition in filter_conditions]
+            self.add_columns = [(col_name, compile_expression(expression))
+                                for col_name, expression in add_columns.items()]
+        self.output_header = output_header
+        self.column_types = dict(column_types or {})
+        self.type_errors = {}
+        self.debug = debug
+        # 大きいローカルファイルを FastCSVReader で読み込む
+        self.fast_reader = fast_reader
+        # batch_size 行ごとのブロックで単純な数値式をまとめて評価する（関数呼び出しなどは行ごとに評価する）
+        self.batch_size = batch_size or 0
+        self.batch = None
+        self.filter_batch_ids = [None] * len(self.filters)
+        self.add_column_batch_ids = [None] * len(self.add_columns)
+        if self.batch_size > 0 and self.uses_expressions:
+            from utils.batch_evaluator import BatchEvaluator
+            batch = BatchEvaluator()
+            # 型を指定した列・他の追加列を参照する式は、変換済みの値・計算済みの値で行ごとに評価する
+            add_names = {col_name.lower() for col_name, c in self.add_columns}
+            self.filter_batch_ids = [None if self._uses_types(c) else batch.add(c, True) for c in self.filters]
+            self.add_column_batch_ids = [
+                None if self._uses_types(c) or any(name in add_names and name != col_name.lower()
+                                                   for name in c.columns + c.names)
+                else batch.add(c, False)
+                for col_name, c in self.add_columns]
+            if batch.expressions:
+                self.batch = batch
+        # フィルタ条件はコストと行を除外する割合から決めた順序で評価する（filter_reorder が False の場合は設定の順序）
+        self.filter_planner = None
+        # jobs で他の RowPlan と評価を共有する式（式 -> 行番号ごとの結果。呼び出し側が処理の単位ごとに空にする）
+        self.shared_results = None
+        if filter_reorder and self.filters:
+            from utils.filter_planner import FilterPlanner, estimate_cost
+            costs = [estimate_cost(c, batch_id is not None)
+                     for c, batch_id in zip(self.filters, self.filter_batch_ids)]
+            self.filter_planner = FilterPlanner(costs)
+        # lookups の表は同じプロセスの RowPlan で共有し、lookup() は式の名前空間に追加する
+        self.joins = []
+        self._extra_names = {}
+        if lookups:
+            from utils.lookups import load_tables, make_lookup
+            tables = load_tables(lookups)
+            self._extra_names["lookup"] = make_lookup(tables)
+            self.joins = [(spec, tables[spec["name"]]) for spec in lookups if spec["join"]]
+        # fnフォルダの関数は共有レジストリから取得し、変更の確認は fn_reload_interval 秒ごとに行う
+        self.registry = None
+        self.metrics = RunMetrics() if profile else None
+        self.namespace = {}
+        self.cached_namespace = {}
+        self._own_namespace = False
+        self._cache_baseline = {}
+        if self.uses_expressions:
+            from utils.expression_evaluator import get_function_registry
+            self.registry = get_function_registry(fn_dir, check_interval=fn_reload_interval,
+                                                  cache_size=fn_cache_size or 0)
+            self.registry.refresh(force=True)
+            # プロファイルでは、fnフォルダの関数を計測する関数で包んだ別の名前空間を使う
+            # （lookups がある場合も lookup() を追加した別の名前空間を使う）
+            self._own_namespace = self.metrics is not None or bool(self._extra_names)
+            if self._own_namespace:
+                self._sync_namespace()
+            else:
+                self.namespace = self.registry.namespace
+                self.cached_namespace = self.registry.cached_namespace
+            self._cache_baseline = self.registry.cache_stats()
+        # フィルタ条件が行番号を参照する場合、行の採否が前の行に依存するため並列化できない
+        self.parallel_safe = not any(c.uses_sequence for c in self.filters)
+
+    def _uses_types(self, compiled):
+        return any(name in self.column_types for name in compiled.int_columns)
+
+    def _bind_types(self, header, count_errors=True):
+        """column_types の列の値を変換して行の後ろに追加する関数を返す
+
+        (列名（小文字） -> 変換済みの値の位置, 行を受け取って変換済みの値を追加した行を返す関数) を返す。
+        関数は変換できない値がある場合は None を返す。式が参照する型を指定した列がない場合は (None, None)。
+        """
+        if not self.column_types:
+            return None, None
+        from utils.column_types import converter, blank_value
+        index = {name.lower(): i for i, name in enumerate(header)}
+        typed = []
+        for c in self.filters + [c for col_name, c in self.add_columns]:
+            typed.extend(name for name in c.int_columns
+                         if name in self.column_types and name in index and name not in typed)
+        if not typed:
+            return None, None
+        header_len = len(header)
+        typed_positions = {name: header_len + i for i, name in enumerate(typed)}
+        converters = [(index[name], converter(self.column_types[name]), blank_value(self.column_types[name]), name)
+                      for name in typed]
+        type_errors = self.type_errors
+
+        def convert_row(values):
+            converted = []
+            failed = False
+            for position, convert, blank, name in converters:
+                value = values[position]
+                try:
+                    if value != '':
+                        converted.append(convert(value))
+                    elif blank is not None:
+                        # 空文字は型の 0（従来の @[列名] と同じ）
+                        converted.append(blank)
+                    else:
+                        raise ValueError(value)
+                except (ValueError, ArithmeticError):
+                    failed = True
+                    if count_errors:
+                        type_errors[name] = type_errors.get(name, 0) + 1
+            return None if failed else values + converted
+        return typed_positions, convert_row
+
+    def take_type_errors(self):
+        """変換できなかった値の列ごとの件数を返し、件数を 0 に戻す"""
+        type_errors = dict(self.type_errors)
+        self.type_errors.clear()
+        return type_errors
+
+    def iter_rows(self, reader, header, line_start, state, log, defer_sequence=False):
+        """readerの各行を処理し、出力する行を (行番号, 出力行, 後で計算する元の行) で返す
+
+        行番号(@#)は state.sequence_number を参照する。呼び出し側は出力した行ごとに
+        state.sequence_number を進める。ログは log(種類, メッセージ, 行番号) で出力する。
+        """
+        header_len = len(header)
+        uses_expressions = self.uses_expressions
+        debug = self.debug
+        metrics = self.metrics
+        if metrics is not None:
+            bind_start = time.perf_counter()
+            reader = metrics.timed_rows(reader)
+        # join の列は行の後ろに追加し、式・出力列からは入力の列と同じように参照する
+        join_row = self._bind_joins(header)
+        if join_row is not None:
+            reader = _join_rows(reader, header_len, join_row)
+            header = self._join_header(header)
+            header_len = len(header)
+        debug_cols = debug_columns(header) if debug else None
+
+        # ヘッダーの列位置に式を束縛する
+        typed_positions, convert_row = self._bind_types(header)
+        shared_results = self.shared_results
+        current = None
+        if shared_results:
+            # 他の追加列を参照する追加列は、ジョブによって参照先が異なるため共有しない
+            from utils.column_graph import references
+            deps = references(self.add_columns, header)[0]
+            current = [None]
+
+        def bind(c, bind_header, kind, typed, index=None):
+            evaluate = self._bind(c, bind_header, kind, typed)
+            if current is None or (index is not None and deps[index]):
+                return evaluate
+            results = shared_results.get(c.expression)
+            return evaluate if results is None else _shared_evaluate(evaluate, results, current)
+
+        bound_filters = [(i, c.expression, bind(c, header, 'filter', typed_positions), batch_id)
+                         for i, (c, batch_id) in enumerate(zip(self.filters, self.filter_batch_ids))]
+        planner = self.filter_planner
+        if planner is not None:
+            evaluated = planner.evaluated
+            rejected = planner.rejected
+            ordered_filters = [bound_filters[i] for i in planner.order]
+            replan_countdown = planner.interval
+        else:
+            ordered_filters = bound_filters
+        # 追加列は参照先の追加列の後に計算し、出力列にも他の追加列にも使わない追加列は計算しない
+        add_plan = self._plan_add_columns(header, defer_sequence=defer_sequence)
+        has_deferred = bool(add_plan.deferred)
+        computed = [i for i in range(len(self.add_columns)) if i not in add_plan.deferred]
+        project, extra, fallbacks = self._bind_projection(header, [self.add_columns[i][0] for i in computed])
+        slots = {i: (header_len + k, fallback) for k, (i, fallback) in enumerate(zip(computed, fallbacks))}
+        work_pad = None
+        if add_plan.work_names:
+            # 他の追加列から参照される追加列と共通部分式の値は、式を評価する行の後ろに格納する
+            typed_len = header_len + len(typed_positions or ())
+            eval_header = list(header) + [''] * (typed_len - header_len) + add_plan.work_names
+            work_positions = {name.lower(): typed_len + k for k, name in enumerate(add_plan.work_names)}
+            shared_positions = {name: work_positions[name] for kind, name, c, i in add_plan.steps if kind == 'shared'}
+            eval_typed = dict(typed_positions or {}, **shared_positions)
+            work_pad = [None] * len(add_plan.work_names)
+            bound_add_columns = ()
+            bound_steps = []
+            for kind, name, c, i in add_plan.steps:
+                if kind == 'shared':
+                    evaluate = self._bind(c, eval_header, 'shared', eval_typed)
+                else:
+                    evaluate = bind(c, eval_header, 'add_column', eval_typed, i)
+                if kind == 'shared':
+                    bound_steps.append((True, name, c.expression, evaluate, None, None, None,
+                                        work_positions[name], ()))
+                    continue
+                slot, fallback = slots[i]
+                shared_refs = tuple(shared_positions[ref] for ref in c.int_columns if ref in shared_positions)
+                bound_steps.append((False, name, c.expression, evaluate, self.add_column_batch_ids[i], slot, fallback,
+                                    work_positions.get(name.lower()), shared_refs))
+        else:
+            bound_add_columns = [(name, c.expression, bind(c, header, 'add_column', typed_positions, i),
+                                  self.add_column_batch_ids[i]) + slots[i]
+                                 for kind, name, c, i in add_plan.steps]
+        if metrics is not None:
+            metrics.stages['bind'] += time.perf_counter() - bind_start
+
+        if self.batch is not None:
+            rows = self._iter_batches(reader, header, line_start)
+        else:
+            rows = zip(itertools.count(line_start), reader, itertools.repeat(None))
+
+        for line_num, values, batch_row in rows:
+            if current is not None:
+                current[0] = line_num
+            if values is None:
+                if metrics is not None:
+                    metrics.counters["rows_filtered"] += 1
+                if debug:
+                    log('debug', "join（inner）の表にキーの行がないため行をスキップしました。", line_num)
+                continue
+            if len(values) != header_len:
+                log('error', f"データ行の項目数がヘッダー行と一致しません。スキップします。", line_num)
+                if metrics is not None:
+                    metrics.counters["rows_invalid"] += 1
+                continue
+
+            if uses_expressions:
+                if self.registry.refresh() and self._own_namespace:
+                    self._sync_namespace()
+            sequence_number = state.sequence_number
+            # 式は型を指定した列を変換した値を後ろに追加した行に対して評価する
+            typed_values = values
+            if convert_row is not None:
+                typed_values = convert_row(values)
+                if typed_values is None:
+                    if metrics is not None:
+                        metrics.counters["rows_invalid"] += 1
+                    if debug:
+                        log('debug', "column_types の型に変換できない値があるため行をスキップしました。", line_num)
+                    continue
+
+            # フィルタリング
+            skip_row = False
+            if planner is None:
+                for i, condition, evaluate, batch_id in bound_filters:
+                    if batch_row is not None and batch_id is not None and batch_row[batch_id] is not _NOT_BATCHED:
+                        result = batch_row[batch_id]
+                    else:
+                        result = evaluate(typed_values, sequence_number)
+                    if not result:
+                        skip_row = True
+                        break
+            else:
+                try:
+                    for i, condition, evaluate, batch_id in ordered_filters:
+                        evaluated[i] += 1
+                        if batch_row is not None and batch_id is not None and batch_row[batch_id] is not _NOT_BATCHED:
+                            result = batch_row[batch_id]
+                        else:
+                            result = evaluate(typed_values, sequence_number)
+                        if not result:
+                            rejected[i] += 1
+                            skip_row = True
+                            break
+                except Exception:
+                    # 評価に失敗した場合は設定の順序で評価し直し、順序を変えない場合と同じ結果にする
+                    skip_row = False
+                    for i, condition, evaluate, batch_id in bound_filters:
+                        if not evaluate(typed_values, sequence_number):
+                            skip_row = True
+                            break
+                replan_countdown -= 1
+                if replan_countdown <= 0:
+                    ordered_filters = [bound_filters[i] for i in planner.replan()]
+                    replan_countdown = planner.interval
+            if skip_row:
+                if metrics is not None:
+                    metrics.counters["rows_filtered"] += 1
+                if debug:
+                    log('debug', f"フィルタリングにより行をスキップしました: {debug_expression(condition, sequence_number, debug_cols, values)}", line_num)
+                continue
+
+            # 追加列の計算（式は元の行の値と、参照する追加列の計算結果に対して評価する）
+            # 計算結果は元の行の後ろの位置に格納する
+            row = values + extra if extra else values
+            if work_pad is not None:
+                work = typed_values + work_pad
+                for shared, col_name, expression, evaluate, batch_id, slot, fallback, position, shared_refs in bound_steps:
+                    if shared:
+                        try:
+                            work[position] = evaluate(work, sequence_number)
+                        except Exception as e:
+                            # 共通部分式を参照する追加列の計算で送出する
+                            work[position] = _Failed(e)
+                        continue
+                    try:
+                        for ref in shared_refs:
+                            if type(work[ref]) is _Failed:
+                                raise work[ref].error
+                        if batch_row is not None and batch_id is not None and batch_row[batch_id] is not _NOT_BATCHED:
+                            row[slot] = batch_row[batch_id]
+                        else:
+                            row[slot] = evaluate(work, sequence_number)
+                        if debug:
+                            log('debug', f"追加列[{col_name}]の計算結果: {debug_expression(expression, sequence_number, debug_cols, values)} = {row[slot]}", line_num)
+                    except Exception as e:
+                        if fallback is not None:
+                            row[slot] = values[fallback]
+                        log('error', f"追加列[{col_name}]の計算に失敗しました: {e}", line_num)
+                        if metrics is not None:
+                            metrics.counters["evaluation_errors"] += 1
+                    if position is not None:
+                        work[position] = row[slot]
+            for col_name, expression, evaluate, batch_id, slot, fallback in bound_add_columns:
+                try:
+                    if batch_row is not None and batch_id is not None and batch_row[batch_id] is not _NOT_BATCHED:
+                        row[slot] = batch_row[batch_id]
+                    else:
+                        row[slot] = evaluate(typed_values, sequence_number)
+                    if debug:
+                        log('debug', f"追加列[{col_name}]の計算結果: {debug_expression(expression, sequence_number, debug_cols, values)} = {row[slot]}", line_num)
+                except Exception as e:
+                    # 計算に失敗した場合は元の列の値（なければ空文字）を出力する
+                    if fallback is not None:
+                        row[slot] = values[fallback]
+                    log('error', f"追加列[{col_name}]の計算に失敗しました: {e}", line_num)
+                    if metrics is not None:
+                        metrics.counters["evaluation_errors"] += 1
+
+            # 出力対象の列を抽出
+            output_row = project(row)
+            if has_deferred:
+                output_row = list(output_row)
+            yield line_num, output_row, (values if has_deferred else None)
+
+    def shareable_expressions(self):
+        """他の RowPlan と評価の結果を共有できる式（filter_conditions・add_columns の式）
+
+        行番号を参照する式と、pure と宣言していない fnフォルダの関数を呼び出す式は除く。
+        """
+        if self.registry is None:
+            return set()
+        from utils.function_cache import is_pure
+        impure = {name for name, func in self.registry.functions.items() if not is_pure(func)}
+        return {c.expression for c in self.filters + [c for col_name, c in self.add_columns]
+                if not c.uses_sequence and c.error is None and not impure.intersection(c.names)}
+
+    def _plan_add_columns(self, header, targets=None, defer_sequence=False):
+        """追加列を計算する順序・共通部分式の計画（utils.column_graph.plan_add_columns）
+
+        pure と宣言された fnフォルダの関数と lookup() の呼び出しを共通部分式にする。
+        """
+        if not self.add_columns:
+            from utils.column_graph import AddColumnPlan
+            return AddColumnPlan([], [], set())
+        from utils.column_graph import plan_add_columns
+        from utils.function_cache import is_pure
+        pure_names = {name for name, func in self.registry.functions.items() if is_pure(func)}
+        pure_names.update(self._extra_names)
+        return plan_add_columns(self.add_columns, header, self.output_header, pure_names, targets=targets,
+                                defer_sequence=defer_sequence, hoist=targets is None)
+
+    def _bind(self, compiled, header, kind, typed_positions=None):
+        """式をヘッダーに束縛する（プロファイルでは評価時間を計測する関数で包む）
+
+        行番号を参照する式は、キャッシュしない関数の名前空間に束縛する。
+        """
+        namespace = self.namespace if compiled.uses_sequence else self.cached_namespace
+        evaluate = compiled.bind(header, namespace, typed_positions)
+        if self.metrics is not None:
+            evaluate = self.metrics.timed_expression(kind, compiled.expression, evaluate)
+        return evaluate
+
+    def _sync_namespace(self):
+        """プロファイル用・lookups 用の名前空間を、共有レジストリの名前空間から作り直す"""
+        functions = self.registry.functions
+        for target, source in ((self.namespace, self.registry.namespace),
+                               (self.cached_namespace, self.registry.cached_namespace)):
+            if self.metrics is not None:
+                namespace = {name: self.metrics.timed_function(name, value) if name in functions else value
+                             for name, value in source.items()}
+            else:
+                namespace = dict(source)
+            namespace.update(self._extra_names)
+            target.clear()
+            target.update(namespace)
+
+    def collect_cache_stats(self):
+        """前回からの fnフォルダの関数のキャッシュの統計を metrics に加算する"""
+        if self.registry is None:
+            return
+        stats = self.registry.cache_stats()
+        if self.metrics is not None:
+            for name, values in stats.items():
+                baseline = self._cache_baseline.get(name, {})
+                entry = self.metrics.function_cache.setdefault(name, {"hits": 0, "misses": 0, "evictions": 0})
+                for key in entry:
+                    entry[key] += values[key] - baseline.get(key, 0)
+        self._cache_baseline = stats
+
+    def used_columns(self, header):
+        """出力列・式が参照する列の位置（それ以外の列は値を参照しない）"""
+        positions = {col: i for i, col in enumerate(header)}
+        lower_positions = {col.lower(): i for i, col in enumerate(header)}
+        used = {positions[col] for col in self.output_header if col in positions}
+        used.update(positions[col_name] for col_name, c in self.add_columns if col_name in positions)
+        for c in self.filters + [c for col_name, c in self.add_columns]:
+            used.update(lower_positions[name] for name in c.columns + c.names if name in lower_positions)
+        for spec, table in self.joins:
+            used.update(positions[col] for col in spec["on"] if col in positions)
+        return sorted(used)
+
+    def _join_header(self, header):
+        """join の列を追加したヘッダー"""
+        if not self.joins:
+            return header
+        from utils.lookups import join_columns
+        return list(header) + [col for spec, table in self.joins for col in join_columns(spec, table.columns)]
+
+    def _bind_joins(self, header):
+        """join の表の列を行の後ろに追加する関数を返す（join がない場合は None）
+
+        関数は inner の表にキーの行がない場合は None を返す。left の表にない場合は空文字を追加する。
+        追加する列の名前が入力の列・他の表の追加する列と同じ場合（大文字・小文字は区別しない）は ValueError。
+        """
+        if not self.joins:
+            return None
+        from utils.lookups import join_columns
+        positions = {col: i for i, col in enumerate(header)}
+        names = {col.lower(): "入力ファイル" for col in header}
+        bound = []
+        for spec, table in self.joins:
+            missing = [col for col in spec["on"] if col not in positions]
+            if missing:
+                raise ValueError(f"lookups の表[{spec['name']}]の join の列[{', '.join(missing)}]が入力ファイルにありません。")
+            on = [positions[col] for col in spec["on"]]
+            join_names = join_columns(spec, table.columns)
+            for col in join_names:
+                if col.lower() in names:
+                    raise ValueError(f"lookups の表[{spec['name']}]の join の列[{col}]が{names[col.lower()]}の列と"
+                                     f"同じ名前です（columns で追加する列を指定してください）。")
+                names[col.lower()] = f"表[{spec['name']}]"
+            columns = [table.positions[col] for col in join_names]
+            bound.append((table.row, on, columns, spec["join"] == 'inner', [''] * len(columns)))
+
+        def join_row(values):
+            joined = list(values)
+            for find, on, columns, inner, empty in bound:
+                key = values[on[0]] if len(on) == 1 else tuple([values[i] for i in on])
+                found = find(key)
+                if found is None:
+                    if inner:
+                        return None
+                    joined += empty
+                else:
+                    joined += [found[i] for i in columns]
+            return joined
+        return join_row
+
+    def _bind_projection(self, header, add_column_names):
+        """出力列を行の位置へ対応付ける
+
+        行は元の値の後ろに追加列の計算結果、さらに存在しない列用の空文字を並べたもの。
+        (行から出力行を取り出す関数, 元の行の後ろに追加する初期値, 追加列ごとの元の列の位置) を返す。
+        同名の列が複数ある場合は後の列、追加列と同名の列がある場合は追加列を出力する。
+        """
+        header_len = len(header)
+        positions = {col: i for i, col in enumerate(header)}
+        fallbacks = [positions.get(col_name) for col_name in add_column_names]
+        for i, col_name in enumerate(add_column_names):
+            positions[col_name] = header_len + i
+        missing = header_len + len(add_column_names)
+        indices = [positions.get(col, missing) for col in self.output_header]
+        extra = [''] * len(add_column_names)
+        if missing in indices:
+            extra.append('')
+
+        if not extra and indices == list(range(header_len)):
+            project = _identity
+        elif len(indices) == 1:
+            index = indices[0]
+            project = lambda row: (row[index],)
+        elif not indices:
+            project = lambda row: ()
+        else:
+            project = operator.itemgetter(*indices)
+        return project, extra, fallbacks
+
+    def _iter_batches(self, reader, header, line_start):
+        """batch_size 行ずつ読み込み、(行番号, 行, 一括評価の結果) を返す
+
+        一括評価の結果は式ごとの値のタプルで、一括評価できなかった式は _NOT_BATCHED。
+        項目数がヘッダーと一致しない行の結果は None。
+        """
+        header_len = len(header)
+        evaluate_block = self.batch.bind(header)
+        rows = enumerate(reader, start=line_start)
+        while True:
+            block = list(itertools.islice(rows, self.batch_size))
+            if not block:
+                return
+            valid = [values for line_num, values in block if values is not None and len(values) == header_len]
+            if self.metrics is not None:
+                start = time.perf_counter()
+            results = evaluate_block(valid) if valid else []
+            if self.metrics is not None:
+                self.metrics.stages['batch'] += time.perf_counter() - start
+            if any(r is not None for r in results):
+                batch_rows = zip(*[r if r is not None else itertools.repeat(_NOT_BATCHED) for r in results])
+            else:
+                batch_rows = None
+            for line_num, values in block:
+                if batch_rows is not None and values is not None and len(values) == header_len:
+                    yield line_num, values, next(batch_rows)
+                else:
+                    yield line_num, values, None
+
+    def bind_deferred(self, header):
+        """行番号を参照する追加列を計算する関数を返す（対象がなければ None）"""
+        # values は join の列を追加した行
+        header = self._join_header(header)
+        targets = self._plan_add_columns(header, defer_sequence=True).deferred
+        if not targets:
+            return None
+        # 行番号を参照する追加列が参照する追加列も計算し直す（計算結果は出力しない）
+        add_plan = self._plan_add_columns(header, targets=sorted(targets))
+        # 変換できなかった値はワーカーで数えているため、ここでは数えない
+        typed_positions, convert_row = self._bind_types(header, count_errors=False)
+        typed_len = len(header) + len(typed_positions or ())
+        eval_header = list(header) + [''] * (typed_len - len(header)) + add_plan.work_names
+        work_positions = {name.lower(): typed_len + k for k, name in enumerate(add_plan.work_names)}
+        work_pad = [None] * len(add_plan.work_names)
+        deferred = []
+        for kind, col_name, c, i in add_plan.steps:
+            positions = [k for k, col in enumerate(self.output_header) if col == col_name] if i in targets else None
+            deferred.append((col_name, c.expression, self._bind(c, eval_header, 'add_column', typed_positions),
+                             positions, work_positions.get(col_name.lower())))
+        debug = self.debug
+        metrics = self.metrics
+        debug_cols = debug_columns(header) if debug else None
+
+        def finalize(output_row, values, sequence_number, line_num, log):
+            typed_values = convert_row(values) if convert_row is not None else values
+            if typed_values is None:
+                return
+            work = typed_values + work_pad
+            for col_name, expression, evaluate, positions, position in deferred:
+                try:
+                    value = evaluate(work, sequence_number)
+                    if positions is not None:
+                        for i in positions:
+                            output_row[i] = value
+                        if debug:
+                            log('debug', f"追加列[{col_name}]の計算結果: {debug_expression(expression, sequence_number, debug_cols, values)} = {value}", line_num)
+                except Exception as e:
+                    value = ''
+                    if positions is not None:
+                        log('error', f"追加列[{col_name}]の計算に失敗しました: {e}", line_num)
+                        if metrics is not None:
+                            metrics.counters["evaluation_errors"] += 1
+                if position is not None:
+                    work[position] = value
+        return finalize
+
+def _join_rows(reader, header_len, join_row):
+    """join の列を追加した行を返す（inner の表にキーの行がない行は None、項目数がヘッダー行と一致しない行は空のリスト）"""
+    for values in reader:
+        yield join_row(values) if len(values) == header_len else []
+
+class OutputWriter:
+    """出力ファイルへの書き込み（max_rows_per_file によるファイルの分割を含む）
+
+    出力ファイルは最初の行を書き込む時に作成する。
+    output_format は出力形式（csv・jsonl・arrow・parquet）。arrow・parquet は batch_rows 行ごとの
+    レコードバッチ・行グループで書き込む。
+    compression を指定した場合は圧縮して書き込み、テキストの出力形式ではファイル名に圧縮形式の拡張子を付ける
+    （output_filename が圧縮形式の拡張子で終わる場合は、その形式で圧縮する）。
+    fsync が True の場合、出力ファイルを閉じる時にディスクへの書き込みを待つ。
+    """
+
+    def __init__(self, output_dir, output_filename, encoding, quotechar, quoting, max_rows_per_file, header,
+                 compression=None, compression_level=None, compression_thread=False, fsync=False,
+                 output_format='csv', batch_rows=10000):
+        self.output_dir = output_dir
+        self.output_format = output_format
+        self.batch_rows = batch_rows
+        self.output_filename, filename_compression = split_compression(output_filename)
+        if not is_text_format(output_format):
+            # ファイル内で圧縮する形式では、ファイル名の圧縮形式の拡張子は使わない
+            filename_compression = None
+        self.compression = compression or filename_compression
+        self.compression_level = compression_level
+        self.compression_thread = compression_thread
+        self.fsync = fsync
+        self.encoding = encoding
+        self.quotechar = quotechar
+        self.quoting = quoting
+        self.max_rows_per_file = max_rows_per_file
+        self.header = header
+        self.file_counter = 1
+        self.row_count = 0
+        # この OutputWriter で書き込んだ行数（row_count は出力ファイルごとの行数）
+        self.total_rows = 0
+        # 作成した出力ファイルのパス
+        self.parts = []
+        self._writer = None
+
+    def part_path(self, file_counter):
+        """出力ファイルのパス（max_rows_per_file を指定した場合は file_counter 番目のファイル）"""
+        output_file_path = os.path.join(self.output_dir, self.output_filename)
+        if self.max_rows_per_file and file_counter >= 1:
+            output_file_path = (os.path.splitext(output_file_path)[0] + f"_{file_counter:04d}"
+                                + format_extension(self.output_format))
+        if not is_text_format(self.output_format):
+            return output_file_path
+        return output_file_path + compression_extension(self.compression)
+
+    def _open(self):
+        output_file_path = self.part_path(self.file_counter)
+        # 書き込み済みの行がある出力ファイル（前回の続き）には追記する
+        append = self.row_count > 0
+        self._writer = open_sink(self.output_format, output_file_path, self.header, self.encoding, self.quotechar,
+                                 self.quoting, self.compression, self.compression_level, self.compression_thread,
+                                 append=append, batch_rows=self.batch_rows)
+        if not append:
+            self.parts.append(output_file_path)
+
+    def writerow(self, row):
+        if self._writer is None:
+            self._open()
+        self._writer.writerow(row)
+        self.row_count += 1
+        self.total_rows += 1
+
+        if self.max_rows_per_file and self.row_count >= self.max_rows_per_file:
+            self._next_part()
+
+    def writerows(self, rows):
+        """複数の行を書き込む（出力ファイルを切り替える位置は writerow() と同じ）"""
+        start = 0
+        while start < len(rows):
+            if self._writer is None:
+                self._open()
+            end = len(rows)
+            if self.max_rows_per_file:
+                end = min(end, start + self.max_rows_per_file - self.row_count)
+            self._writer.writerows(itertools.islice(rows, start, end))
+            self.row_count += end - start
+            self.total_rows += end - start
+            start = end
+            if self.max_rows_per_file and self.row_count >= self.max_rows_per_file:
+                self._next_part()
+
+    def _next_part(self):
+        """出力ファイルを閉じ、次の行から次の出力ファイルに書き込む"""
+        self.close()
+        self.row_count = 0
+        self.file_counter += 1
+
+    def close(self):
+        if self._writer:
+            self._writer.close()
+            self._writer = None
+            if self.fsync:
+                with open(self.part_path(self.file_counter), 'ab') as f:
+                    os.fsync(f.fileno())
+
+    def commit(self):
+        """書き込み済みの行をファイルに確定し、続きを書き込むための状態を返す"""
+        self.close()
+        part_size = 0
+        if self.row_count > 0:
+            part_size = os.path.getsize(self.part_path(self.file_counter))
+        return {"file_counter": self.file_counter, "row_count": self.row_count, "part_size": part_size,
+                "parts": list(self.parts)}
+
+    def restore(self, output):
+        """commit() の状態から続きを書き込めるようにする
+
+        状態を記録した後に書き込まれた行（中断した処理の出力）は取り除く。
+        """
+        self.file_counter = output["file_counter"]
+        self.row_count = output["row_count"]
+        self.parts = list(output["parts"])
+        path = self.part_path(self.file_counter)
+        if self.row_count > 0:
+            with open(path, 'r+b') as f:
+                f.truncate(output["part_size"])
+        elif os.path.exists(path):
+            os.remove(path)
+        if self.max_rows_per_file:
+            file_counter = self.file_counter + 1
+            while os.path.exists(self.part_path(file_counter)):
+                os.remove(self.part_path(file_counter))
+                file_counter += 1
+
+    def rollback(self, output):
+        """commit() の後に書き込んだ行を取り除き、output（commit() の状態）から続きを書き込めるようにする"""
+        self.close()
+        self.restore(output)
+
+class StreamWriter:
+    """呼び出し側が指定した出力先への書き込み（ファイルの分割はしない）
+
+    output は write() を持つテキストのファイルオブジェクト、または writerow() を持つオブジェクト。
+    ヘッダー行は最初の行を書き込む時に出力する。
+    """
+
+    def __init__(self, output, quotechar, quoting, header):
+        self.output = output
+        self.header = header
+        self.row_count = 0
+        if hasattr(output, 'writerow'):
+            self._writer = output
+        else:
+            self._writer = csv.writer(output, quotechar=quotechar, quoting=quoting)
+        self._started = False
+
+    def writerow(self, row):
+        if not self._started:
+            self._writer.writerow(self.header)
+            self._started = True
+        self._writer.writerow(row)
+        self.row_count += 1
+
+    def close(self):
+        flush = getattr(self.output, 'flush', None)
+        if flush is not None:
+            flush()
+
+class SequenceState:
+    """出力済みの行に続く行番号(@#)"""
+
+    def __init__(self, sequence_number=1):
+        self.sequence_number = sequence_number
+
+def get_delimiter(file_path):
+    """ファイル名から区切り文字を判定する（圧縮形式の拡張子は除いて判定する）"""
+    return '\t' if split_compression(file_path)[0].lower().endswith('.tsv') else ','
+
+def _use_fast_reader(file_path, encoding, plan):
+    """FastCSVReader で読み込むか（fast_reader が有効で、圧縮されていないファイル）"""
+    return plan.fast_reader and split_compression(file_path)[1] is None and is_fast_encoding(encoding)
+
+@contextlib.contextmanager
+def _open_csv(file_path, encoding, plan, start=None):
+    """ファイル（または start 以降）を読み込むCSVリーダーを開く"""
+    delimiter = get_delimiter(file_path)
+    if _use_fast_reader(file_path, encoding, plan):
+        reader = FastCSVReader(file_path, encoding, delimiter, start=start)
+        try:
+            yield reader
+        finally:
+            reader.close()
+        return
+    with open_input(file_path) as raw:
+        if start is not None:
+            raw.seek(start)
+        f = io.TextIOWrapper(raw, encoding=encoding, newline='')
+        yield csv.reader(f, delimiter=delimiter, quotechar='"')
+
+def _set_header(reader, plan, header):
+    """FastCSVReader の場合、ヘッダーから文字列に変換する列を設定する"""
+    if isinstance(reader, FastCSVReader):
+        used = plan.used_columns(header)
+        # 多くの列を使う場合は、行全体をまとめて変換する方が速い
+        reader.used_columns = used if len(used) * 4 < len(header) else None
+
+def _file_logger(file_path):
+    """行番号付きのログをファイルに出力する関数を返す"""
+    def log(kind, message, line_num):
+        if kind == 'debug':
+            if _debug_limiter.allow():
+                write_debug_log(message, file_path, line_num)
+        else:
+            log_error(message, file_path, line_num)
+    return log
+
+_worker_plan = None
+_worker_aggregate = None
+
+def _init_worker(plan_args, aggregate=None):
+    """ワーカープロセスの初期化（式のコンパイルとfnフォルダのロードを一度だけ行う）
+
+    aggregate（集計の定義）を指定した場合、ワーカーで集計した途中の値を返す。
+    """
+    global _worker_plan, _worker_aggregate
+    _worker_plan = RowPlan(**plan_args)
+    _worker_aggregate = aggregate
+
+def _process_chunk(task):
+    """ワーカープロセスでファイル（またはその一部）を処理する
+
+    結果の行とログはメモリに蓄積し、親プロセスが元の順序で書き出す。
+    ログと結果の行番号は、チャンクの場合はチャンク内の0から始まる番号。
+    集計する場合は、行の代わりに集計途中の値を返す。
+    """
+    file_path, encoding, header, start, end, validate_end = task
+    plan = _worker_plan
+    delimiter = get_delimiter(file_path)
+    result = {"header": header, "rows": [], "logs": [], "records": 0, "valid_end": True, "error": None,
+              "metrics": None, "type_errors": None, "partial": None}
+    logs = result["logs"]
+
+    def log(kind, message, line_num):
+        logs.append((kind, message, line_num))
+
+    emit = result["rows"].append
+    aggregator = None
+    if _worker_aggregate is not None:
+        from utils.aggregate import Aggregator
+        # チャンク内のグループはメモリに収まるため、一時ファイルには書き出さない
+        aggregator = Aggregator(_worker_aggregate, memory_limit=float('inf'))
+
+        def emit(item):
+            aggregator.add(item[1])
+
+    def counted(reader):
+        # 処理したレコード数を数え、末尾の検証用レコードを取り除く
+        for row in reader:
+            if validate_end and row == [CHUNK_SENTINEL]:
+                result["valid_end"] = True
+                return
+            result["records"] += 1
+            yield row
+
+    try:
+        if start is None:
+            with _open_csv(file_path, encoding, plan) as reader:
+                header = next(reader, None)
+                # ヘッダー行がない場合は header を None のまま返す（親プロセスでエラーを出力する）
+                result["header"] = header
+                if header is not None:
+                    _set_header(reader, plan, header)
+                    for item in plan.iter_rows(reader, header, 2, SequenceState(), log, defer_sequence=True):
+                        emit(item)
+        else:
+            result["valid_end"] = not validate_end
+            if _use_fast_reader(file_path, encoding, plan):
+                reader = FastCSVReader(file_path, encoding, delimiter, start, end, validate_end)
+                _set_header(reader, plan, header)
+            else:
+                reader = read_chunk_rows(file_path, encoding, delimiter, start, end, validate_end)
+            for item in plan.iter_rows(counted(reader), header, 0, SequenceState(), log, defer_sequence=True):
+                emit(item)
+    except Exception as e:
+        result["error"] = str(e)
+    if plan.metrics is not None:
+        plan.collect_cache_stats()
+        result["metrics"] = plan.metrics.take()
+    result["type_errors"] = plan.take_type_errors()
+    if aggregator is not None:
+        result["partial"] = aggregator.take()
+    return result
+
+def _plan_file_tasks(file_path, encoding, chunk_size):
+    """ファイルをワーカーに渡すタスクに分割する
+
+    (ヘッダー, [(開始位置, 終了位置, 末尾を検証するか), ...]) を返す。
+    ファイル全体を1つのタスクとする場合は (None, [(None, None, False)]) 、
+    親プロセスで逐次処理する場合は None を返す。
+    """
+    file_size = os.path.getsize(file_path)
+    if file_size <= chunk_size:
+        return None, [(None, None, False)]
+    if split_compression(file_path)[1] is not None or not is_chunkable_encoding(encoding):
+        # ファイル全体をワーカーのメモリに載せないよう、大きいファイルは逐次処理する
+        return None
+    boundaries = find_chunk_boundaries(file_path, chunk_size)
+    if boundaries is None:
+        return None
+    header_end, chunks = boundaries
+    header = read_chunk_header(file_path, encoding, get_delimiter(file_path), header_end)
+    if header is None or not chunks:
+        return None
+    tasks = [(start, end, i < len(chunks) - 1) for i, (start, end) in enumerate(chunks)]
+    return header, tasks
+
+def _process_file_serial(file_path, encoding, plan, state, writer, start=None, header=None, line_start=2):
+    """ファイル（または start 以降）を親プロセスで逐次処理する"""
+    log = _file_logger(file_path)
+    with _open_csv(file_path, encoding, plan, start) as reader:
+        if header is None:
+            header = next(reader, None)
+            if header is None:
+                log_error("ヘッダー行を読み込めませんでした。", file_path)
+                return
+        _set_header(reader, plan, header)
+        _write_rows(reader, header, plan, state, writer, log, line_start)
+
+def _write_rows(reader, header, plan, state, writer, log, line_start=2):
+    """readerの各行を処理して書き出す"""
+    for line_num, output_row, values in plan.iter_rows(reader, header, line_start, state, log):
+        state.sequence_number += 1
+        writer.writerow(output_row)
+
+def _process_files_parallel(input_files, input_encoding, plan, plan_args, state, writer, workers, chunk_size,
+                            on_file_done=None, aggregator=None):
+    """ワーカープロセスで並列に処理し、元の順序で書き出す
+
+    行の採否はワーカーで決まり、行番号(@#)と出力ファイルの分割は親プロセスで
+    元の順序に従って割り当てるため、逐次処理と同じ結果になる。
+    on_file_done はファイルの行をすべて書き出した後に、そのファイルのパスと、エラーで処理を打ち切ったか（failed）で呼び出す。
+    aggregator を指定した場合、ワーカーで集計した途中の値を aggregator に併合する
+    （行番号を参照する追加列がある場合は、行を親プロセスに返して集計する）。
+    """
+    # 結果はメモリに保持されるため、処理待ちのチャンク数を制限する
+    max_pending = workers + 2
+    if aggregator is not None and any(c.uses_sequence for col_name, c in plan.add_columns):
+        aggregator = None
+    aggregate = aggregator.definition if aggregator is not None else None
+
+    def iter_tasks():
+        for file_index, file_path in enumerate(input_files):
+            try:
+                planned = _plan_file_tasks(file_path, input_encoding, chunk_size)
+            except Exception:
+                planned = None
+            if planned is None:
+                yield file_index, file_path, None, None
+                continue
+            header, chunks = planned
+            for start, end, validate_end in chunks:
+                yield file_index, file_path, header, (start, end, validate_end)
+
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=(plan_args, aggregate)) as executor:
+        pending = collections.deque()
+        tasks = iter_tasks()
+        current_file = None
+        # 処理を打ち切ったファイル
+        skip_file = None
+        # 処理中のファイルでエラーが発生したか
+        failed = False
+        line_base = 2
+        finalize = None
+
+        def submit_next():
+            for file_index, file_path, header, chunk in tasks:
+                if chunk is None:
+                    pending.append((file_index, file_path, header, chunk, None))
+                else:
+                    start, end, validate_end = chunk
+                    future = executor.submit(_process_chunk, (file_path, input_encoding, header, start, end, validate_end))
+                    pending.append((file_index, file_path, header, chunk, future))
+                return True
+            return False
+
+        while len(pending) < max_pending and submit_next():
+            pass
+
+        while pending:
+            file_index, file_path, header, chunk, future = pending.popleft()
+            while len(pending) < max_pending and submit_next():
+                pass
+
+            if file_index != current_file:
+                if current_file is not None and on_file_done is not None:
+                    on_file_done(input_files[current_file], failed)
+                current_file = file_index
+                skip_file = None
+                failed = False
+                line_base = 2
+                finalize = None
+                print(f"処理中のファイル: {os.path.basename(file_path)}")
+            if skip_file == file_index:
+                if future is not None:
+                    future.cancel()
+                continue
+
+            log = _file_logger(file_path)
+            if future is None:
+                # 分割できない大きいファイルは親プロセスで逐次処理する
+                try:
+                    _process_file_serial(file_path, input_encoding, plan, state, writer)
+                except Exception as e:
+                    log_error(f"ファイルの処理中にエラーが発生しました: {e}", file_path)
+                    failed = True
+                continue
+
+            result = future.result()
+            if not result["valid_end"]:
+                # クォートの推定によるチャンク境界が誤っていた場合、このチャンク以降を逐次処理する
+                skip_file = file_index
+                try:
+                    _process_file_serial(file_path, input_encoding, plan, state, writer,
+                                         start=chunk[0], header=header, line_start=line_base)
+                except Exception as e:
+                    log_error(f"ファイルの処理中にエラーが発生しました: {e}", file_path)
+                    failed = True
+                continue
+
+            if result["metrics"] is not None and plan.metrics is not None:
+                plan.metrics.merge(result["metrics"])
+            for name, count in result["type_errors"].items():
+                plan.type_errors[name] = plan.type_errors.get(name, 0) + count
+            if result["partial"] is not None:
+                aggregator.merge(result["partial"])
+            if chunk[0] is None and result["header"] is None and result["error"] is None:
+                log_error("ヘッダー行を読み込めませんでした。", file_path)
+                continue
+            if chunk[0] is None:
+                offset = 0
+            else:
+                offset = line_base
+            if finalize is None and result["header"] is not None:
+                finalize = plan.bind_deferred(result["header"]) or False
+
+            for kind, message, line_num in result["logs"]:
+                log(kind, message, line_num + offset)
+            for line_num, output_row, values in result["rows"]:
+                if finalize:
+                    finalize(output_row, values, state.sequence_number, line_num + offset, log)
+                state.sequence_number += 1
+                writer.writerow(output_row)
+            line_base += result["records"]
+
+            if result["error"] is not None:
+                skip_file = file_index
+                failed = True
+                log_error(f"ファイルの処理中にエラーが発生しました: {result['error']}", file_path)
+
+        if current_file is not None and on_file_done is not None:
+            on_file_done(input_files[current_file], failed)
+
+def _plan_args(config, output_header):
+    """設定から RowPlan の引数を作成する"""
+    fn_dir = None
+    if config.get('filter_conditions') or config.get('add_columns'):
+        from utils.expression_evaluator import default_fn_dir
+        fn_dir = default_fn_dir()
+    return {
+        "filter_conditions": config.get('filter_conditions', []),
+        "add_columns": config.get('add_columns', {}),
+        "output_header": output_header,
+        "fn_dir": fn_dir,
+        "fn_reload_interval": config.get('fn_reload_interval', 1.0),
+        "debug": config.get('debug', False),
+        "batch_size": config.get('batch_size', 0),
+        "filter_reorder": config.get('filter_reorder', False),
+        "fast_reader": config.get('fast_reader', False),
+        "profile": bool(config.get('profile', False)),
+        "fn_cache_size": config.get('fn_cache_size', 1024),
+        "column_types": {},
+        "lookups": _lookup_specs(config),
+    }
+
+def _lookup_specs(config):
+    """lookups の表の定義（設定が不正な場合は ValueError）"""
+    if not config.get('lookups'):
+        return []
+    from utils.lookups import parse_lookups, DEFAULT_MEMORY_MB
+    return parse_lookups(config['lookups'], config.get('input_encoding', 'UTF-8'), config.get('lookup_index_dir'),
+                         config.get('lookup_memory_mb', DEFAULT_MEMORY_MB))
+
+def _load_lookups(config):
+    """lookups の表を読み込み、join で行に追加する列を返す（設定・参照ファイルが不正な場合は ValueError）"""
+    specs = _lookup_specs(config)
+    if not specs:
+        return []
+    from utils.lookups import load_tables, join_columns
+    try:
+        tables = load_tables(specs)
+    except (OSError, csv.Error, UnicodeError) as e:
+        raise ValueError(f"lookups の参照ファイルを読み込めませんでした: {e}")
+    return [col for spec in specs if spec["join"] for col in join_columns(spec, tables[spec["name"]].columns)]
+
+def _default_output_header(config, headers, joined=()):
+    """output_columns を指定しない場合の出力列（入力ファイルの列、join の列、追加列の順）"""
+    output_header = []
+    for header in headers:
+        for h in header:
+            if h not in output_header:
+                output_header.append(h)
+    for col_name in list(joined) + list(config.get('add_columns', {})):
+        if col_name not in output_header:
+            output_header.append(col_name)
+    return output_header
+
+def _read_sample(file_path, encoding, size):
+    """ファイルのヘッダー行と、先頭の size 行を読み込む"""
+    with io.TextIOWrapper(open_input(file_path), encoding=encoding, newline='') as f:
+        reader = csv.reader(f, delimiter=get_delimiter(file_path), quotechar='"')
+        header = next(reader, None)
+        return header or [], list(itertools.islice(reader, size))
+
+def _resolve_column_types(config, plan_args, header, rows):
+    """column_types を検証し、"auto" の列の型をサンプルの行から推定して plan_args に設定する
+
+    型が不正な場合は ValueError を送出する。
+    """
+    if not config.get('column_types'):
+        return
+    from utils.column_types import normalize_column_types, resolve_column_types
+    column_types = normalize_column_types(config['column_types'])
+    columns = []
+    if plan_args["fn_dir"] is not None:
+        from utils.expression_evaluator import compile_expression
+        for expression in list(plan_args["filter_conditions"]) + list(plan_args["add_columns"].values()):
+            columns.extend(name for name in compile_expression(expression).int_columns if name not in columns)
+    plan_args["column_types"] = resolve_column_types(column_types, header, rows, columns)
+
+def _validate_column_types(config):
+    """column_types の型を検証する（不正な型の場合は ValueError）"""
+    if config.get('column_types'):
+        from utils.column_types import normalize_column_types
+        normalize_column_types(config['column_types'])
+
+def _column_types_sample(config):
+    return config.get('column_types_sample', 1000)
+
+def _report_type_errors(plan, file_path=None):
+    """column_types の型に変換できなかった値の件数を列ごとに error.txt に出力する"""
+    type_errors = plan.take_type_errors()
+    for name, count in sorted(type_errors.items()):
+        log_error(f"列[{name}]の {count} 件の値を {plan.column_types[name]} に変換できないため、行をスキップしました。",
+                  file_path)
+    return type_errors
+
+def _writer_options(config):
+    """設定から OutputWriter の出力先・出力列以外の引数を作成する（出力形式・圧縮形式が使用できない場合は ValueError）"""
+    output_format = normalize_format(config.get('output_format'))
+    output_encoding = config.get('output_encoding', 'auto')
+    if output_encoding == 'auto':
+        output_encoding = config.get('input_encoding', 'UTF-8')
+    return {
+        "encoding": output_encoding,
+        "quotechar": config.get('output_quotechar', '"'),
+        "quoting": get_quoting(config.get('output_quotemode')),
+        "max_rows_per_file": config.get('max_rows_per_file', 0),
+        "compression": normalize_codec(config.get('output_compression'), format_codecs(output_format)),
+        "compression_level": config.get('output_compression_level'),
+        "compression_thread": config.get('output_compression_thread', False),
+        "fsync": config.get('output_fsync', False),
+        "output_format": output_format,
+        "batch_rows": config.get('output_batch_rows', 10000),
+    }
+
+def _output_writer(config, output_dir, output_filename, header):
+    """出力ファイルへの writer を作成する（設定が不正な場合は ValueError）
+
+    output_partition_by を指定した場合は、パーティションの値ごとの出力ファイルに振り分ける。
+    """
+    options = _writer_options(config)
+    partition_by = config.get('output_partition_by')
+    if not partition_by:
+        return OutputWriter(output_dir, output_filename, header=header, **options)
+    from utils.partitioned_writer import PartitionedWriter, partition_key, DEFAULT_MAX_OPEN_FILES, DEFAULT_BUFFER_ROWS
+    key = partition_key(partition_by, header)
+
+    def make_writer(filename):
+        return OutputWriter(output_dir, filename, header=header, **options)
+    return PartitionedWriter(make_writer, key, output_filename,
+                             key_size=1 if isinstance(partition_by, str) else len(partition_by),
+                             max_open_files=config.get('output_max_open_files', DEFAULT_MAX_OPEN_FILES),
+                             buffer_rows=config.get('output_partition_buffer_rows', DEFAULT_BUFFER_ROWS),
+                             appendable=is_text_format(options["output_format"]))
+
+def _report_partition_errors(writer, file_path=None):
+    """output_partition_by の式を評価できなかった行数をエラーログに出力する"""
+    errors = getattr(writer, "errors", 0)
+    if errors:
+        log_error(f"output_partition_by の式を評価できない {errors} 行は、空の値のパーティションに出力しました。", file_path)
+
+def _output_stages(config, output_header, column_types=None):
+    """aggregate・distinct_on・sort_by の段で writer を包む関数を返す（設定が不正な場合は ValueError）
+
+    (元の writer に書き出す行のヘッダー, 包む関数（段がない場合は None）) を返す。
+    出力行を集計し、集計結果（集計しない場合は出力行）の重複を除いて並べ替えてから、元の writer に書き出す
+    （出力ファイルの分割は元の writer で行う）。
+    """
+    aggregate = None
+    if config.get('aggregate'):
+        from utils.aggregate import parse_aggregate, result_types
+        aggregate = parse_aggregate(config['aggregate'], output_header, column_types)
+        output_header = aggregate[0]
+        column_types = result_types(aggregate, column_types)
+    sort_by = config.get('sort_by')
+    distinct_on = config.get('distinct_on')
+    if not sort_by and not distinct_on and aggregate is None:
+        return output_header, None
+    from utils.external_sort import SortedWriter, DistinctWriter, sort_key, distinct_key, DEFAULT_MEMORY_MB
+    key = sort_key(sort_by, output_header, column_types) if sort_by else None
+    dedup_key = distinct_key(distinct_on, output_header) if distinct_on else None
+    options = {
+        "memory_limit": int(config.get('sort_memory_mb', DEFAULT_MEMORY_MB) * 1024 * 1024),
+        "temp_dir": config.get('sort_temp_dir'),
+        "workers": config.get('sort_workers', 1) or 1,
+    }
+
+    def wrap(writer, metrics=None):
+        if key is not None:
+            writer = SortedWriter(writer, key, metrics=metrics, **options)
+        if dedup_key is not None:
+            writer = DistinctWriter(writer, dedup_key, metrics=metrics, **options)
+        if aggregate is not None:
+            from utils.aggregate import Aggregator, AggregateWriter
+            memory_limit = int(config.get('aggregate_memory_mb', DEFAULT_MEMORY_MB) * 1024 * 1024)
+            writer = AggregateWriter(writer, Aggregator(aggregate, memory_limit, config.get('sort_temp_dir')))
+        return writer
+    return output_header, wrap
+
+def _report_aggregate_errors(writer, file_path=None):
+    """aggregate で数値に変換できなかった値の件数をエラーログに出力する"""
+    aggregator = getattr(writer, "aggregator", None)
+    if aggregator is None:
+        return
+    for name, count in aggregator.errors.items():
+        log_error(f"集計列[{name}]の {count} 件の値を数値に変換できないため、集計から除きました。", file_path)
+
+def _load_plan_cache(config, plan_args):
+    """plan_cache_dir のキャッシュを読み込む（設定されていない場合・式がない場合は None）"""
+    cache_dir = config.get('plan_cache_dir')
+    if not cache_dir or plan_args["fn_dir"] is None:
+        return None
+    from utils.plan_cache import PlanCache
+    expressions = list(plan_args["filter_conditions"]) + list(plan_args["add_columns"].values())
+    cache = PlanCache(cache_dir, config, plan_args["fn_dir"], expressions)
+    cache.load()
+    return cache
+
+def _save_plan_cache(cache):
+    """コンパイル結果を plan_cache_dir に保存する"""
+    if cache is None:
+        return
+    try:
+        cache.save()
+    except OSError as e:
+        log_error(f"プランのキャッシュを保存できませんでした: {e}")
+
+def _open_logs_for(config):
+    """設定に従ってログを開く"""
+    open_logs(config.get('debug', False), config.get('log_flush_interval', 1.0),
+              config.get('log_background', False), config.get('debug_rate_limit', 0))
+
+def process_files(config):
+    """設定に基づいてファイルを処理する
+
+    config が設定のリスト、または jobs を含む設定の場合は、入力ファイルを1回だけ読み込んで
+    ジョブごとのフィルタ・追加列・出力で処理する（ログの設定は最初のジョブのもの）。
+    """
+    configs = _job_configs(config)
+    if configs is None:
+        configs = [config]
+    _open_logs_for(configs[0] if configs else {})
+    try:
+        if len(configs) == 1:
+            _process_files(configs[0])
+        else:
+            _process_jobs(configs)
+    finally:
+        close_logs()
+
+def process_stream(config, input_stream, output_stream, delimiter=',', name='<stdin>'):
+    """設定に基づいてCSV/TSVをストリームで処理する
+
+    input_stream は行の文字列を返すファイルオブジェクトまたはイテラブル、
+    output_stream は write() を持つテキストのファイルオブジェクトまたは writerow() を持つオブジェクト。
+    1行ずつ読み込んで書き出すため、メモリ使用量は入力の大きさに依存しない。
+    input_dir、output_dir、output_filename、max_rows_per_file、workers は使用しない。
+    profile のレポートの入力・出力のバイト数は 0 とする。
+    ログのファイル名には name を使用する。出力した行数を返す。
+    """
+    _open_logs_for(config)
+    try:
+        reader = csv.reader(input_stream, delimiter=delimiter, quotechar='"')
+        header = next(reader, None)
+        if header is None:
+            log_error("ヘッダー行を読み込めませんでした。", name)
+            return 0
+
+        try:
+            joined = _load_lookups(config)
+        except ValueError as e:
+            log_error(str(e))
+            return 0
+        output_header = config.get('output_columns', [])
+        if not output_header:
+            output_header = _default_output_header(config, [header], joined)
+
+        plan_args = _plan_args(config, output_header)
+        if config.get('column_types'):
+            sample = list(itertools.islice(reader, _column_types_sample(config)))
+            reader = itertools.chain(sample, reader)
+            try:
+                _resolve_column_types(config, plan_args, header, sample)
+            except ValueError as e:
+                log_error(str(e))
+                return 0
+        try:
+            writer_header, output_stages = _output_stages(config, output_header, plan_args["column_types"])
+        except ValueError as e:
+            log_error(str(e))
+            return 0
+        plan_cache = _load_plan_cache(config, plan_args)
+        plan = RowPlan(**plan_args)
+        writer = StreamWriter(output_stream, config.get('output_quotechar', '"'),
+                              get_quoting(config.get('output_quotemode')), writer_header)
+        profiler = None
+        if plan.metrics is not None:
+            writer = TimedWriter(writer, plan.metrics)
+            if config.get('profile') == 'cprofile':
+                import cProfile
+                profiler = cProfile.Profile()
+                profiler.enable()
+        if output_stages is not None:
+            writer = output_stages(writer, plan.metrics)
+        start = time.perf_counter()
+        try:
+            _write_rows(reader, header, plan, SequenceState(), writer, _file_logger(name))
+        finally:
+            writer.close()
+            _save_plan_cache(plan_cache)
+            type_errors = _report_type_errors(plan, name)
+            _report_aggregate_errors(writer, name)
+            if plan.metrics is not None:
+                if profiler is not None:
+                    profiler.disable()
+                plan.collect_cache_stats()
+                # 標準出力は出力の行に使うため、メッセージは標準エラー出力に出力する
+                _write_profile(config, plan.metrics, time.perf_counter() - start, [], 0, 1, profiler, type_errors,
+                               sys.stderr)
+        return writer.row_count
+    finally:
+        close_logs()
+
+def _read_headers(config, input_files, encoding):
+    """入力ファイルのヘッダー行のリスト（plan_cache_dir を設定した場合、変わっていないファイルはキャッシュから）"""
+    cache = None
+    if config.get('plan_cache_dir'):
+        from utils.header_cache import HeaderCache
+        cache = HeaderCache(config['plan_cache_dir'])
+        cache.load()
+    headers = []
+    for file_path in input_files:
+        header = cache.get(file_path, encoding) if cache is not None else None
+        if header is None:
+            header = read_header(file_path, encoding, get_delimiter(file_path))
+            if header and cache is not None:
+                cache.put(file_path, encoding, header)
+        if header:
+            headers.append(header)
+    if cache is not None:
+        try:
+            cache.save()
+        except OSError as e:
+            log_error(f"ヘッダー行のキャッシュを保存できませんでした: {e}")
+    return headers
+
+class _Job:
+    """process_files の1つの設定の処理（入力ファイル・RowPlan・出力先と、終了時に使う値）"""
+
+    def __init__(self, config, input_files, plan, plan_args, state, writer, output_writer, on_file_done,
+                 plan_cache):
+        self.config = config
+        self.input_files = input_files
+        self.plan = plan
+        self.plan_args = plan_args
+        self.state = state
+        self.writer = writer
+        self.output_writer = output_writer
+        self.on_file_done = on_file_done
+        self.plan_cache = plan_cache
+        self.workers = config.get('workers', 1) or 1
+        self.profiler = None
+        self.bytes_before = 0
+        self.start = None
+
+def _prepare_job(config, fanout=False):
+    """設定を検証し、入力ファイル・RowPlan・出力先を準備する（処理しない場合はエラーを出力して None）
+
+    fanout の場合（jobs）は、他のジョブの出力を待たせないように、出力を常に別スレッドで書き込む。
+    """
+    input_dir = config.get('input_dir')
+    input_encoding = config.get('input_encoding', 'UTF-8')
+    output_dir = config.get('output_dir')
+    output_filename = config.get('output_filename')
+    output_columns = config.get('output_columns', [])
+    output_async = config.get('output_async', False)
+    incremental = config.get('incremental', False)
+
     if not input_dir or not output_dir or not output_filename:
         log_error("入力ディレクトリ、出力ディレクトリ、出力ファイル名のいずれかが設定されていません。")
         return
 
+    try:
+        writer_options = _writer_options(config)
+        _validate_column_types(config)
+        joined = _load_lookups(config)
+    except ValueError as e:
+        log_error(str(e))
+        return
+    output_format = writer_options["output_format"]
+    if incremental and not is_text_format(output_format):
+        log_error(f"incremental は {output_format} 形式の出力では使用できません。")
+        return
+    if incremental and (config.get('sort_by') or config.get('distinct_on') or config.get('aggregate')):
+        log_error("incremental は sort_by・distinct_on・aggregate と同時に使用できません。")
+        return
+    if fanout and (incremental or config.get('profile') == 'cprofile'):
+        log_error("jobs では incremental・profile の \"cprofile\" を使用できません。")
+        return
+
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
 
@@ -109,121 +1637,586 @@ def process_files(config):
         log_error(f"入力ディレクトリにCSV/TSVファイルが見つかりません: {input_dir}")
         return
 
-    all_headers = []
-    for file_path in input_files:
-        delimiter = '\t' if file_path.lower().endswith('.tsv') else ','
-        header = read_header(file_path, input_encoding, delimiter)
-        if header:
-            for h in header:
-                if h not in all_headers:
-                    all_headers.append(h)
+    if output_columns:
+        # 出力列が指定されている場合、ヘッダー行はデータと同じ読み込みで取得する
+        output_header = output_columns
+    else:
+        headers = _read_headers(config, input_files, input_encoding)
+        if not headers:
+            log_error("ヘッダー行を読み込めませんでした。")
+            return
+
+        output_header = _default_output_header(config, headers, joined)
 
-    if not all_headers:
-        log_error("ヘッダー行を読み込めませんでした。")
+    plan_args = _plan_args(config, output_header)
+    if config.get('column_types'):
+        # "auto" の列の型は、最初の入力ファイルの先頭の行から推定する
+        try:
+            header, sample = _read_sample(input_files[0], input_encoding, _column_types_sample(config))
+        except (OSError, ValueError, csv.Error) as e:
+            log_error(f"column_types の推定に失敗しました: {e}", input_files[0])
+            header, sample = [], []
+        try:
+            _resolve_column_types(config, plan_args, header, sample)
+        except ValueError as e:
+            log_error(str(e))
+            return
+    try:
+        writer_header, output_stages = _output_stages(config, output_header, plan_args["column_types"])
+        writer = output_writer = _output_writer(config, output_dir, output_filename, writer_header)
+    except ValueError as e:
+        log_error(str(e))
         return
+    state = SequenceState()
 
-    for col_name, expression in add_columns.items():
-        if col_name not in all_headers:
-            all_headers.append(col_name)
+    on_file_done = None
+    if incremental:
+        manifest = _load_manifest(config, output_dir, output_header, input_files, writer)
+        input_files = [file_path for file_path in input_files if not manifest.is_processed(file_path)]
+        if not input_files:
+            print("新しい入力ファイルはありません。")
+            return
+        if manifest.output:
+            writer.restore(manifest.output)
+            state.sequence_number = manifest.output["sequence_number"]
+        else:
+            manifest.output = dict(writer.commit(), sequence_number=state.sequence_number)
 
-    output_file_counter = 1
-    output_file_path = os.path.join(output_dir, output_filename)
-    output_file = None
-    output_writer = None
-    row_count = 0
-    sequence_number = 1
+        def on_file_done(file_path, failed=False):
+            if failed:
+                # 途中まで書き込んだ行を取り除き、次回の実行で処理し直す
+                writer.rollback(manifest.output)
+                state.sequence_number = manifest.output["sequence_number"]
+                return
+            output = writer.commit()
+            output["sequence_number"] = state.sequence_number
+            manifest.commit(file_path, output)
 
-    for file_path in input_files:
-        delimiter = '\t' if file_path.lower().endswith('.tsv') else ','
-        try:
-            with open(file_path, 'r', encoding=input_encoding, newline='') as f:
+    if output_async or fanout:
+        # 書き込みと出力ファイルの切り替えは別スレッドで行う
+        writer = AsyncRowWriter(writer, config.get('output_batch_rows', 10000))
+    plan_cache = _load_plan_cache(config, plan_args)
+    plan = RowPlan(**plan_args)
+    job = _Job(config, input_files, plan, plan_args, state, writer, output_writer, on_file_done, plan_cache)
+    if plan.metrics is not None:
+        job.writer = TimedWriter(job.writer, plan.metrics)
+        job.bytes_before = _output_size(job.writer.parts)
+        if config.get('profile', False) == 'cprofile':
+            import cProfile
+            job.profiler = cProfile.Profile()
+            job.profiler.enable()
+    if output_stages is not None:
+        job.writer = output_stages(job.writer, plan.metrics)
+    job.start = time.perf_counter()
+    return job
+
+def _finish_job(job):
+    """出力を閉じ、エラーの件数とプロファイルを出力する"""
+    plan = job.plan
+    writer = job.writer
+    try:
+        writer.close()
+    finally:
+        _save_plan_cache(job.plan_cache)
+        type_errors = _report_type_errors(plan)
+        _report_aggregate_errors(writer)
+        _report_partition_errors(job.output_writer)
+        if plan.metrics is not None:
+            if job.profiler is not None:
+                job.profiler.disable()
+            plan.collect_cache_stats()
+            _write_profile(job.config, plan.metrics, time.perf_counter() - job.start, job.input_files,
+                           _output_size(writer.parts) - job.bytes_before,
+                           job.workers if plan.parallel_safe else 1, job.profiler, type_errors)
+
+def _process_files(config):
+    """process_files の本体（ログを開いた状態で呼び出す）"""
+    job = _prepare_job(config)
+    if job is None:
+        return
+    input_encoding = config.get('input_encoding', 'UTF-8')
+    chunk_size = config.get('chunk_size', 8 * 1024 * 1024)
+    try:
+        if job.workers > 1 and job.plan.parallel_safe:
+            _process_files_parallel(job.input_files, input_encoding, job.plan, job.plan_args, job.state, job.writer,
+                                    job.workers, chunk_size, job.on_file_done,
+                                    getattr(job.writer, "aggregator", None))
+        else:
+            for file_path in job.input_files:
                 print(f"処理中のファイル: {os.path.basename(file_path)}")
-                
-                reader = csv.reader(f, delimiter=delimiter, quotechar='"')
-                header = next(reader)
-                header_len = len(header)
-
-                for line_num, row in enumerate(reader, start=2):
-                    values = row
-                    if len(values) != header_len:
-                        log_error(f"データ行の項目数がヘッダー行と一致しません。スキップします。", file_path, line_num)
-                        continue
+                failed = False
+                try:
+                    _process_file_serial(file_path, input_encoding, job.plan, job.state, job.writer)
+                except Exception as e:
+                    log_error(f"ファイルの処理中にエラーが発生しました: {e}", file_path)
+                    failed = True
+                if job.on_file_done is not None:
+                    job.on_file_done(file_path, failed)
+    finally:
+        _finish_job(job)
 
-                    row_data = dict(zip(header, values))
-                    
-                    # フィルタリング
-                    if filter_conditions:
-                        evaluator = ExpressionEvaluator(sequence_number, row_data)
-                        skip_row = False
-                        for condition in filter_conditions:
-                            if not evaluator.evaluate(condition):
-                                skip_row = True
-                                break
-                        if skip_row:
-                            if debug:
-                                write_debug_log(f"フィルタリングにより行をスキップしました: {evaluator.evaluate_expression}", file_path, line_num)
-                            continue
-
-                    # 追加列の計算
-                    evaluator = ExpressionEvaluator(sequence_number, row_data)
-                    for col_name, expression in add_columns.items():
-                        try:
-                            row_data[col_name] = evaluator.evaluate(expression)
-                            if debug:
-                                write_debug_log(f"追加列[{col_name}]の計算結果: {evaluator.evaluate_expression} = {row_data[col_name]}", file_path, line_num)
-                        except Exception as e:
-                            log_error(f"追加列[{col_name}]の計算に失敗しました: {e}", file_path, line_num)
-
-                    # 出力対象の列を抽出
-                    sequence_number += 1
-                    output_row = []
-                    if output_columns:
-                        for col in output_columns:
-                            output_row.append(row_data.get(col, ''))
-                    else:
-                        output_row = []
-                        for col in all_headers:
-                            output_row.append(row_data.get(col, ''))
-
-                    if not output_file:
-                        if output_encoding == 'auto':
-                            output_encoding = input_encoding
-                        if max_rows_per_file and output_file_counter >= 1:
-                            output_file_path = os.path.splitext(os.path.join(output_dir, output_filename))[0] + f"_{output_file_counter:04d}.csv"
-                        output_file = open(output_file_path, 'w', encoding=output_encoding, newline='')
-                        output_writer = csv.writer(output_file, quotechar=output_quotechar, quoting=output_quote)
-                        
-                        output_header = []
-                        if output_columns:
-                            output_header = output_columns
-                        else:
-                            output_header = all_headers
-                        output_writer.writerow(output_header)
-
-                    output_writer.writerow(output_row)
-                    row_count += 1
-
-                    if max_rows_per_file and row_count >= max_rows_per_file:
-                        output_file.close()
-                        output_file = None
-                        output_writer = None
-                        row_count = 0
-                        output_file_counter += 1
-
-        except Exception as e:
-            log_error(f"ファイルの処理中にエラーが発生しました: {e}", file_path)
-            continue
-    
-    if output_file:
-        output_file.close()
-
-def main():
+# jobs で、読み込んだ行をそれぞれのジョブで処理する単位（行数）
+_FANOUT_BATCH_ROWS = 10000
+
+def _job_configs(config):
+    """ジョブごとの設定のリスト（jobs を使用しない設定の場合は None）
+
+    config が設定のリストの場合はそれぞれをジョブの設定とし、jobs を含む設定の場合は
+    jobs 以外の項目をすべてのジョブに共通の設定として、jobs の各設定で上書きする。
+    """
+    if isinstance(config, list):
+        return config
+    jobs = config.get('jobs')
+    if jobs is None:
+        return None
+    common = {key: value for key, value in config.items() if key != 'jobs'}
+    return [dict(common, **job) for job in jobs]
+
+def _share_expressions(jobs):
+    """複数のジョブにある同じ式の評価を、1行に一度だけにする（RowPlan.shared_results を設定する）
+
+    列の型・参照ファイル・fnフォルダが同じジョブの間で共有する。共有する式の結果の表のリストを返す。
+    """
+    groups = {}
+    for job in jobs:
+        context = json.dumps({key: job.plan_args[key] for key in ('fn_dir', 'column_types', 'lookups')},
+                             sort_keys=True, ensure_ascii=False)
+        groups.setdefault(context, []).append(job.plan)
+    tables = []
+    for plans in groups.values():
+        counts = collections.Counter(expression for plan in plans for expression in plan.shareable_expressions())
+        results = {expression: {} for expression, count in counts.items() if count > 1}
+        if results:
+            tables.extend(results.values())
+            for plan in plans:
+                plan.shared_results = results
+    return tables
+
+def _process_file_jobs(file_path, encoding, jobs, shared_tables=()):
+    """ファイルを1回だけ読み込み、_FANOUT_BATCH_ROWS 行ごとにそれぞれのジョブで処理して書き出す
+
+    処理中にエラーが発生したジョブでは、そのファイルの残りの行は処理しない。
+    shared_tables（共有する式の結果の表）は処理の単位ごとに空にしてから使う。
+    """
+    log = _file_logger(file_path)
+    # FastCSVReader は、すべてのジョブで fast_reader が有効な場合に使う
+    plan = next((job.plan for job in jobs if not job.plan.fast_reader), jobs[0].plan)
+    with _open_csv(file_path, encoding, plan) as reader:
+        header = next(reader, None)
+        if header is None:
+            log_error("ヘッダー行を読み込めませんでした。", file_path)
+            return
+        if isinstance(reader, FastCSVReader):
+            used = set()
+            for job in jobs:
+                used.update(job.plan.used_columns(header))
+            reader.used_columns = sorted(used) if len(used) * 4 < len(header) else None
+        active = list(jobs)
+        line_start = 2
+        while active:
+            rows = list(itertools.islice(reader, _FANOUT_BATCH_ROWS))
+            if not rows:
+                break
+            for results in shared_tables:
+                results.clear()
+            for job in list(active):
+                try:
+                    _write_rows(rows, header, job.plan, job.state, job.writer, log, line_start)
+                except Exception as e:
+                    log_error(f"ファイルの処理中にエラーが発生しました: {e}", file_path)
+                    active.remove(job)
+            line_start += len(rows)
+
+def _process_jobs(configs):
+    """複数のジョブを、入力ファイルを1回だけ読み込んで処理する（ログを開いた状態で呼び出す）
+
+    input_dir・input_encoding はすべてのジョブで同じとする。ジョブごとに RowPlan・行番号(@#)・出力を持ち、
+    複数のジョブにある同じ式は1行に一度だけ評価する（_share_expressions）。
+    出力は別スレッドで書き込むため、書き込みが遅いジョブがあっても、そのジョブの出力のバッファ
+    （output_batch_rows 行 × 2）が一杯になるまでは他のジョブを待たせない。workers・chunk_size は使用しない。
+    """
+    if not configs:
+        log_error("jobs にジョブの設定がありません。")
+        return
+    inputs = {(config.get('input_dir'), config.get('input_encoding', 'UTF-8')) for config in configs}
+    if len(inputs) > 1:
+        log_error("jobs の input_dir・input_encoding はすべてのジョブで同じにしてください。")
+        return
+    input_encoding = configs[0].get('input_encoding', 'UTF-8')
+    jobs = []
+    try:
+        for config in configs:
+            job = _prepare_job(config, fanout=True)
+            if job is not None:
+                jobs.append(job)
+        if not jobs:
+            return
+        shared_tables = _share_expressions(jobs)
+        for file_path in jobs[0].input_files:
+            print(f"処理中のファイル: {os.path.basename(file_path)}")
+            try:
+                _process_file_jobs(file_path, input_encoding, jobs, shared_tables)
+            except Exception as e:
+                log_error(f"ファイルの処理中にエラーが発生しました: {e}", file_path)
+    finally:
+        # 1つのジョブの出力のエラーで、他のジョブの出力を閉じないままにしない
+        for job in jobs:
+            try:
+                _finish_job(job)
+            except Exception as e:
+                log_error(f"出力の書き込み中にエラーが発生しました: {e}")
+
+def _output_size(paths):
+    """出力ファイルの合計サイズ"""
+    return sum(os.path.getsize(path) for path in paths if os.path.exists(path))
+
+def _write_profile(config, metrics, elapsed, input_files, bytes_out, workers, profiler=None, type_errors=None,
+                   message_file=None):
+    """profile のレポート（JSON）と、cProfile の結果を保存する（message_file は完了のメッセージの出力先）"""
+    report_path = config.get('profile_report') or "csvsc_profile.json"
+    cprofile_path = None
+    try:
+        if profiler is not None:
+            cprofile_path = os.path.splitext(report_path)[0] + ".prof"
+            profiler.dump_stats(cprofile_path)
+        bytes_in = sum(os.path.getsize(path) for path in input_files if os.path.exists(path))
+        report = metrics.report(elapsed, bytes_in, bytes_out, files=len(input_files), workers=workers,
+                                cprofile=cprofile_path, type_errors=type_errors or {})
+        write_report(report_path, report)
+        print(f"プロファイルを出力しました: {report_path}", file=message_file)
+    except Exception as e:
+        log_error(f"プロファイルの出力に失敗しました: {e}")
+
+def _load_manifest(config, output_dir, output_header, input_files, writer):
+    """incremental の記録を読み込む
+
+    設定・fnフォルダ・出力列が前回と異なる場合、または処理済みの入力ファイルの内容が
+    変わった場合は、前回の出力ファイルを削除してすべての入力ファイルを処理し直す。
+    """
+    from utils.expression_evaluator import default_fn_dir
+    manifest_path = config.get('manifest_path') or os.path.join(output_dir, ".csvsc_manifest.json")
+    fingerprint = {
+        "config": config_hash(config),
+        "fn": fn_hash(default_fn_dir()),
+        "output_header": list(output_header),
+    }
+    lookups = _lookup_specs(config)
+    if lookups:
+        # 参照ファイルが変わった場合は処理し直す
+        from utils.lookups import fingerprint as lookups_fingerprint
+        fingerprint["lookups"] = lookups_fingerprint(lookups)
+    manifest = RunManifest.load(manifest_path, fingerprint)
+    changed = manifest.changed_files(input_files)
+    if changed:
+        for file_path in changed:
+            log_error("処理済みの入力ファイルが変更されたため、すべての入力ファイルを処理し直します。", file_path)
+        manifest.reset()
+    if manifest.previous_parts:
+        print("設定または入力ファイルが変更されたため、すべての入力ファイルを処理し直します。")
+        for path in manifest.previous_parts:
+            if os.path.exists(path):
+                os.remove(path)
+        manifest.previous_parts = []
+    return manifest
+
+_watch_plans = {}
+
+def _watch_plan(plan_args):
+    """RowPlan を設定・出力列ごとに再利用する（式のコンパイルとfnフォルダのロードはプロセスごとに一度だけ行う）"""
+    key = json.dumps(plan_args, sort_keys=True, ensure_ascii=False)
+    plan = _watch_plans.get(key)
+    if plan is None:
+        plan = RowPlan(**plan_args)
+        _watch_plans[key] = plan
+    return plan
+
+def _process_watch_file(task):
+    """watch で到着した入力ファイルを1つ処理する（ワーカープロセスでも実行する）
+
+    出力ファイルは output_dir の一時フォルダに書き込み、すべての行を書き込んだ後に output_dir に移す。
+    出力ファイル名は「入力ファイル名（拡張子を含む）_output_filename」、行番号(@#)は入力ファイルごとに1から始まる。
+    ログはメモリに蓄積し、呼び出し側が書き出す。
+    """
+    file_path, config, plan_args = task
+    result = {"rows": 0, "parts": [], "logs": [], "error": None, "type_errors": {}}
+    logs = result["logs"]
+
+    def log(kind, message, line_num):
+        logs.append((kind, message, line_num))
+
+    input_encoding = config.get('input_encoding', 'UTF-8')
+    output_dir = config['output_dir']
+    temp_dir = os.path.join(output_dir, ".csvsc_tmp")
+    # 拡張子・圧縮形式の拡張子も含める（data.csv と data.tsv の出力ファイルを別にする）
+    name = os.path.basename(file_path)
+    writer = None
+    plan = None
+    try:
+        output_header = config.get('output_columns', [])
+        plan_args = dict(plan_args)
+        if not output_header or config.get('column_types'):
+            # "auto" の列の型は入力ファイルごとに推定する
+            header, sample = _read_sample(file_path, input_encoding, _column_types_sample(config))
+            if not header:
+                raise ValueError("ヘッダー行を読み込めませんでした。")
+            _resolve_column_types(config, plan_args, header, sample)
+        if not output_header:
+            output_header = _default_output_header(config, [header], _load_lookups(config))
+        plan_args["output_header"] = output_header
+        plan = _watch_plan(plan_args)
+        os.makedirs(temp_dir, exist_ok=True)
+        writer_header, output_stages = _output_stages(config, output_header, plan_args["column_types"])
+        writer = output_writer = _output_writer(config, temp_dir, f"{name}_{config['output_filename']}",
+                                                writer_header)
+        if output_stages is not None:
+            writer = output_stages(writer)
+        state = SequenceState()
+        with _open_csv(file_path, input_encoding, plan) as reader:
+            header = next(reader, None)
+            if header is None:
+                raise ValueError("ヘッダー行を読み込めませんでした。")
+            _set_header(reader, plan, header)
+            for line_num, output_row, values in plan.iter_rows(reader, header, 2, state, log):
+                state.sequence_number += 1
+                writer.writerow(output_row)
+        writer.close()
+        for part in writer.parts:
+            final_path = os.path.join(output_dir, os.path.basename(part))
+            os.replace(part, final_path)
+            result["parts"].append(final_path)
+        result["rows"] = output_writer.total_rows
+        result["type_errors"] = plan.take_type_errors()
+        aggregator = getattr(writer, "aggregator", None)
+        if aggregator is not None:
+            for name, count in aggregator.errors.items():
+                logs.append(('error', f"集計列[{name}]の {count} 件の値を数値に変換できないため、集計から除きました。", None))
+        # output_partition_by の場合はパーティションごとの出力ファイル
+        for part_writer in getattr(output_writer, "writers", {None: output_writer}).values():
+            if not part_writer.max_rows_per_file:
+                continue
+            # 前回の処理で作成した、今回より後の番号の出力ファイルを削除する
+            file_counter = len(part_writer.parts) + 1
+            while True:
+                stale_path = os.path.join(output_dir, os.path.basename(part_writer.part_path(file_counter)))
+                if not os.path.exists(stale_path):
+                    break
+                os.remove(stale_path)
+                file_counter += 1
+        if getattr(output_writer, "errors", 0):
+            logs.append(('error', f"output_partition_by の式を評価できない {output_writer.errors} 行は、"
+                                  "空の値のパーティションに出力しました。", None))
+    except Exception as e:
+        result["error"] = str(e)
+        if plan is not None:
+            plan.take_type_errors()
+        if writer is not None:
+            try:
+                writer.close()
+            except Exception:
+                pass
+            for part in writer.parts:
+                if os.path.exists(part):
+                    os.remove(part)
+    return result
+
+def watch_files(config, stop=None):
+    """input_dir を監視し、到着した入力ファイルを処理し続ける（stop が設定されるまで）"""
+    _open_logs_for(config)
+    try:
+        _watch_files(config, stop if stop is not None else threading.Event())
+    finally:
+        close_logs()
+
+def _watch_files(config, stop):
+    """watch_files の本体（ログを開いた状態で呼び出す）
+
+    処理済みの入力ファイルは記録し、再起動後も内容が変わっていなければ処理しない。
+    workers が 2 以上の場合はワーカープロセスで処理し、処理中のファイル数を workers + 2 までに
+    制限する（それ以上のファイルは input_dir に残したまま待つ）。
+    """
+    from utils.watcher import DirectoryWatcher, WatchStatus
+
+    input_dir = config.get('input_dir')
+    output_dir = config.get('output_dir')
+    if not input_dir or not output_dir or not config.get('output_filename'):
+        log_error("入力ディレクトリ、出力ディレクトリ、出力ファイル名のいずれかが設定されていません。")
+        return
+    try:
+        _writer_options(config)
+        _validate_column_types(config)
+        _load_lookups(config)
+    except ValueError as e:
+        log_error(str(e))
+        return
+    if not os.path.isdir(input_dir):
+        log_error(f"入力ディレクトリが見つかりません: {input_dir}")
+        return
+    os.makedirs(output_dir, exist_ok=True)
+
+    plan_args = _plan_args(config, [])
+    plan_cache = _load_plan_cache(config, plan_args)
+    from utils.expression_evaluator import default_fn_dir
+    manifest_path = config.get('manifest_path') or os.path.join(output_dir, ".csvsc_watch.json")
+    fingerprint = {"config": config_hash(config), "fn": fn_hash(default_fn_dir())}
+    if plan_args["lookups"]:
+        # 参照ファイルが変わった場合は処理し直す
+        from utils.lookups import fingerprint as lookups_fingerprint
+        fingerprint["lookups"] = lookups_fingerprint(plan_args["lookups"])
+    manifest = RunManifest.load(manifest_path, fingerprint)
+    watcher = DirectoryWatcher(input_dir, is_input_filename, config.get('watch_interval', 1.0),
+                               config.get('watch_settle', 1.0))
+    status = WatchStatus(config.get('watch_status_path') or os.path.join(output_dir, ".csvsc_watch_status.json"),
+                         config.get('watch_status_interval', 5.0))
+    workers = config.get('workers', 1) or 1
+    max_pending = workers + 2
+    executor = None
+    if workers > 1:
+        from concurrent.futures import ProcessPoolExecutor, wait as futures_wait, FIRST_COMPLETED
+        executor = ProcessPoolExecutor(max_workers=workers)
+    queue = collections.deque()
+    queued = set()
+    # 処理に失敗したファイル -> (大きさ, 更新日時)（変更されるまで処理し直さない）
+    failed = {}
+    pending = {}
+
+    def finish(file_path, result):
+        log = _file_logger(file_path)
+        for kind, message, line_num in result["logs"]:
+            log(kind, message, line_num)
+        for name, count in sorted(result.get("type_errors", {}).items()):
+            log_error(f"列[{name}]の {count} 件の値を変換できないため、行をスキップしました。", file_path)
+        queued.discard(file_path)
+        if result["error"] is not None:
+            log_error(f"ファイルの処理中にエラーが発生しました: {result['error']}", file_path)
+            try:
+                stat = os.stat(file_path)
+                failed[file_path] = (stat.st_size, stat.st_mtime_ns)
+            except OSError:
+                pass
+            status.record(file_path, 0, result["error"])
+            return
+        failed.pop(file_path, None)
+        try:
+            manifest.commit(file_path, None)
+        except OSError as e:
+            log_error(f"処理済みの記録を保存できませんでした: {e}", file_path)
+        status.record(file_path, result["rows"])
+        print(f"処理しました: {os.path.basename(file_path)} ({result['rows']} 行)")
+
+    def write_status(force=False):
+        try:
+            status.write(force)
+        except OSError as e:
+            log_error(f"状態ファイルを書き出せませんでした: {e}")
+
+    def is_new(file_path):
+        if file_path in queued:
+            return False
+        try:
+            stat = os.stat(file_path)
+            if failed.get(file_path) == (stat.st_size, stat.st_mtime_ns):
+                return False
+            return not manifest.is_processed(file_path)
+        except OSError:
+            return False
+
+    print(f"入力ディレクトリを監視しています: {input_dir}")
+    try:
+        while True:
+            if not stop.is_set():
+                for file_path in watcher.ready_files():
+                    if is_new(file_path):
+                        queue.append(file_path)
+                        queued.add(file_path)
+            while queue and len(pending) < max_pending and not stop.is_set():
+                file_path = queue.popleft()
+                task = (file_path, config, plan_args)
+                if executor is None:
+                    status.queued = len(queue)
+                    status.in_flight = 1
+                    finish(file_path, _process_watch_file(task))
+                    status.in_flight = 0
+                    write_status()
+                else:
+                    pending[executor.submit(_process_watch_file, task)] = file_path
+            if pending:
+                done, not_done = futures_wait(list(pending), timeout=watcher.poll_interval, return_when=FIRST_COMPLETED)
+                for future in done:
+                    file_path = pending.pop(future)
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        result = {"rows": 0, "parts": [], "logs": [], "error": str(e)}
+                    finish(file_path, result)
+            status.queued = len(queue)
+            status.in_flight = len(pending)
+            write_status()
+            if stop.is_set():
+                if not pending:
+                    break
+            elif not pending and not queue:
+                watcher.wait()
+    finally:
+        if executor is not None:
+            executor.shutdown(wait=True)
+        watcher.close()
+        status.queued = len(queue)
+        status.in_flight = 0
+        write_status(force=True)
+        _save_plan_cache(plan_cache)
+
+def main(argv=None):
     """メイン処理"""
-    config_path = "csvsc.json"
-    config = load_config(config_path)
-    if config:
+    parser = argparse.ArgumentParser(description="CSV/TSVファイルを処理します。")
+    parser.add_argument('--config', default="csvsc.json", help="設定ファイル（デフォルトは csvsc.json）")
+    parser.add_argument('--pipe', action='store_true',
+                        help="input_dir・output_dir の代わりに標準入力から読み込み、標準出力に書き出す")
+    parser.add_argument('--tsv', action='store_true', help="--pipe の入力をTSVとして読み込む")
+    parser.add_argument('--watch', action='store_true',
+                        help="input_dir を監視し、到着した入力ファイルを処理し続ける（Ctrl+C で終了）")
+    args = parser.parse_args(argv)
+
+    if not args.pipe:
+        print("CSV/TSVファイルを処理します。")
+    config = load_config(args.config)
+    if not config:
+        return
+    if (args.watch or args.pipe) and _job_configs(config) is not None:
+        log_error("--watch・--pipe では jobs を使用できません。")
+        return
+    if args.watch:
+        stop = threading.Event()
+        # 処理中のファイルを書き終えてから終了する
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(signum, lambda *args: stop.set())
+        watch_files(config, stop)
+        return
+    if not args.pipe:
         process_files(config)
+        return
+
+    input_encoding = config.get('input_encoding', 'UTF-8')
+    output_encoding = config.get('output_encoding', 'auto')
+    if output_encoding == 'auto':
+        output_encoding = input_encoding
+    stdin = io.TextIOWrapper(sys.stdin.buffer, encoding=input_encoding, newline='')
+    stdout = io.TextIOWrapper(sys.stdout.buffer, encoding=output_encoding, newline='')
+    try:
+        process_stream(config, stdin, stdout, delimiter='\t' if args.tsv else ',')
+    except BrokenPipeError:
+        # 出力先（head など）が先に終了した場合は、残りの出力を捨てて終了する
+        devnull = os.open(os.devnull, os.O_WRONLY)
+        os.dup2(devnull, sys.stdout.fileno())
+    finally:
+        stdin.detach()
+        try:
+            stdout.detach()
+        except (BrokenPipeError, ValueError):
+            pass
 
 if __name__ == "__main__":
-    print("CSV/TSVファイルを処理します。")
-    main()
\ No newline at end of file
+    # freeze_support() は実行ファイルにまとめた場合のみ必要（multiprocessing の読み込みを省く）
+    if getattr(sys, 'frozen', False):
+        import multiprocessing
+        multiprocessing.freeze_support()
+    main()
@@ -2,7 +2,7 @@ import csv
 import random
 import string
 
-def generate_large_csv(filename, num_rows, num_columns):
+def generate_large_csv(filename, num_rows, num_columns, delimiter=',', encoding='utf-8'):
     """
     指定された行数と列数で、ランダムなデータを含むCSVファイルを生成します。
 
@@ -10,9 +10,11 @@ def generate_large_csv(filename, num_rows, num_columns):
         filename (str): 生成するCSVファイルのパス。
         num_rows (int): 生成するCSVファイルの行数。
         num_columns (int): 生成するCSVファイルの列数。
+        delimiter (str): 区切り文字。TSVの場合は '\\t'。
+        encoding (str): ファイルのエンコーディング。
     """
-    with open(filename, 'w', newline='', encoding='utf-8') as csvfile:
-        writer = csv.writer(csvfile)
+    with open(filename, 'w', newline='', encoding=encoding) as csvfile:
+        writer = csv.writer(csvfile, delimiter=delimiter)
 
         # ヘッダー行を書き込む
         header = [f"column{i+1}" for i in range(num_columns)]
@@ -6,8 +6,13 @@ import datetime
 import sys
 import tempfile
 sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
-from csvsc import load_config, log_error, get_input_files, read_header, process_files
-from utils.expression_evaluator import ExpressionEvaluator
+from csvsc import load_config, log_error, get_input_files, read_header, process_files, process_stream
+from utils.expression_evaluator import ExpressionEvaluator, FunctionRegistry, compile_expression, build_namespace
+from utils.batch_evaluator import BatchEvaluator
+from utils.log_writer import LogWriter, RateLimiter
+from utils.filter_planner import FilterPlanner, estimate_cost
+from utils.fast_reader import FastCSVReader
+from utils.profiler import RunMetrics
 
 # テスト用の設定ファイルを作成
 @pytest.fixture(scope="session")
@@ -230,4 +235,1523 @@ def test_expression_evaluator():
     evaluator = ExpressionEvaluator(1, {"column1": "10", "column2": "20"})
     with pytest.raises(ValueError, match="式の評価に失敗しました"):
         evaluator.evaluate("$[column1] + @[column2]")
-            
+
+# コンパイル済みの式のテスト
+def test_compiled_expression():
+    compiled = compile_expression("$[column1] + $[COLUMN2] + $# + str(@[column2] + @#)")
+    assert compiled is compile_expression("$[column1] + $[COLUMN2] + $# + str(@[column2] + @#)")
+    assert sorted(compiled.columns) == ["column1", "column2"]
+
+    namespace = build_namespace({"str": str})
+    evaluate = compiled.bind(["Column2", "column1"], namespace)
+    assert evaluate(["20", "10"], 1) == "1020121"
+    assert evaluate(["x", "a'b\\n"], 2) == "a'b\\nx22"
+
+    # ヘッダーに存在しない列は空文字・0として扱う
+    evaluate = compile_expression("$[column9] + str(@[column9])").bind(["column1"], namespace)
+    assert evaluate(["1"], 1) == "0"
+
+    # 列名の直接参照
+    evaluate = compile_expression("column1 + column2").bind(["column1", "column2"], namespace)
+    assert evaluate(["1", "2"], 1) == "12"
+
+    evaluate = compile_expression("$[column1] +").bind(["column1"], namespace)
+    with pytest.raises(ValueError, match="式の評価に失敗しました"):
+        evaluate(["1"], 1)
+
+# 関数レジストリのテスト
+def test_function_registry(tmp_path):
+    module_path = tmp_path / "funcs.py"
+    module_path.write_text("def double(x):\n    return x * 2\n", encoding='utf-8')
+    registry = FunctionRegistry(str(tmp_path), check_interval=3600)
+    assert registry.refresh(force=True)
+    assert registry.functions["double"](2) == 4
+    evaluate = compile_expression("double(@[column1])").bind(["column1"], registry.namespace)
+    assert evaluate(["3"], 1) == 6
+
+    # 変更がなければ再ロードしない
+    assert not registry.refresh(force=True)
+    # 確認間隔内は変更を確認しない
+    module_path.write_text("def double(x):\n    return x * 3\n", encoding='utf-8')
+    os.utime(module_path, ns=(0, 0))
+    assert not registry.refresh()
+    assert registry.refresh(force=True)
+    assert evaluate(["3"], 1) == 9
+    assert registry.stats()["load_count"] == 1
+    assert registry.stats()["reload_count"] == 1
+
+    # 更新日時のみの変更では再ロードしない
+    os.utime(module_path, ns=(10**9, 10**9))
+    assert not registry.refresh(force=True)
+    assert registry.stats()["reload_count"] == 1
+
+# pure と宣言した関数のキャッシュのテスト
+def test_function_registry_cache(tmp_path):
+    from csvsc import RowPlan, SequenceState
+    module_path = tmp_path / "funcs.py"
+    module_path.write_text(
+        "from utils.function_cache import impure\n"
+        "__pure__ = ['code', 'stamp']\n"
+        "calls = []\n"
+        "def code(x):\n    calls.append(x)\n    return 'c' + x\n"
+        "@impure\n"
+        "def stamp(x):\n    calls.append(x)\n    return len(calls)\n"
+        "def count():\n    return len(calls)\n", encoding='utf-8')
+    registry = FunctionRegistry(str(tmp_path), check_interval=3600, cache_size=2)
+    registry.refresh(force=True)
+    evaluate = compile_expression("code($[column1])").bind(["column1"], registry.cached_namespace)
+    assert [evaluate([v], 1) for v in ["a", "b", "a", "a", "c", "a"]] == ["ca", "cb", "ca", "ca", "cc", "ca"]
+    assert registry.functions["count"]() == 3
+    assert registry.cache_stats()["code"] == {"hits": 3, "misses": 3, "evictions": 1}
+    # impure の関数はキャッシュしない
+    assert "stamp" not in registry.cache_stats()
+
+    # 再ロードした関数のキャッシュは破棄する（統計は累計）
+    module_path.write_text("__pure__ = ['code']\ndef code(x):\n    return 'd' + x\n", encoding='utf-8')
+    os.utime(module_path, ns=(0, 0))
+    assert registry.refresh(force=True)
+    assert evaluate(["a"], 1) == "da"
+    assert registry.cache_stats()["code"] == {"hits": 3, "misses": 4, "evictions": 1}
+
+    # 行番号を参照する式からの呼び出しはキャッシュしない
+    plan = RowPlan([], {"x": "code($[column1])", "y": "code($#)"}, ["x", "y"], fn_dir=str(tmp_path),
+                   fn_cache_size=2)
+    rows = [row for line_num, row, values in plan.iter_rows([["a"], ["a"]], ["column1"], 2, SequenceState(),
+                                                              lambda *args: None)]
+    assert rows == [("da", "d1"), ("da", "d1")]
+    assert plan.registry.cache_stats()["code"] == {"hits": 1, "misses": 1, "evictions": 0}
+
+# 並列処理のテスト（逐次処理と同じ出力になること）
+def test_process_files_parallel(tmp_path):
+    input_dir = tmp_path / "input"
+    input_dir.mkdir()
+    for k in range(2):
+        with open(input_dir / f"data{k}.csv", 'w', newline='', encoding='utf-8') as f:
+            writer = csv.writer(f)
+            writer.writerow(["column1", "column2", "column3"])
+            if k == 1:
+                # クォートされていないフィールド内のクォート（チャンク境界の推定が誤る）
+                f.write('5"x,10,2\n')
+            for i in range(200):
+                writer.writerow([str(i), str(i % 20), ["a", "b\nc", 'd"e', "あ"][i % 4]])
+
+    def run(workers):
+        output_dir = tmp_path / f"output{workers}"
+        process_files({
+            "input_dir": str(input_dir),
+            "output_dir": str(output_dir),
+            "output_filename": "output.csv",
+            "max_rows_per_file": 37,
+            "add_columns": {"new_column": "$[column3] + $#", "double": "@[column2] * 2"},
+            "filter_conditions": ["@[column2] > 5"],
+            "workers": workers,
+            "chunk_size": 256,
+        })
+        outputs = {}
+        for name in sorted(os.listdir(output_dir)):
+            with open(output_dir / name, 'r', encoding='utf-8', newline='') as f:
+                outputs[name] = f.read()
+        return outputs
+
+    serial = run(1)
+    assert len(serial) > 2
+    assert run(3) == serial
+
+# 空の入力ファイルは並列処理でも逐次処理と同じエラーを出力する
+def test_process_files_parallel_empty_file(tmp_path):
+    input_dir = tmp_path / "input"
+    input_dir.mkdir()
+    (input_dir / "a.csv").write_bytes(b"")
+    with open(input_dir / "b.csv", 'w', newline='', encoding='utf-8') as f:
+        f.write("column1,column2\n1,2\n3,4\n")
+
+    def run(workers):
+        if os.path.exists("error.txt"):
+            os.remove("error.txt")
+        output_dir = tmp_path / f"output{workers}"
+        process_files({
+            "input_dir": str(input_dir),
+            "output_dir": str(output_dir),
+            "output_filename": "output.csv",
+            "workers": workers,
+        })
+        with open("error.txt", 'r', encoding='utf-8') as f:
+            # 日時を除く
+            errors = "".join(line.split('\t', 1)[1] for line in f)
+        os.remove("error.txt")
+        with open(output_dir / "output.csv", 'r', encoding='utf-8', newline='') as f:
+            return f.read(), errors
+
+    output, errors = run(2)
+    assert "ヘッダー行を読み込めませんでした。" in errors
+    assert "ファイルの処理中にエラーが発生しました" not in errors
+    assert (output, errors) == run(1)
+
+# 一括評価のテスト（行ごとの評価と同じ結果になること）
+def test_batch_evaluator():
+    header = ["column1", "column2"]
+    rows = [["1", "20"], ["x", "5"], [" 7 ", ""], ["3.5", "-4"], ["12", "0"]]
+    expressions = ["@[column1] > 5", "@[column1] * 2 + @[column2]", "@[column1] // @[column2]", "fnc1(@[column1])", "@[column9] + 1"]
+    batch = BatchEvaluator()
+    batch_ids = [batch.add(compile_expression(e), False) for e in expressions]
+    assert batch_ids[3] is None
+    results = batch.bind(header)(rows)
+    # ゼロ除算を含むブロックは行ごとの評価に戻す
+    assert results[batch_ids[2]] is None
+
+    namespace = build_namespace()
+    for expression, batch_id in zip(expressions, batch_ids):
+        if batch_id is None or results[batch_id] is None:
+            continue
+        evaluate = compile_expression(expression).bind(header, namespace)
+        assert results[batch_id] == [evaluate(row, 1) for row in rows]
+
+def test_process_files_batch(tmp_path):
+    input_dir = tmp_path / "input"
+    input_dir.mkdir()
+    with open(input_dir / "data.csv", 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        writer.writerow(["column1", "column2", "column3"])
+        for i in range(100):
+            writer.writerow([str(i), ["5", "x", "", "15"][i % 4], str(i % 3)])
+        writer.writerow(["1", "2"])
+
+    def run(batch_size):
+        output_dir = tmp_path / f"output{batch_size}"
+        process_files({
+            "input_dir": str(input_dir),
+            "output_dir": str(output_dir),
+            "output_filename": "output.csv",
+            "add_columns": {"sum": "@[column1] + @[column2]", "ratio": "@[column1] / @[column3]", "seq": "$#"},
+            "filter_conditions": ["@[column2] > 1 or @[column1] < 10"],
+            "batch_size": batch_size,
+        })
+        with open(output_dir / "output.csv", 'r', encoding='utf-8', newline='') as f:
+            return f.read()
+
+    assert run(16) == run(0)
+
+# 出力列の対応付けのテスト（重複する列名・上書きする追加列・存在しない列）
+def test_process_files_projection(tmp_path):
+    input_dir = tmp_path / "input"
+    input_dir.mkdir()
+    with open(input_dir / "data.csv", 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        writer.writerow(["column1", "column2", "column1"])
+        writer.writerow(["1", "2", "3"])
+        writer.writerow(["4", "x", "6"])
+
+    output_dir = tmp_path / "output"
+    process_files({
+        "input_dir": str(input_dir),
+        "output_dir": str(output_dir),
+        "output_filename": "output.csv",
+        "output_columns": ["column2", "column1", "missing", "new_column"],
+        "add_columns": {"column2": "$[column2] * (10 // @[column2])", "new_column": "$#"},
+    })
+    with open(output_dir / "output.csv", 'r', encoding='utf-8', newline='') as f:
+        output_data = list(csv.reader(f))
+    assert output_data == [
+        ["column2", "column1", "missing", "new_column"],
+        ["22222", "3", "", "1"],
+        # 計算に失敗した追加列は元の列の値を出力する
+        ["x", "6", "", "2"],
+    ]
+    if os.path.exists("error.txt"):
+        os.remove("error.txt")
+
+# バッファ付きログのテスト
+@pytest.mark.parametrize("background", [False, True])
+def test_log_writer(tmp_path, background):
+    log_path = tmp_path / "test.log"
+    writer = LogWriter(str(log_path), flush_interval=60, background=background)
+    writer.write("line1\n")
+    if not background:
+        # ファイルは最初に書き出す時に作成する
+        assert not log_path.exists()
+    writer.flush()
+    assert log_path.read_text(encoding='utf-8') == "line1\n"
+    for i in range(2500):
+        writer.write(f"{i}\n")
+    writer.close()
+    writer.write("closed\n")
+    lines = log_path.read_text(encoding='utf-8').splitlines()
+    assert lines == ["line1"] + [str(i) for i in range(2500)]
+
+def test_rate_limiter():
+    limiter = RateLimiter(3)
+    assert [limiter.allow() for i in range(5)] == [True, True, True, False, False]
+    assert limiter.suppressed == 2
+    assert all(RateLimiter(0).allow() for i in range(100))
+
+# ストリーム処理のテスト（ファイルの処理と同じ結果になること）
+def test_process_stream(tmp_path):
+    import io
+    lines = ["column1\tcolumn2\n"] + [f"{i}\t{i % 7}\n" for i in range(50)] + ["1\n"]
+    config = {
+        "add_columns": {"seq": "$#", "double": "@[column2] * 2"},
+        "filter_conditions": ["@[column2] > 2"],
+        "output_quotemode": "minimal",
+    }
+
+    output = io.StringIO()
+    assert process_stream(config, io.StringIO(''.join(lines)), output, delimiter='\t') == 28
+
+    input_dir = tmp_path / "input"
+    input_dir.mkdir()
+    with open(input_dir / "data.tsv", 'w', encoding='utf-8', newline='') as f:
+        f.writelines(lines)
+    output_dir = tmp_path / "output"
+    process_files(dict(config, input_dir=str(input_dir), output_dir=str(output_dir), output_filename="output.csv"))
+    with open(output_dir / "output.csv", 'r', encoding='utf-8', newline='') as f:
+        assert output.getvalue() == f.read()
+
+    # イテラブルの入力と writerow() を持つ出力先
+    class Rows:
+        def __init__(self):
+            self.rows = []
+
+        def writerow(self, row):
+            self.rows.append(list(row))
+
+    rows = Rows()
+    process_stream(dict(config, output_columns=["seq", "column1"]), iter(lines), rows, delimiter='\t')
+    assert rows.rows[:3] == [["seq", "column1"], ["1", "3"], ["2", "4"]]
+    if os.path.exists("error.txt"):
+        os.remove("error.txt")
+
+def test_process_stream_profile_and_messages(tmp_path, capsys):
+    import io
+    # 関数のロードのエラーとプロファイルのメッセージは、出力の行と混ざらないように標準エラー出力に出力する
+    fn_dir = tmp_path / "fn"
+    fn_dir.mkdir()
+    (fn_dir / "broken.py").write_text("def f(:\n", encoding='utf-8')
+    FunctionRegistry(str(fn_dir)).refresh()
+    report = tmp_path / "profile.json"
+    config = {"filter_conditions": ["@[column1] > 1"], "profile": True, "profile_report": str(report)}
+    output = io.StringIO()
+    assert process_stream(config, io.StringIO("column1\n1\n2\n3\n"), output) == 2
+    captured = capsys.readouterr()
+    assert captured.out == ""
+    assert "関数のロード中にエラーが発生しました" in captured.err and "プロファイルを出力しました" in captured.err
+    with open(report, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+    assert data["rows_read"] == 3 and data["rows_written"] == 2
+
+# 圧縮ファイルの入出力のテスト
+@pytest.mark.parametrize("compression_thread", [False, True])
+def test_process_files_compressed(tmp_path, compression_thread):
+    import gzip
+    import lzma
+    input_dir = tmp_path / "input"
+    input_dir.mkdir()
+    with gzip.open(input_dir / "data1.csv.gz", 'wt', encoding='utf-8', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(["column1", "column2"])
+        for i in range(5):
+            writer.writerow([str(i), "あ"])
+    with lzma.open(input_dir / "data2.tsv.xz", 'wt', encoding='utf-8', newline='') as f:
+        f.write("column1\tcolumn2\n5\tb,c\n6\td\n")
+
+    output_dir = tmp_path / "output"
+    process_files({
+        "input_dir": str(input_dir),
+        "output_dir": str(output_dir),
+        "output_filename": "output.csv",
+        "max_rows_per_file": 4,
+        "output_quotemode": "minimal",
+        "output_compression": "gzip",
+        "output_compression_level": 1,
+        "output_compression_thread": compression_thread,
+    })
+    assert sorted(os.listdir(output_dir)) == ["output_0001.csv.gz", "output_0002.csv.gz"]
+    rows = []
+    for name in sorted(os.listdir(output_dir)):
+        with gzip.open(output_dir / name, 'rt', encoding='utf-8', newline='') as f:
+            rows.extend(list(csv.reader(f))[1:])
+    assert rows == [[str(i), "あ"] for i in range(5)] + [["5", "b,c"], ["6", "d"]]
+
+# incremental のテスト（追加分だけを処理し、すべてを処理した場合と同じ出力になること）
+def test_process_files_incremental(tmp_path):
+    input_dir = tmp_path / "input"
+    input_dir.mkdir()
+
+    def add_file(name, start, count):
+        with open(input_dir / name, 'w', newline='', encoding='utf-8') as f:
+            writer = csv.writer(f)
+            writer.writerow(["column1", "column2"])
+            for i in range(start, start + count):
+                writer.writerow([str(i), str(i % 3)])
+
+    def run(output_name, incremental):
+        output_dir = tmp_path / output_name
+        process_files({
+            "input_dir": str(input_dir),
+            "output_dir": str(output_dir),
+            "output_filename": "output.csv",
+            "max_rows_per_file": 3,
+            "add_columns": {"seq": "$#"},
+            "filter_conditions": ["@[column2] > 0"],
+            "incremental": incremental,
+        })
+        outputs = {}
+        for name in sorted(os.listdir(output_dir)):
+            if name.endswith(".csv"):
+                with open(output_dir / name, 'r', encoding='utf-8', newline='') as f:
+                    outputs[name] = f.read()
+        return outputs
+
+    add_file("a.csv", 0, 4)
+    run("incremental", True)
+    add_file("b.csv", 4, 5)
+    assert run("incremental", True) == run("full1", False)
+
+    # 中断した処理の出力（記録の後に書き込まれた行・ファイル）は取り除く
+    output_dir = tmp_path / "incremental"
+    with open(output_dir / ".csvsc_manifest.json", 'r', encoding='utf-8') as f:
+        file_counter = json.load(f)["output"]["file_counter"]
+    with open(output_dir / f"output_{file_counter:04d}.csv", 'a', encoding='utf-8', newline='') as f:
+        f.write('"partial","row"\r\n')
+    with open(output_dir / f"output_{file_counter + 1:04d}.csv", 'w', encoding='utf-8') as f:
+        f.write("partial")
+    add_file("c.csv", 9, 4)
+    assert run("incremental", True) == run("full2", False)
+
+    # 処理済みのファイルが変更された場合はすべて処理し直す
+    add_file("a.csv", 100, 2)
+    assert run("incremental", True) == run("full3", False)
+
+# incremental でエラーにより処理を打ち切ったファイルは記録せず、途中まで書き込んだ行を取り除く
+@pytest.mark.parametrize("workers", [1, 2])
+@pytest.mark.parametrize("partition_by", [None, "grp"])
+def test_process_files_incremental_failed_file(tmp_path, workers, partition_by):
+    def add_file(input_dir, name, ids):
+        input_dir.mkdir(exist_ok=True)
+        with open(input_dir / name, 'w', newline='', encoding='utf-8') as f:
+            f.write("id,grp\n")
+            for i in ids:
+                f.write(f"{i},{'xy'[i % 2]}{i // 10}\n")
+
+    def run(input_dir, output_name, incremental):
+        output_dir = tmp_path / output_name
+        process_files({
+            "input_dir": str(input_dir),
+            "output_dir": str(output_dir),
+            "output_filename": "output.csv",
+            "max_rows_per_file": 3,
+            "add_columns": {"seq": "$#"},
+            # id が 50 の行で評価に失敗し、ファイルの処理を打ち切る
+            "filter_conditions": ["1 / (@[id] - 50) != 0"],
+            "output_partition_by": partition_by,
+            "workers": workers,
+            "incremental": incremental,
+        })
+        outputs = {}
+        for name in sorted(os.listdir(output_dir)):
+            if name.endswith(".csv"):
+                with open(output_dir / name, 'r', encoding='utf-8', newline='') as f:
+                    outputs[name] = f.read()
+        return outputs
+
+    input_dir = tmp_path / "input"
+    expected_dir = tmp_path / "expected"
+    for target in [input_dir, expected_dir]:
+        add_file(target, "a.csv", range(0, 14))
+        add_file(target, "c.csv", range(60, 65))
+    add_file(input_dir, "b.csv", range(45, 55))
+    assert run(input_dir, "incremental", True) == run(expected_dir, "full1", False)
+    with open(tmp_path / "incremental" / ".csvsc_manifest.json", 'r', encoding='utf-8') as f:
+        assert sorted(os.path.basename(path) for path in json.load(f)["files"]) == ["a.csv", "c.csv"]
+
+    # 修正したファイルは次回の実行で処理する
+    add_file(input_dir, "b.csv", range(40, 48))
+    add_file(expected_dir, "d.csv", range(40, 48))
+    assert run(input_dir, "incremental", True) == run(expected_dir, "full2", False)
+    if os.path.exists("error.txt"):
+        os.remove("error.txt")
+
+# フィルタ条件の評価順序のテスト（順序を変えても結果が同じになること）
+def test_filter_planner():
+    costs = [estimate_cost(compile_expression(e)) for e in ["fnc1($[column1]) != ''", "@[column2] > 5"]]
+    assert costs[0] > costs[1]
+    planner = FilterPlanner(costs, interval=10)
+    assert planner.order == [1, 0]
+    # 除外する割合が大きい条件を先に評価する
+    planner.evaluated = [100, 100]
+    planner.rejected = [99, 0]
+    assert planner.replan() == [0, 1]
+
+@pytest.mark.parametrize("filter_conditions", [
+    ["fnc1($[column1]) != '2'", "@[column2] > 5", "$[column3] != 'b'"],
+    # 評価に失敗する条件（順序を変えない場合と同じ行でファイルの処理を中断する）
+    ["$[column1] + 1", "@[column2] > 5"],
+    ["@[column2] > 5", "$[column3] + (1 if @[column1] > 150 else '')"],
+])
+def test_process_files_filter_reorder(tmp_path, filter_conditions):
+    input_dir = tmp_path / "input"
+    input_dir.mkdir()
+    with open(input_dir / "data.csv", 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        writer.writerow(["column1", "column2", "column3"])
+        for i in range(3000):
+            writer.writerow([str(i), str(i % 10), ["a", "b", "c"][i % 3]])
+
+    def run(filter_reorder):
+        output_dir = tmp_path / f"output{filter_reorder}"
+        process_files({
+            "input_dir": str(input_dir),
+            "output_dir": str(output_dir),
+            "output_filename": "output.csv",
+            "add_columns": {"seq": "$#"},
+            "filter_conditions": filter_conditions,
+            "filter_reorder": filter_reorder,
+        })
+        if not os.path.exists(output_dir / "output.csv"):
+            return None
+        with open(output_dir / "output.csv", 'r', encoding='utf-8', newline='') as f:
+            return f.read()
+
+    assert run(True) == run(False)
+    if os.path.exists("error.txt"):
+        os.remove("error.txt")
+
+def test_process_files_filter_reorder_default(tmp_path):
+    # デフォルトは設定の順序（先の条件の評価に失敗すると、後の条件で除外する行でもファイルの処理を中断する）
+    input_dir = tmp_path / "input"
+    input_dir.mkdir()
+    with open(input_dir / "data.csv", 'w', newline='', encoding='utf-8') as f:
+        f.write("column1,column2\n")
+        for i in range(100):
+            f.write(f"{i},{i % 40}\n")
+    output_dir = tmp_path / "output"
+    if os.path.exists("error.txt"):
+        os.remove("error.txt")
+    process_files({
+        "input_dir": str(input_dir),
+        "output_dir": str(output_dir),
+        "output_filename": "output.csv",
+        "filter_conditions": ["100 / (@[column1] - 3) > 1", "@[column2] > 29"],
+    })
+    assert not os.path.exists(output_dir / "output.csv")
+    with open("error.txt", 'r', encoding='utf-8') as f:
+        assert "division by zero" in f.read()
+    os.remove("error.txt")
+
+# FastCSVReader のテスト（csv.reader と同じ結果になること）
+@pytest.mark.parametrize("encoding,delimiter", [("utf-8", ","), ("cp932", ","), ("utf-8-sig", "\t")])
+def test_fast_csv_reader(tmp_path, encoding, delimiter):
+    import io
+    import random
+    rng = random.Random(0)
+    values = ["a", "", "あいう", "表", 'q"uote', "x\ny", "c\r\nd", "e\rf", " sp ", "1,2", "t\tab"]
+    lines = ["h1{0}h2{0}h3\r\n".format(delimiter)]
+    for i in range(300):
+        kind = i % 7
+        if kind == 0:
+            lines.append("\n")
+        elif kind == 1:
+            lines.append('5"x{0}10{0}z\n'.format(delimiter))
+        else:
+            fields = []
+            for j in range(3):
+                value = rng.choice(values)
+                if rng.random() < 0.5 or any(ch in value for ch in ('"', '\n', '\r', delimiter)):
+                    value = '"' + value.replace('"', '""') + '"'
+                fields.append(value)
+            lines.append(delimiter.join(fields) + rng.choice(["\n", "\r\n"]))
+    lines.append("last{0}row".format(delimiter))
+    file_path = tmp_path / "data.csv"
+    with open(file_path, 'w', encoding=encoding, newline='') as f:
+        f.write(''.join(lines))
+    with open(file_path, 'r', encoding=encoding, newline='') as f:
+        expected = list(csv.reader(f, delimiter=delimiter))
+
+    assert list(FastCSVReader(str(file_path), encoding, delimiter)) == expected
+
+    # 文字列に変換する列を限定した場合、その列の値は同じ
+    reader = FastCSVReader(str(file_path), encoding, delimiter)
+    assert next(reader) == expected[0]
+    reader.used_columns = [1]
+    for row, expected_row in zip(reader, expected[1:]):
+        assert len(row) == len(expected_row)
+        if len(row) > 1:
+            assert row[1] == expected_row[1]
+
+def test_process_files_fast_reader(tmp_path):
+    input_dir = tmp_path / "input"
+    input_dir.mkdir()
+    with open(input_dir / "data.csv", 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        writer.writerow(["column1", "column2", "column3", "unused"])
+        f.write('5"x,10,2,u\n')
+        for i in range(300):
+            writer.writerow([str(i), str(i % 20), ["a", "b\nc", 'd"e', "あ"][i % 4], "z" * (i % 5)])
+
+    def run(fast_reader, workers):
+        output_dir = tmp_path / f"output{fast_reader}{workers}"
+        process_files({
+            "input_dir": str(input_dir),
+            "output_dir": str(output_dir),
+            "output_filename": "output.csv",
+            "output_columns": ["column3", "new_column", "column1"],
+            "add_columns": {"new_column": "$[column3] + $#", "double": "@[column2] * 2"},
+            "filter_conditions": ["@[column2] > 5"],
+            "fast_reader": fast_reader,
+            "workers": workers,
+            "chunk_size": 256,
+        })
+        with open(output_dir / "output.csv", 'r', encoding='utf-8', newline='') as f:
+            return f.read()
+
+    expected = run(False, 1)
+    assert run(True, 1) == expected
+    assert run(True, 3) == expected
+
+@pytest.mark.parametrize("profile,workers", [(True, 1), (True, 3), ("cprofile", 1)])
+def test_process_files_profile(tmp_path, profile, workers):
+    input_dir = tmp_path / "input"
+    input_dir.mkdir()
+    with open(input_dir / "data.csv", 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        writer.writerow(["column1", "column2"])
+        for i in range(200):
+            writer.writerow([str(i), str(i % 10)])
+        f.write("invalid\n")
+    report_path = tmp_path / "profile.json"
+    process_files({
+        "input_dir": str(input_dir),
+        "output_dir": str(tmp_path / "output"),
+        "output_filename": "output.csv",
+        "add_columns": {"ratio": "@[column1] // @[column2]", "seq": "$#"},
+        "filter_conditions": ["@[column2] > 4"],
+        "workers": workers,
+        "chunk_size": 256,
+        "profile": profile,
+        "profile_report": str(report_path),
+    })
+    with open(report_path, 'r', encoding='utf-8') as f:
+        report = json.load(f)
+    assert report["rows_read"] == 201
+    assert report["rows_invalid"] == 1
+    assert report["rows_filtered"] == 100
+    assert report["rows_written"] == 100
+    assert report["evaluation_errors"] == 0
+    assert report["bytes_in"] == os.path.getsize(input_dir / "data.csv")
+    assert report["bytes_out"] == os.path.getsize(tmp_path / "output" / "output.csv")
+    assert set(report["stages"]) >= {"parse", "bind", "filter", "add_columns", "write"}
+    calls = {(e["kind"], e["expression"]): e["calls"] for e in report["expressions"]}
+    assert calls[("filter", "@[column2] > 4")] == 200
+    assert calls[("add_column", "@[column1] // @[column2]")] == 100
+    assert calls[("add_column", "$#")] == 100
+    if profile == "cprofile":
+        assert os.path.exists(report["cprofile"])
+    if os.path.exists("error.txt"):
+        os.remove("error.txt")
+
+def test_run_metrics():
+    metrics = RunMetrics()
+    double = metrics.timed_function("double", lambda x: x * 2)
+    evaluate = metrics.timed_expression("add_column", "double(@[a])", lambda row, seq: double(row[0]))
+    assert [evaluate([i], 1) for i in range(3)] == [0, 2, 4]
+    data = metrics.take()
+    assert metrics.functions["double"][0] == 0
+    assert evaluate([5], 1) == 10
+    metrics.merge(data)
+    report = metrics.report(1.0)
+    assert report["functions"][0]["name"] == "double"
+    assert report["functions"][0]["calls"] == 4
+    assert report["expressions"][0]["calls"] == 4
+
+@pytest.mark.parametrize("workers", [1, 3])
+def test_process_files_output_async(tmp_path, workers):
+    input_dir = tmp_path / "input"
+    input_dir.mkdir()
+    for n in range(3):
+        with open(input_dir / f"data{n}.csv", 'w', newline='', encoding='utf-8') as f:
+            writer = csv.writer(f)
+            writer.writerow(["column1", "column2"])
+            for i in range(250):
+                writer.writerow([str(i), str(i % 7)])
+
+    def run(output_async):
+        output_dir = tmp_path / f"output{output_async}"
+        process_files({
+            "input_dir": str(input_dir),
+            "output_dir": str(output_dir),
+            "output_filename": "output.csv",
+            "max_rows_per_file": 100,
+            "add_columns": {"seq": "$#"},
+            "filter_conditions": ["@[column2] > 1"],
+            "workers": workers,
+            "chunk_size": 512,
+            "output_async": output_async,
+            "output_batch_rows": 64,
+            "output_fsync": output_async,
+        })
+        result = {}
+        for name in sorted(os.listdir(output_dir)):
+            with open(output_dir / name, 'r', encoding='utf-8', newline='') as f:
+                result[name] = f.read()
+        return result
+
+    expected = run(False)
+    assert len(expected) == 6
+    assert run(True) == expected
+
+def test_async_row_writer_error():
+    from utils.async_writer import AsyncRowWriter
+
+    class FailingWriter:
+        def __init__(self):
+            self.rows = []
+
+        def writerows(self, rows):
+            if any(row == ["bad"] for row in rows):
+                raise ValueError("write failed")
+            self.rows.extend(rows)
+
+        def close(self):
+            pass
+
+    target = FailingWriter()
+    writer = AsyncRowWriter(target, batch_size=2)
+    writer.writerow(["a"])
+    writer.writerow(["bad"])
+    with pytest.raises(ValueError):
+        writer.flush()
+    writer.writerow(["b"])
+    writer.close()
+    assert target.rows == [["b"]]
+
+# arrow・parquet の列の型は、最初のバッチだけでなくすべての行の値から決める
+@pytest.mark.parametrize("output_format", ["arrow", "parquet"])
+def test_arrow_sink_column_types(tmp_path, output_format):
+    pyarrow = pytest.importorskip("pyarrow")
+    import pyarrow.ipc
+    import pyarrow.parquet
+    from utils.sinks import open_sink
+
+    def write(rows):
+        path = str(tmp_path / f"output.{output_format}")
+        sink = open_sink(output_format, path, ["value"], None, None, None, batch_rows=2)
+        sink.writerows(rows[:2])
+        for row in rows[2:]:
+            sink.writerow(row)
+        sink.close()
+        if output_format == "arrow":
+            with pyarrow.ipc.open_file(path) as reader:
+                table = reader.read_all()
+        else:
+            table = pyarrow.parquet.read_table(path)
+        return str(table.schema.field("value").type), table.column("value").to_pylist()
+
+    # 後のバッチに小数がある整数の列は double（小数を切り捨てない）
+    assert write([[1], [2], [2.5], [3.7], ['']]) == ("double", [1.0, 2.0, 2.5, 3.7, None])
+    # 後のバッチに文字列がある列は文字列
+    assert write([[1], [2], [3.5], ['N/A'], [True]]) == ("string", ["1", "2", "3.5", "N/A", "True"])
+    assert write([[1], [''], [3]]) == ("int64", [1, None, 3])
+    assert write([]) == ("string", [])
+    assert os.listdir(tmp_path) == [f"output.{output_format}"]
+
+@pytest.mark.parametrize("output_format", ["jsonl", "arrow", "parquet"])
+def test_process_files_output_format(tmp_path, output_format):
+    if output_format != "jsonl":
+        pytest.importorskip("pyarrow")
+    input_dir = tmp_path / "input"
+    input_dir.mkdir()
+    with open(input_dir / "data.csv", 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        writer.writerow(["column1", "column2"])
+        for i in range(25):
+            writer.writerow([str(i), "あ" * (i % 3)])
+    output_dir = tmp_path / "output"
+    process_files({
+        "input_dir": str(input_dir),
+        "output_dir": str(output_dir),
+        "output_filename": "output.csv",
+        "max_rows_per_file": 10,
+        "add_columns": {"double": "@[column1] * 2", "half": "@[column1] / 2", "even": "@[column1] % 2 == 0"},
+        "output_format": output_format,
+        "output_batch_rows": 4,
+    })
+    extension = {"jsonl": ".jsonl", "arrow": ".arrow", "parquet": ".parquet"}[output_format]
+    names = sorted(os.listdir(output_dir))
+    assert names == [f"output_{n:04d}{extension}" for n in (1, 2, 3)]
+
+    records = []
+    for name in names:
+        path = str(output_dir / name)
+        if output_format == "jsonl":
+            with open(path, 'r', encoding='utf-8') as f:
+                records.extend(json.loads(line) for line in f)
+            continue
+        import pyarrow
+        if output_format == "arrow":
+            import pyarrow.ipc
+            with pyarrow.ipc.open_file(path) as reader:
+                table = reader.read_all()
+                assert reader.num_record_batches == (3 if name != names[-1] else 2)
+        else:
+            import pyarrow.parquet
+            table = pyarrow.parquet.read_table(path)
+            assert pyarrow.parquet.ParquetFile(path).num_row_groups == (3 if name != names[-1] else 2)
+        assert str(table.schema.field("double").type) == "int64"
+        assert str(table.schema.field("half").type) == "double"
+        assert str(table.schema.field("even").type) == "bool"
+        records.extend(table.to_pylist())
+    assert len(records) == 25
+    assert records[3] == {"column1": "3", "column2": "", "double": 6, "half": 1.5, "even": False}
+    assert records[5]["column2"] == "ああ"
+
+def test_process_files_output_format_invalid(tmp_path):
+    input_dir = tmp_path / "input"
+    input_dir.mkdir()
+    (input_dir / "data.csv").write_text("column1\n1\n", encoding='utf-8')
+    if os.path.exists("error.txt"):
+        os.remove("error.txt")
+    process_files({
+        "input_dir": str(input_dir),
+        "output_dir": str(tmp_path / "output"),
+        "output_filename": "output.csv",
+        "output_format": "xml",
+    })
+    with open("error.txt", 'r', encoding='utf-8') as f:
+        assert "使用できない出力形式です: xml" in f.read()
+    assert not os.path.exists(tmp_path / "output")
+    os.remove("error.txt")
+
+def test_process_files_plan_cache(tmp_path, monkeypatch):
+    import utils.expression_evaluator as expression_evaluator
+    input_dir = tmp_path / "input"
+    input_dir.mkdir()
+    config = {
+        "input_dir": str(input_dir),
+        "output_filename": "output.csv",
+        "add_columns": {"total": "@[column2] * 2 + len_check", "label": "$[column1] + $#"},
+        "filter_conditions": ["@[column2] > 10"],
+        "plan_cache_dir": str(tmp_path / "cache"),
+    }
+    (input_dir / "data.csv").write_text("column1,column2,len_check\na,1,0\nb,12,1\nc,30,2\n", encoding='utf-8')
+
+    def run(name):
+        monkeypatch.setattr(expression_evaluator, "_compiled_cache", {})
+        process_files(dict(config, output_dir=str(tmp_path / name)))
+        with open(tmp_path / name / "output.csv", 'r', encoding='utf-8') as f:
+            return f.read()
+
+    def plan_files():
+        return [name for name in os.listdir(tmp_path / "cache") if name.startswith("plan-")]
+
+    expected = run("cold")
+    assert len(plan_files()) == 1
+    # 2回目はキャッシュから復元し、式を解析・コンパイルしない
+    def fail(self, expression):
+        raise AssertionError(f"コンパイルされました: {expression}")
+    monkeypatch.setattr(expression_evaluator.CompiledExpression, "__init__", fail)
+    # 変わっていない入力ファイルのヘッダー行はキャッシュから読み込む
+    import csvsc
+    def fail_header(*args):
+        raise AssertionError("ヘッダー行を読み込みました")
+    monkeypatch.setattr(csvsc, "read_header", fail_header)
+    assert run("warm") == expected
+    monkeypatch.undo()
+
+    # 入出力のフォルダが異なっても式が同じならキャッシュを共有し、式が変わった場合は別のキャッシュを作る
+    config["filter_conditions"] = ["@[column2] > 20"]
+    run("changed")
+    assert len(plan_files()) == 2
+
+    # 入力ファイルが変わった場合はヘッダー行を読み直す
+    (input_dir / "data.csv").write_text("column1,column2,len_check,extra\nb,30,1,x\n", encoding='utf-8')
+    assert run("rewritten").splitlines()[0] == '"column1","column2","len_check","extra","total","label"'
+
+def test_startup_lazy_imports(tmp_path):
+    import subprocess
+    input_dir = tmp_path / "input"
+    input_dir.mkdir()
+    (input_dir / "data.csv").write_text("column1\n1\n", encoding='utf-8')
+    config = {"input_dir": str(input_dir), "output_dir": str(tmp_path / "output"), "output_filename": "output.csv"}
+    script = (
+        "import sys, json\n"
+        f"sys.path.insert(0, {os.path.join(os.path.dirname(__file__), '..')!r})\n"
+        "import csvsc\n"
+        f"csvsc.process_files({config!r})\n"
+        "print(json.dumps(sorted(m for m in sys.modules if m.startswith(('utils.', 'pyarrow', 'multiprocessing', 'concurrent')))))\n"
+    )
+    result = subprocess.run([sys.executable, "-c", script], capture_output=True, text=True, cwd=tmp_path, check=True)
+    modules = json.loads(result.stdout.strip().splitlines()[-1])
+    # 式がない場合は、式の評価エンジン・pyarrow・並列処理のモジュールを読み込まない
+    for name in ("utils.expression_evaluator", "utils.batch_evaluator", "utils.filter_planner", "pyarrow",
+                 "multiprocessing", "concurrent.futures"):
+        assert name not in modules
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_watch_files(tmp_path, workers):
+    import threading
+    import time
+    from csvsc import watch_files
+    input_dir = tmp_path / "input"
+    input_dir.mkdir()
+    output_dir = tmp_path / "output"
+    config = {
+        "input_dir": str(input_dir),
+        "output_dir": str(output_dir),
+        "output_filename": "output.csv",
+        "add_columns": {"total": "@[column2] * 2"},
+        "filter_conditions": ["@[column2] > 1"],
+        "watch_interval": 0.05,
+        "watch_settle": 0.1,
+        "workers": workers,
+    }
+
+    def wait_for(path):
+        deadline = time.monotonic() + 10
+        while not os.path.exists(path):
+            assert time.monotonic() < deadline, f"出力されませんでした: {path}"
+            time.sleep(0.05)
+        with open(path, 'r', encoding='utf-8') as f:
+            return f.read()
+
+    def start():
+        stop = threading.Event()
+        thread = threading.Thread(target=watch_files, args=(config, stop))
+        thread.start()
+        return stop, thread
+
+    (input_dir / "a.csv").write_text("column1,column2\nx,1\ny,2\n", encoding='utf-8')
+    stop, thread = start()
+    try:
+        assert wait_for(output_dir / "a.csv_output.csv") == '"column1","column2","total"\n"y","2","4"\n'
+        # 到着したファイルを処理する（入力ファイル以外の名前のファイルは無視する）
+        (input_dir / "b.csv.part").write_text("column1,column2\nz,5\n", encoding='utf-8')
+        os.replace(input_dir / "b.csv.part", input_dir / "b.csv")
+        assert wait_for(output_dir / "b.csv_output.csv") == '"column1","column2","total"\n"z","5","10"\n'
+    finally:
+        stop.set()
+        thread.join()
+    with open(output_dir / ".csvsc_watch_status.json", 'r', encoding='utf-8') as f:
+        status = json.load(f)
+    assert status["files_done"] == 2 and status["rows_written"] == 2 and status["queued"] == 0
+    assert not os.listdir(output_dir / ".csvsc_tmp")
+
+    # 再起動しても処理済みのファイルは処理しない
+    os.remove(output_dir / "a.csv_output.csv")
+    (input_dir / "c.csv").write_text("column1,column2\nw,3\n", encoding='utf-8')
+    # 拡張子だけが異なる入力ファイルの出力ファイルは別にする
+    (input_dir / "c.tsv").write_text("column1\tcolumn2\nv\t4\n", encoding='utf-8')
+    stop, thread = start()
+    try:
+        assert wait_for(output_dir / "c.csv_output.csv") == '"column1","column2","total"\n"w","3","6"\n'
+        assert wait_for(output_dir / "c.tsv_output.csv") == '"column1","column2","total"\n"v","4","8"\n'
+    finally:
+        stop.set()
+        thread.join()
+    assert not os.path.exists(output_dir / "a.csv_output.csv")
+
+def test_directory_watcher(tmp_path):
+    import time
+    from utils.watcher import DirectoryWatcher
+    watcher = DirectoryWatcher(str(tmp_path), lambda name: name.endswith('.csv'), poll_interval=0.01, settle=0.2,
+                               use_inotify=False)
+    (tmp_path / "a.csv").write_text("column1\n", encoding='utf-8')
+    (tmp_path / "a.txt").write_text("column1\n", encoding='utf-8')
+    # 書き込み中の可能性があるファイルは、大きさ・更新日時が settle 秒変わらないまで返さない
+    assert watcher.ready_files() == []
+    time.sleep(0.25)
+    assert watcher.ready_files() == [str(tmp_path / "a.csv")]
+    with open(tmp_path / "a.csv", 'a', encoding='utf-8') as f:
+        f.write("1\n")
+    assert watcher.ready_files() == []
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_process_files_column_types(tmp_path, workers):
+    input_dir = tmp_path / "input"
+    input_dir.mkdir()
+    (input_dir / "data1.csv").write_text(
+        "id,price,qty,day\n1,12.5,3,2024-03-01\n2,9.99,x,2024-03-02\n3,20.25,,2024-04-01\n", encoding='utf-8')
+    (input_dir / "data2.csv").write_text(
+        "id,price,qty,day\n4,30,5,2024-03-31\n5,abc,1,2024-03-05\n6,,2,2024-03-06\n7,11,4,\n8,15,,2024-03-08\n",
+        encoding='utf-8')
+    output_dir = tmp_path / "output"
+    if os.path.exists("error.txt"):
+        os.remove("error.txt")
+    process_files({
+        "input_dir": str(input_dir),
+        "output_dir": str(output_dir),
+        "output_filename": "output.csv",
+        "output_columns": ["id", "total", "month", "label"],
+        "column_types": {"price": "decimal", "qty": "int", "day": "date"},
+        "filter_conditions": ["@[price] > 10", "@[day].month == 3"],
+        # 数値の型の空文字は 0、$[列名] は元の文字列
+        "add_columns": {"total": "@[price] * @[qty]", "month": "@[day].month", "label": "$[price] + '円'"},
+        "workers": workers,
+        "chunk_size": 16,
+    })
+    with open(output_dir / "output.csv", 'r', encoding='utf-8') as f:
+        rows = list(csv.reader(f))
+    assert rows == [["id", "total", "month", "label"], ["1", "37.5", "3", "12.5円"], ["4", "150", "3", "30円"],
+                    ["8", "0", "3", "15円"]]
+    # 変換できない値がある行はスキップし、列ごとの件数を出力する
+    with open("error.txt", 'r', encoding='utf-8') as f:
+        errors = f.read()
+    assert "列[qty]の 1 件の値を int に変換できない" in errors
+    assert "列[price]の 1 件の値を decimal に変換できない" in errors
+    # date の空文字は変換できない値
+    assert "列[day]の 1 件の値を date に変換できない" in errors
+    os.remove("error.txt")
+
+def test_column_types_inference(tmp_path):
+    from utils.column_types import normalize_column_types, resolve_column_types, infer_type
+    assert infer_type(["1", "", "20"]) == "int"
+    assert infer_type(["1", "2.5"]) == "float"
+    assert infer_type(["2024-01-02", ""]) == "date"
+    assert infer_type(["1", "a"]) == "str"
+    header = ["A", "B", "C"]
+    rows = [["1", "1.5", "x"], ["2", "2", "y"]]
+    assert resolve_column_types(normalize_column_types("auto"), header, rows, ["a", "b", "d"]) == \
+        {"a": "int", "b": "float"}
+    assert resolve_column_types(normalize_column_types({"A": "auto", "C": "date:%Y/%m/%d"}), header, rows) == \
+        {"a": "int", "c": "date:%Y/%m/%d"}
+    with pytest.raises(ValueError):
+        normalize_column_types({"a": "integer"})
+
+    # "auto" の列は最初の入力ファイルの先頭の行から推定する（従来は小数が 0 になる）
+    input_dir = tmp_path / "input"
+    input_dir.mkdir()
+    (input_dir / "data.csv").write_text("id,price\n1,0.5\n2,1.5\n", encoding='utf-8')
+    process_files({
+        "input_dir": str(input_dir),
+        "output_dir": str(tmp_path / "output"),
+        "output_filename": "output.csv",
+        "column_types": "auto",
+        "filter_conditions": ["@[price] > 1"],
+    })
+    with open(tmp_path / "output" / "output.csv", 'r', encoding='utf-8') as f:
+        assert f.read() == '"id","price"\n"2","1.5"\n'
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_process_files_sort_distinct(tmp_path, workers):
+    input_dir = tmp_path / "input"
+    input_dir.mkdir()
+    rows = [(i, f"g{i % 7}", (i * 37) % 11) for i in range(300)]
+    for n in range(2):
+        with open(input_dir / f"data{n + 1}.csv", 'w', encoding='utf-8', newline='') as f:
+            f.write("id,grp,amount\n")
+            for i, grp, amount in rows[n * 150:(n + 1) * 150]:
+                f.write(f"{i},{grp},{amount}\n")
+    output_dir = tmp_path / "output"
+    process_files({
+        "input_dir": str(input_dir),
+        "output_dir": str(output_dir),
+        "output_filename": "output.csv",
+        "add_columns": {"key": "@[amount] % 3"},
+        "column_types": {"amount": "int"},
+        "sort_by": ["-amount", "grp"],
+        "distinct_on": ["grp", "key"],
+        # 一時ファイルに書き出して併合する
+        "sort_memory_mb": 0.001,
+        "sort_temp_dir": str(tmp_path / "sort"),
+        "max_rows_per_file": 5,
+        "workers": workers,
+        "chunk_size": 256,
+    })
+    expected = {}
+    for i, grp, amount in rows:
+        expected.setdefault((grp, amount % 3), [str(i), grp, str(amount), str(amount % 3)])
+    expected = sorted(expected.values(), key=lambda row: (-int(row[2]), row[1]))
+    output = []
+    parts = sorted(os.listdir(output_dir))
+    assert parts == [f"output_{n:04d}.csv" for n in range(1, (len(expected) + 4) // 5 + 1)]
+    for part in parts:
+        with open(output_dir / part, 'r', encoding='utf-8') as f:
+            part_rows = list(csv.reader(f))
+        assert part_rows[0] == ["id", "grp", "amount", "key"] and len(part_rows) <= 6
+        output.extend(part_rows[1:])
+    assert output == expected
+    # 一時ファイルは削除する
+    assert os.listdir(tmp_path / "sort") == []
+
+def test_external_sorter(tmp_path):
+    from utils.external_sort import ExternalSorter, DistinctWriter, sort_key, distinct_key
+
+    class ListWriter:
+        def __init__(self):
+            self.rows = []
+            self.closed = False
+
+        def writerow(self, row):
+            self.rows.append(list(row))
+
+        def close(self):
+            self.closed = True
+
+    # ランが merge_fanin を超える場合は中間のランを並列に併合する（キーが同じ値は追加した順）
+    sorter = ExternalSorter(1, str(tmp_path), merge_fanin=3, workers=2)
+    values = [(i * 7919) % 50 for i in range(40)]
+    for i, value in enumerate(values):
+        sorter.add(value, i, 1)
+    assert sorter.spills == 40
+    assert [(key, value) for key, _, value in sorter.records()] == sorted((v, i) for i, v in enumerate(values))
+    sorter.close()
+    assert os.listdir(tmp_path) == []
+
+    header = ["name", "amount", "day"]
+    key = sort_key(["-day", "amount", "name"], header, {"amount": "float", "day": "date"})
+    rows = [["a", "2.5", "2024-01-02"], ["b", "10", "2024-01-02"], ["c", "", "2024-01-03"], ["d", "x", ""]]
+    assert sorted(rows, key=key) == [rows[2], rows[0], rows[1], rows[3]]
+    with pytest.raises(ValueError):
+        sort_key(["missing"], header)
+
+    # キーの集合が memory_limit を超えた後は、外部ソートで重複を除いて元の順に書き出す
+    output = ListWriter()
+    writer = DistinctWriter(output, distinct_key(["name"], header), 300, str(tmp_path))
+    names = ["a", "b", "a", "c", "b", "d", "c", "e", "a", "f", "e"]
+    for i, name in enumerate(names):
+        writer.writerow([name, str(i), ""])
+    writer.close()
+    assert output.rows == [["a", "0", ""], ["b", "1", ""], ["c", "3", ""], ["d", "5", ""], ["e", "7", ""],
+                           ["f", "9", ""]]
+    assert writer.duplicates == 5 and output.closed
+
+@pytest.mark.parametrize("index,workers", [("memory", 1), ("sqlite", 1), ("auto", 2)])
+def test_process_files_lookups(tmp_path, index, workers):
+    input_dir = tmp_path / "input"
+    input_dir.mkdir()
+    (input_dir / "orders.csv").write_text(
+        "order_id,cust_id,item\n1,c1,a\n2,c2,b\n3,c9,a\n4,c1,c\n", encoding='utf-8')
+    ref = tmp_path / "customers.tsv"
+    ref.write_text("cust_id\tregion\tname\nc1\teast\tAlice\nc2\twest\tBob\nc1\tnorth\tDup\n", encoding='utf-8')
+    (tmp_path / "prices.csv").write_text("item,region,price\na,east,100\nb,west,200\nc,east,300\n", encoding='utf-8')
+    index_dir = tmp_path / "index"
+    output_dir = tmp_path / "output"
+    config = {
+        "input_dir": str(input_dir),
+        "output_dir": str(output_dir),
+        "output_filename": "output.csv",
+        "lookups": {
+            # join の列を省略した場合は key 以外の列を追加する（キーが重複する場合は最初の行）
+            "customers": {"path": str(ref), "key": "cust_id", "join": "left", "index": index},
+            "prices": {"path": str(tmp_path / "prices.csv"), "key": ["item", "region"], "index": index},
+        },
+        "lookup_index_dir": str(index_dir),
+        "add_columns": {"price": "lookup('prices', ($[item], $[region]), 'price', '-')",
+                        "known": "lookup('customers', $[cust_id])"},
+        "workers": workers,
+        "chunk_size": 16,
+    }
+    process_files(config)
+    with open(output_dir / "output.csv", 'r', encoding='utf-8') as f:
+        assert list(csv.reader(f)) == [
+            ["order_id", "cust_id", "item", "region", "name", "price", "known"],
+            ["1", "c1", "a", "east", "Alice", "100", "True"],
+            ["2", "c2", "b", "west", "Bob", "200", "True"],
+            ["3", "c9", "a", "", "", "-", "False"],
+            ["4", "c1", "c", "east", "Alice", "300", "True"],
+        ]
+    if index != "memory" or workers == 1:
+        assert len(os.listdir(index_dir)) == 2
+
+    # inner の表にキーの行がない行はスキップし、参照ファイルが変わった場合は索引を作り直す
+    ref.write_text("cust_id\tregion\tname\nc2\tsouth\tBob\nc9\teast\tCarol\n", encoding='utf-8')
+    config["lookups"]["customers"].update({"join": "inner", "columns": ["region"]})
+    config["filter_conditions"] = ["$[region] != 'south'"]
+    config["output_columns"] = ["order_id", "region", "price"]
+    process_files(config)
+    with open(output_dir / "output.csv", 'r', encoding='utf-8') as f:
+        assert list(csv.reader(f)) == [["order_id", "region", "price"], ["3", "east", "100"]]
+    assert len(os.listdir(index_dir)) == 2
+
+def test_lookups_invalid(tmp_path):
+    input_dir = tmp_path / "input"
+    input_dir.mkdir()
+    (input_dir / "data.csv").write_text("id\n1\n", encoding='utf-8')
+    if os.path.exists("error.txt"):
+        os.remove("error.txt")
+    process_files({
+        "input_dir": str(input_dir),
+        "output_dir": str(tmp_path / "output"),
+        "output_filename": "output.csv",
+        "lookups": {"missing": {"path": str(tmp_path / "missing.csv"), "key": "id"}},
+    })
+    with open("error.txt", 'r', encoding='utf-8') as f:
+        assert "lookups の表[missing]の参照ファイルを開けません" in f.read()
+    os.remove("error.txt")
+
+    # join で追加する列が入力の列と同じ名前の場合は、入力の値を置き換えずにエラー
+    (tmp_path / "ref.csv").write_text("id,ID,region\n1,x,east\n", encoding='utf-8')
+    process_files({
+        "input_dir": str(input_dir),
+        "output_dir": str(tmp_path / "output"),
+        "output_filename": "output.csv",
+        "lookups": {"ref": {"path": str(tmp_path / "ref.csv"), "key": "id", "join": "inner"}},
+    })
+    assert not os.path.exists(tmp_path / "output" / "output.csv")
+    with open("error.txt", 'r', encoding='utf-8') as f:
+        assert "lookups の表[ref]の join の列[ID]が入力ファイルの列と同じ名前です" in f.read()
+    os.remove("error.txt")
+
+@pytest.mark.parametrize("workers,memory_mb", [(1, 256), (1, 0.0005), (2, 256)])
+def test_process_files_aggregate(tmp_path, workers, memory_mb):
+    input_dir = tmp_path / "input"
+    input_dir.mkdir()
+    rows = [(i, f"g{i % 7}", (i * 37) % 11) for i in range(300)]
+    for n in range(2):
+        with open(input_dir / f"data{n + 1}.csv", 'w', encoding='utf-8', newline='') as f:
+            f.write("id,grp,amount\n")
+            for i, grp, amount in rows[n * 150:(n + 1) * 150]:
+                f.write(f"{i},{grp},{amount if i % 50 else 'x'}\n")
+    output_dir = tmp_path / "output"
+    if os.path.exists("error.txt"):
+        os.remove("error.txt")
+    process_files({
+        "input_dir": str(input_dir),
+        "output_dir": str(output_dir),
+        "output_filename": "output.csv",
+        "filter_conditions": ["@[id] % 3 != 0"],
+        "add_columns": {"double": "@[id] * 2"},
+        "aggregate": {
+            "group_by": ["grp"],
+            "columns": {"rows": "count", "total": "sum:amount", "high": "max:double", "low": "min:amount",
+                        "average": "mean:id", "kinds": "count_distinct:amount"},
+        },
+        "sort_by": ["-total", "grp"],
+        # 一時ファイルに書き出して併合する
+        "aggregate_memory_mb": memory_mb,
+        "sort_temp_dir": str(tmp_path / "temp"),
+        "workers": workers,
+        "chunk_size": 16,
+    })
+    groups = {}
+    for i, grp, amount in rows:
+        if i % 3 == 0:
+            continue
+        group = groups.setdefault(grp, {"ids": [], "amounts": []})
+        group["ids"].append(i)
+        if i % 50:
+            group["amounts"].append(amount)
+    # count_distinct は数値に変換できない値（"x"）も数える
+    expected = [[grp, str(len(g["ids"])), str(sum(g["amounts"])), str(max(g["ids"]) * 2), str(min(g["amounts"])),
+                 str(sum(g["ids"]) / len(g["ids"])),
+                 str(len(set(g["amounts"])) + (len(g["amounts"]) < len(g["ids"])))]
+                for grp, g in groups.items()]
+    expected.sort(key=lambda row: (-int(row[2]), row[0]))
+    with open(output_dir / "output.csv", 'r', encoding='utf-8') as f:
+        output = list(csv.reader(f))
+    assert output[0] == ["grp", "rows", "total", "high", "low", "average", "kinds"]
+    assert output[1:] == expected
+    # 数値に変換できない値は集計から除き、件数をエラーログに出力する
+    with open("error.txt", 'r', encoding='utf-8') as f:
+        assert "集計列[total]の 4 件の値を数値に変換できないため" in f.read()
+    os.remove("error.txt")
+    # 一時ファイルは削除する
+    assert not (tmp_path / "temp").exists() or os.listdir(tmp_path / "temp") == []
+
+def test_aggregator(tmp_path):
+    from utils.aggregate import Aggregator, AggregateWriter, parse_aggregate
+
+    class ListWriter:
+        def __init__(self):
+            self.rows = []
+
+        def writerow(self, row):
+            self.rows.append(list(row))
+
+        def close(self):
+            pass
+
+    header = ["name", "amount"]
+    # group_by を省略した場合は全体を集計する（行がない場合も1行）
+    definition = parse_aggregate({"columns": {"n": "count", "total": "sum:amount", "avg": "mean:amount"}}, header)
+    output = ListWriter()
+    AggregateWriter(output, Aggregator(definition)).close()
+    assert output.rows == [[0, 0, '']]
+    aggregator = Aggregator(definition)
+    for row in [["a", "1"], ["b", ""], ["c", "2.5"]]:
+        aggregator.add(row)
+    assert list(aggregator.results()) == [[3, 3.5, 1.75]]
+
+    # ワーカーの途中の値を併合する
+    definition = parse_aggregate({"group_by": "name", "columns": {"top": "max:amount"}}, header)
+    parent = Aggregator(definition, 1, str(tmp_path))
+    for rows in ([["a", "9"], ["b", "x"]], [["a", "10"], ["b", "2"]]):
+        worker = Aggregator(definition, float('inf'))
+        for row in rows:
+            worker.add(row)
+        parent.merge(worker.take())
+    assert sorted(parent.results()) == [["a", 10], ["b", "x"]]
+    assert parent.spills == 2
+    parent.close()
+    assert os.listdir(tmp_path) == []
+
+    for aggregate in [{"columns": {"x": "median:amount"}}, {"columns": {"x": "sum"}},
+                      {"group_by": ["missing"], "columns": {"n": "count"}}, ["count"]]:
+        with pytest.raises(ValueError):
+            parse_aggregate(aggregate, header)
+
+@pytest.mark.parametrize("workers,output_async", [(1, False), (2, True)])
+def test_process_files_partition_by(tmp_path, workers, output_async):
+    input_dir = tmp_path / "input"
+    input_dir.mkdir()
+    rows = [(i, f"t{i % 5}", f"2024-0{i % 3 + 1}-{i % 28 + 1:02d}") for i in range(200)]
+    # ファイル名に使えない文字と _ は %XX に置き換える（別の値が同じファイルにならない）
+    raw_tenants = {"t3": "a_b", "t4": "a/b"}
+    names = {"t3": "a%5Fb", "t4": "a%2Fb"}
+    for n in range(2):
+        with open(input_dir / f"data{n + 1}.csv", 'w', encoding='utf-8', newline='') as f:
+            f.write("id,tenant,day\n")
+            for i, tenant, day in rows[n * 100:(n + 1) * 100]:
+                f.write(f"{i},{raw_tenants.get(tenant, tenant)},{day}\n")
+    output_dir = tmp_path / "output"
+    process_files({
+        "input_dir": str(input_dir),
+        "output_dir": str(output_dir),
+        "output_filename": "output.csv.gz",
+        "filter_conditions": ["@[id] % 4 != 0"],
+        "output_partition_by": ["tenant", "$[day][:7]"],
+        "max_rows_per_file": 4,
+        # 開いたままにするファイル数・バッファの行数を小さくして、閉じたファイルに追記する
+        "output_max_open_files": 2,
+        "output_partition_buffer_rows": 3,
+        "output_async": output_async,
+        "output_batch_rows": 7,
+        "workers": workers,
+        "chunk_size": 64,
+    })
+    import gzip
+    expected = {}
+    for i, tenant, day in rows:
+        if i % 4:
+            expected.setdefault(f"{names.get(tenant, tenant)}_{day[:7]}", []).append(
+                [str(i), raw_tenants.get(tenant, tenant), day])
+    files = sorted(os.listdir(output_dir))
+    assert files == sorted(f"output_{name}_{n:04d}.csv.gz" for name, partition in expected.items()
+                           for n in range(1, (len(partition) + 3) // 4 + 1))
+    for name, partition in expected.items():
+        output = []
+        for n in range(1, (len(partition) + 3) // 4 + 1):
+            with gzip.open(output_dir / f"output_{name}_{n:04d}.csv.gz", 'rt', encoding='utf-8', newline='') as f:
+                part_rows = list(csv.reader(f))
+            assert part_rows[0] == ["id", "tenant", "day"] and len(part_rows) <= 5
+            output.extend(part_rows[1:])
+        assert output == partition
+
+    from utils.partitioned_writer import partition_name
+    values = [("a/b",), ("a_b",), ("a%2Fb",), ("a_b", "c"), ("a", "b_c"), ("", "a"), ("_a",)]
+    assert len({partition_name(v) for v in values}) == len(values)
+
+def test_process_files_partition_by_incremental(tmp_path):
+    input_dir = tmp_path / "input"
+    input_dir.mkdir()
+
+    def add_file(name, start, count):
+        with open(input_dir / name, 'w', newline='', encoding='utf-8') as f:
+            f.write("id,grp\n")
+            for i in range(start, start + count):
+                f.write(f"{i},{'xy'[i % 2]}{i // 10}\n")
+
+    def run(output_name, incremental):
+        output_dir = tmp_path / output_name
+        process_files({
+            "input_dir": str(input_dir),
+            "output_dir": str(output_dir),
+            "output_filename": "output.csv",
+            "max_rows_per_file": 3,
+            "output_partition_by": "grp",
+            "output_max_open_files": 1,
+            "incremental": incremental,
+        })
+        outputs = {}
+        for name in sorted(os.listdir(output_dir)):
+            if name.endswith(".csv"):
+                with open(output_dir / name, 'r', encoding='utf-8', newline='') as f:
+                    outputs[name] = f.read()
+        return outputs
+
+    add_file("a.csv", 0, 14)
+    run("incremental", True)
+    add_file("b.csv", 14, 9)
+    assert run("incremental", True) == run("full", False)
+
+    # 出力列にない列は指定できない
+    if os.path.exists("error.txt"):
+        os.remove("error.txt")
+    process_files({
+        "input_dir": str(input_dir),
+        "output_dir": str(tmp_path / "invalid"),
+        "output_filename": "output.csv",
+        "output_partition_by": ["missing"],
+    })
+    with open("error.txt", 'r', encoding='utf-8') as f:
+        assert "output_partition_by の列[missing]が出力列にありません" in f.read()
+    os.remove("error.txt")
+
+# 追加列の依存関係・共通部分式・出力に使わない追加列の省略のテスト
+def test_add_columns_graph(tmp_path):
+    from csvsc import RowPlan, SequenceState
+    (tmp_path / "funcs.py").write_text(
+        "__pure__ = ['code']\n"
+        "calls = []\n"
+        "def code(x):\n    calls.append(x)\n    return 'c' + x\n"
+        "def len2(x):\n    return len(x)\n"
+        "def count():\n    return len(calls)\n", encoding='utf-8')
+    add_columns = {
+        "label": "$[name] + ':' + code($[column1])",
+        "name": "code($[column1]).upper() + $[column2]",
+        "length": "@[size] + 1",
+        "size": "len2(code($[column1]))",
+        # 出力列にも他の追加列にも使わない追加列は計算しない
+        "unused": "1 / 0",
+    }
+    plan = RowPlan([], add_columns, ["column1", "label", "length", "column2"], fn_dir=str(tmp_path),
+                   fn_cache_size=0)
+    errors = []
+    rows = [row for line_num, row, values in plan.iter_rows([["a", "1"], ["bb", "2"]], ["column1", "column2"], 2,
+                                                              SequenceState(), lambda *args: errors.append(args))]
+    assert rows == [("a", "CA1:ca", 3, "1"), ("bb", "CBB2:cbb", 4, "2")]
+    assert errors == []
+    # code($[column1]) は1行に一度だけ呼び出す
+    assert plan.registry.functions["count"]() == 2
+
+    # 条件式・and/or で評価しない場合がある呼び出しは共通部分式にしない
+    (tmp_path / "guarded.py").write_text(
+        "__pure__ = ['inv']\n"
+        "def inv(x):\n    return 100 // x\n", encoding='utf-8')
+    add_columns = {"p": "inv(@[a]) if @[a] != 0 else -1", "q": "inv(@[a]) * 2 if @[a] != 0 else -2",
+                   "r": "@[a] != 0 and inv(@[a]) > 10"}
+    plan = RowPlan([], add_columns, ["p", "q", "r"], fn_dir=str(tmp_path), fn_cache_size=0)
+    errors = []
+    rows = [row for line_num, row, values in plan.iter_rows([["0"], ["5"]], ["a"], 2, SequenceState(),
+                                                              lambda *args: errors.append(args))]
+    assert rows == [(-1, -2, False), (20, 40, True)]
+    assert errors == []
+
+    # 循環する参照はエラー
+    plan = RowPlan([], {"x": "$[y]", "y": "$[x]"}, ["x"])
+    with pytest.raises(ValueError, match="循環"):
+        list(plan.iter_rows([["1"]], ["column1"], 2, SequenceState(), lambda *args: None))
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_process_files_add_columns_dependencies(tmp_path, workers):
+    input_dir = tmp_path / "input"
+    input_dir.mkdir()
+    with open(input_dir / "data.csv", 'w', encoding='utf-8', newline='') as f:
+        f.write("price,qty\n")
+        for i in range(100):
+            f.write(f"{i},{i % 4}\n")
+    output_dir = tmp_path / "output"
+    process_files({
+        "input_dir": str(input_dir),
+        "output_dir": str(output_dir),
+        "output_filename": "output.csv",
+        "output_columns": ["price", "total", "label"],
+        "filter_conditions": ["@[qty] > 0"],
+        # 行番号を参照する追加列と、それを参照する追加列は並列処理では親プロセスで計算する
+        "add_columns": {"label": "$[seq] + '/' + $[total]", "total": "@[sub] + @[tax]", "seq": "'#' + $#",
+                        "tax": "@[sub] // 10", "sub": "@[price] * @[qty]"},
+        "workers": workers,
+        "chunk_size": 64,
+    })
+    expected = [["price", "total", "label"]]
+    for i in [i for i in range(100) if i % 4]:
+        sub = i * (i % 4)
+        expected.append([str(i), str(sub + sub // 10), f"#{len(expected)}/{sub + sub // 10}"])
+    with open(output_dir / "output.csv", 'r', encoding='utf-8') as f:
+        assert list(csv.reader(f)) == expected
+
+@pytest.mark.parametrize("fast_reader", [False, True])
+def test_process_files_jobs(tmp_path, monkeypatch, fast_reader):
+    import csvsc
+    # 読み込んだ行をジョブで処理する単位を小さくして、単位の境界をまたぐ行番号を確認する
+    monkeypatch.setattr(csvsc, "_FANOUT_BATCH_ROWS", 7)
+    input_dir = tmp_path / "input"
+    input_dir.mkdir()
+    for n in range(2):
+        with open(input_dir / f"data{n + 1}.csv", 'w', encoding='utf-8', newline='') as f:
+            f.write("id,grp,amount\n")
+            for i in range(n * 50, (n + 1) * 50):
+                f.write(f"{i},g{i % 3},{i * 2}\n")
+    jobs = [
+        {"filter_conditions": ["@[id] % 2 == 0"], "add_columns": {"seq": "$#"},
+         "output_columns": ["seq", "id", "amount"], "max_rows_per_file": 20},
+        {"filter_conditions": ["@[amount] > 30"], "output_format": "jsonl", "output_columns": ["id", "grp"]},
+        {"aggregate": {"group_by": ["grp"], "columns": {"n": "count", "total": "sum:amount"}},
+         "output_columns": ["grp", "amount"]},
+    ]
+    common = {"input_dir": str(input_dir), "output_filename": "output.csv", "fast_reader": fast_reader}
+
+    def outputs(output_dir):
+        result = {}
+        for name in sorted(os.listdir(output_dir)):
+            with open(output_dir / name, 'r', encoding='utf-8') as f:
+                result[name] = f.read()
+        return result
+
+    expected = []
+    for k, job in enumerate(jobs):
+        process_files(dict(common, output_dir=str(tmp_path / f"separate{k}"), **job))
+        expected.append(outputs(tmp_path / f"separate{k}"))
+    assert len(expected[0]) == 3
+
+    # 設定のリストと、jobs を含む設定（jobs 以外の項目は共通の設定）
+    process_files([dict(common, output_dir=str(tmp_path / f"list{k}"), **job) for k, job in enumerate(jobs)])
+    process_files(dict(common, jobs=[dict(job, output_dir=str(tmp_path / f"jobs{k}")) for k, job in enumerate(jobs)]))
+    for k in range(len(jobs)):
+        assert outputs(tmp_path / f"list{k}") == expected[k]
+        assert outputs(tmp_path / f"jobs{k}") == expected[k]
+
+def test_process_files_jobs_input_mismatch(tmp_path):
+    if os.path.exists("error.txt"):
+        os.remove("error.txt")
+    process_files({"output_filename": "output.csv", "jobs": [
+        {"input_dir": str(tmp_path / "a"), "output_dir": str(tmp_path / "out_a")},
+        {"input_dir": str(tmp_path / "b"), "output_dir": str(tmp_path / "out_b")},
+    ]})
+    with open("error.txt", 'r', encoding='utf-8') as f:
+        assert "input_dir・input_encoding はすべてのジョブで同じ" in f.read()
+    os.remove("error.txt")
+    assert not os.path.exists(tmp_path / "out_a")
+
+def test_process_files_jobs_shared_expressions(tmp_path, monkeypatch):
+    import utils.expression_evaluator as expression_evaluator
+    from utils.expression_evaluator import get_function_registry
+    fn_dir = tmp_path / "fn"
+    fn_dir.mkdir()
+    (fn_dir / "funcs.py").write_text(
+        "__pure__ = ['triple']\n"
+        "calls = []\n"
+        "def triple(x):\n    calls.append(x)\n    return int(x) * 3\n"
+        "def tick(x):\n    calls.append('tick')\n    return int(x)\n", encoding='utf-8')
+    monkeypatch.setattr(expression_evaluator, "default_fn_dir", lambda: str(fn_dir))
+    input_dir = tmp_path / "input"
+    input_dir.mkdir()
+    with open(input_dir / "data.csv", 'w', encoding='utf-8', newline='') as f:
+        f.write("id\n")
+        for i in range(30):
+            f.write(f"{i}\n")
+    jobs = [
+        {"filter_conditions": ["triple($[id]) % 2 == 0"],
+         "add_columns": {"t": "triple($[id]) + 1", "a": "@[b] * 2", "b": "1", "k": "tick($[id])"},
+         "output_columns": ["id", "t", "a", "k"]},
+        # 参照する追加列が異なる同じ式と、pure でない関数の呼び出しは共有しない
+        {"filter_conditions": ["triple($[id]) % 2 == 0", "@[id] > 10"],
+         "add_columns": {"a": "@[b] * 2", "b": "2", "k": "tick($[id])"}, "output_columns": ["id", "a", "k"]},
+    ]
+    common = {"input_dir": str(input_dir), "output_filename": "output.csv", "fn_cache_size": 0}
+
+    def output(output_dir):
+        with open(output_dir / "output.csv", 'r', encoding='utf-8') as f:
+            return f.read()
+
+    expected = []
+    for k, job in enumerate(jobs):
+        process_files(dict(common, output_dir=str(tmp_path / f"separate{k}"), **job))
+        expected.append(output(tmp_path / f"separate{k}"))
+    calls = get_function_registry(str(fn_dir)).functions["triple"].__globals__["calls"]
+    assert '"12","37","2","12"' in expected[0] and '"12","4","12"' in expected[1]
+    calls.clear()
+    process_files([dict(common, output_dir=str(tmp_path / f"jobs{k}"), **job) for k, job in enumerate(jobs)])
+    for k in range(len(jobs)):
+        assert output(tmp_path / f"jobs{k}") == expected[k]
+    # フィルタ条件は1行に一度（30回）、追加列 t は出力する行（15回）だけ呼び出す
+    assert len([call for call in calls if call != 'tick']) == 45
+    assert calls.count('tick') == 15 + 9
@@ -0,0 +1,328 @@
+import os
+import sys
+import zlib
+import pickle
+import shutil
+import decimal
+import tempfile
+
+DEFAULT_MEMORY_MB = 256
+# メモリを超えた場合にグループを書き出す一時ファイル（パーティション）の数
+SPILL_PARTITIONS = 16
+FUNCTIONS = ('count', 'sum', 'min', 'max', 'mean', 'count_distinct')
+# 集計関数の種類
+_ROWS, _COUNT, _SUM, _MIN, _MAX, _MEAN, _DISTINCT = range(7)
+_KINDS = {'count': _COUNT, 'sum': _SUM, 'min': _MIN, 'max': _MAX, 'mean': _MEAN, 'count_distinct': _DISTINCT}
+# グループ・値の大きさの見積もりに加える値（バイト）
+_GROUP_OVERHEAD = 200
+_STATE_OVERHEAD = 64
+
+def parse_aggregate(aggregate, header, column_types=None):
+    """aggregate の設定値を検証し、集計の定義を返す（不正な場合は ValueError）
+
+    aggregate は group_by（列名のリスト）と columns（出力する列名 -> "関数" または "関数:列名"）の辞書。
+    列は header（集計する行の列）から探す。定義は (集計結果のヘッダー, グループの列の位置, 集計のリスト) で、
+    集計は (種類, 行の位置, 型) のタプル。
+    """
+    if not isinstance(aggregate, dict) or not aggregate.get('columns'):
+        raise ValueError("aggregate には group_by と columns（列名と集計関数の辞書）を指定してください。")
+    positions = {}
+    for i, name in enumerate(header):
+        positions.setdefault(name, i)
+    column_types = column_types or {}
+
+    def position(column):
+        if column not in positions:
+            raise ValueError(f"aggregate の列[{column}]が出力列にありません。")
+        return positions[column]
+
+    group_by = aggregate.get('group_by') or []
+    if isinstance(group_by, str):
+        group_by = [group_by]
+    group_positions = [position(column) for column in group_by]
+    aggregations = []
+    for name, definition in aggregate['columns'].items():
+        function, _, column = str(definition).partition(':')
+        function = function.strip().lower()
+        column = column.strip()
+        if function not in _KINDS:
+            raise ValueError(f"aggregate の列[{name}]の集計関数が不正です: {function}（{', '.join(FUNCTIONS)} から選択）")
+        if not column:
+            if function != 'count':
+                raise ValueError(f"aggregate の列[{name}]には集計する列を指定してください（例: \"{function}:列名\"）。")
+            aggregations.append((_ROWS, None, None))
+            continue
+        aggregations.append((_KINDS[function], position(column), column_types.get(column.lower())))
+    header = list(group_by) + list(aggregate['columns'])
+    return header, group_positions, aggregations
+
+def result_types(definition, column_types=None):
+    """集計結果の列の型（sort_by で数値として並べるため、集計値の列は float、min・max は元の列の型）"""
+    header, group_positions, aggregations = definition
+    column_types = column_types or {}
+    types = {}
+    for name in header[:len(group_positions)]:
+        if name.lower() in column_types:
+            types[name.lower()] = column_types[name.lower()]
+    for name, (kind, position, type_name) in zip(header[len(group_positions):], aggregations):
+        types[name.lower()] = type_name if kind in (_MIN, _MAX) and type_name else 'float'
+    return types
+
+def _number(value):
+    if isinstance(value, (int, float, decimal.Decimal)):
+        return value
+    value = str(value)
+    try:
+        return int(value)
+    except ValueError:
+        return float(value)
+
+def _partition(key):
+    return zlib.crc32(repr(key).encode('utf-8')) % SPILL_PARTITIONS
+
+class Aggregator:
+    """行をグループごとに集計する（ハッシュ集計）
+
+    グループの集計途中の値の大きさの見積もりが memory_limit バイトを超えた場合は、グループをキーのハッシュで
+    パーティションに分けて一時ファイルに書き出し、results() でパーティションごとに併合する。
+    空文字・None の値は集計しない（count は列を指定しない場合は行数、指定した場合は値がある行数）。
+    sum・mean は数値（column_types で型を指定した列はその型）に変換し、変換できない値は集計から除いて
+    errors に集計列ごとの件数を数える。min・max は数値を文字列より小さい値として比較する。
+    並列処理では、ワーカーの take() の値を親プロセスで merge() する。
+    パーティションごとのグループはメモリに収まることを前提とする。
+    """
+
+    def __init__(self, definition, memory_limit=DEFAULT_MEMORY_MB * 1024 * 1024, temp_dir=None):
+        self.definition = definition
+        self.header, self.group_positions, aggregations = definition
+        self.names = self.header[len(self.group_positions):]
+        self.memory_limit = memory_limit
+        self.temp_dir = temp_dir
+        from utils.column_types import converter
+        self._aggregations = []
+        for i, (kind, position, type_name) in enumerate(aggregations):
+            convert = converter(type_name) if type_name not in (None, 'str', 'auto') else None
+            self._aggregations.append((i, kind, position, convert))
+        self.groups = {}
+        self.errors = {}
+        self.spills = 0
+        self._size = 0
+        self._dir = None
+        if len(self.group_positions) == 1:
+            group_position = self.group_positions[0]
+            self._key = lambda row: (row[group_position],)
+        else:
+            self._key = lambda row: tuple([row[i] for i in self.group_positions])
+
+    def _initial(self):
+        states = []
+        for i, kind, position, convert in self._aggregations:
+            if kind in (_ROWS, _COUNT, _SUM):
+                states.append(0)
+            elif kind == _MEAN:
+                states.append([0, 0])
+            elif kind == _DISTINCT:
+                states.append(set())
+            else:
+                states.append(None)
+        return states
+
+    def _error(self, i):
+        name = self.names[i]
+        self.errors[name] = self.errors.get(name, 0) + 1
+
+    def add(self, row):
+        key = self._key(row)
+        states = self.groups.get(key)
+        if states is None:
+            states = self.groups[key] = self._initial()
+            self._size += sys.getsizeof(key) + _GROUP_OVERHEAD + _STATE_OVERHEAD * len(states)
+        for i, kind, position, convert in self._aggregations:
+            if kind == _ROWS:
+                states[i] += 1
+                continue
+            value = row[position]
+            if value is None or value == '':
+                continue
+            if kind == _COUNT:
+                states[i] += 1
+                continue
+            if kind == _DISTINCT:
+                distinct = states[i]
+                if value not in distinct:
+                    distinct.add(value)
+                    self._size += sys.getsizeof(value) + _STATE_OVERHEAD
+                continue
+            try:
+                if convert is not None and isinstance(value, str):
+                    value = convert(value)
+                if kind == _SUM:
+                    states[i] += _number(value)
+                elif kind == _MEAN:
+                    state = states[i]
+                    state[0] += _number(value)
+                    state[1] += 1
+                else:
+                    if convert is None:
+                        try:
+                            ranked = (0, _number(value))
+                        except ValueError:
+                            ranked = (1, str(value))
+                    else:
+                        ranked = (0, value)
+                    current = states[i]
+                    if current is None or (ranked < current if kind == _MIN else current < ranked):
+                        states[i] = ranked
+            except (ValueError, TypeError, ArithmeticError):
+                self._error(i)
+        if self._size >= self.memory_limit:
+            self._spill()
+
+    def _merge_states(self, states, other):
+        for i, kind, position, convert in self._aggregations:
+            value = other[i]
+            if kind in (_ROWS, _COUNT, _SUM):
+                states[i] += value
+            elif kind == _MEAN:
+                states[i][0] += value[0]
+                states[i][1] += value[1]
+            elif kind == _DISTINCT:
+                states[i] |= value
+            elif value is not None:
+                current = states[i]
+                if current is None or (value < current if kind == _MIN else current < value):
+                    states[i] = value
+
+    def take(self):
+        """集計途中の値を返し、空にする（ワーカーから親プロセスに渡す）"""
+        data = (self.groups, self.errors)
+        self.groups = {}
+        self.errors = {}
+        self._size = 0
+        return data
+
+    def merge(self, data):
+        """take() の値を併合する"""
+        groups, errors = data
+        for key, other in groups.items():
+            states = self.groups.get(key)
+            if states is None:
+                self.groups[key] = other
+                self._size += sys.getsizeof(key) + _GROUP_OVERHEAD + _STATE_OVERHEAD * len(other)
+                for i, kind, position, convert in self._aggregations:
+                    if kind == _DISTINCT:
+                        self._size += sum(sys.getsizeof(value) + _STATE_OVERHEAD for value in other[i])
+            else:
+                self._merge_states(states, other)
+        for name, count in errors.items():
+            self.errors[name] = self.errors.get(name, 0) + count
+        if self._size >= self.memory_limit:
+            self._spill()
+
+    def _spill_path(self, partition):
+        if self._dir is None:
+            if self.temp_dir:
+                os.makedirs(self.temp_dir, exist_ok=True)
+            self._dir = tempfile.mkdtemp(prefix="csvsc_aggregate_", dir=self.temp_dir or None)
+        return os.path.join(self._dir, f"part{partition:02d}")
+
+    def _spill(self):
+        """グループをパーティションごとの一時ファイルに追記し、メモリから除く"""
+        partitions = [[] for _ in range(SPILL_PARTITIONS)]
+        for key, states in self.groups.items():
+            partitions[_partition(key)].append((key, states))
+        for partition, groups in enumerate(partitions):
+            if groups:
+                with open(self._spill_path(partition), 'ab') as f:
+                    pickle.dump(groups, f, protocol=pickle.HIGHEST_PROTOCOL)
+        self.spills += 1
+        self.groups = {}
+        self._size = 0
+
+    def _finish(self, key, states):
+        row = list(key)
+        for i, kind, position, convert in self._aggregations:
+            value = states[i]
+            if kind == _MEAN:
+                value = value[0] / value[1] if value[1] else ''
+            elif kind == _DISTINCT:
+                value = len(value)
+            elif kind in (_MIN, _MAX):
+                value = '' if value is None else value[1]
+            row.append(value)
+        return row
+
+    def results(self):
+        """集計結果の行を返す（グループは最初に現れた順。一時ファイルに書き出した場合はパーティションごと）
+
+        group_by を指定せず、行が1行もない場合も1行を返す。
+        """
+        if self._dir is None:
+            if not self.groups and not self.group_positions:
+                self.groups[()] = self._initial()
+            for key, states in self.groups.items():
+                yield self._finish(key, states)
+            return
+        remaining = [[] for _ in range(SPILL_PARTITIONS)]
+        for key, states in self.groups.items():
+            remaining[_partition(key)].append((key, states))
+        self.groups = {}
+        for partition in range(SPILL_PARTITIONS):
+            merged = {}
+            path = self._spill_path(partition)
+            batches = []
+            if os.path.exists(path):
+                with open(path, 'rb') as f:
+                    while True:
+                        try:
+                            batches.append(pickle.load(f))
+                        except EOFError:
+                            break
+                os.remove(path)
+            batches.append(remaining[partition])
+            for groups in batches:
+                for key, states in groups:
+                    current = merged.get(key)
+                    if current is None:
+                        merged[key] = states
+                    else:
+                        self._merge_states(current, states)
+            for key, states in merged.items():
+                yield self._finish(key, states)
+
+    def close(self):
+        """一時ファイルを削除する"""
+        self.groups = {}
+        if self._dir is not None:
+            shutil.rmtree(self._dir, ignore_errors=True)
+            self._dir = None
+
+class AggregateWriter:
+    """行を aggregator で集計し、close() で集計結果を writer に書き出す（それ以外の属性は元の writer のもの）"""
+
+    def __init__(self, writer, aggregator):
+        self._writer = writer
+        self.aggregator = aggregator
+        self._closed = False
+
+    def writerow(self, row):
+        self.aggregator.add(row)
+
+    def writerows(self, rows):
+        for row in rows:
+            self.aggregator.add(row)
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        try:
+            writerow = self._writer.writerow
+            for row in self.aggregator.results():
+                writerow(row)
+        finally:
+            self.aggregator.close()
+            self._writer.close()
+
+    def __getattr__(self, name):
+        return getattr(self._writer, name)
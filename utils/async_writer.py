@@ -0,0 +1,84 @@
+import queue
+import threading
+
+class AsyncRowWriter:
+    """出力する行をまとめて、別スレッドで書き込む
+
+    writerow() は行をバッファに追加するだけで、batch_size 行ごとにバッファをキューに渡す。
+    キューには queue_size 個までのバッファを保持し（ダブルバッファ）、一杯の場合は書き込み側が待つ。
+    CSVへの変換・エンコード・ファイルへの書き込みと出力ファイルの切り替えは、
+    別スレッドで writer.writerows() により行う。
+    スレッドで発生したエラーは次の writerow()、flush()、commit()、close() で送出する。
+    それ以外の属性は元の writer のもの（参照する前に flush() すること）。
+    """
+
+    def __init__(self, writer, batch_size=10000, queue_size=2):
+        self._writer = writer
+        self.batch_size = max(int(batch_size), 1)
+        self._buffer = []
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._error = None
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name="OutputWriter", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            rows = self._queue.get()
+            try:
+                if rows is None:
+                    return
+                if self._error is None:
+                    self._writer.writerows(rows)
+            except Exception as e:
+                self._error = e
+            finally:
+                self._queue.task_done()
+
+    def _raise_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def writerow(self, row):
+        buffer = self._buffer
+        buffer.append(row)
+        if len(buffer) >= self.batch_size:
+            self._submit()
+
+    def _submit(self):
+        self._raise_error()
+        rows, self._buffer = self._buffer, []
+        self._queue.put(rows)
+
+    def flush(self):
+        """バッファの行をすべて書き込むまで待つ"""
+        if self._buffer:
+            self._submit()
+        self._queue.join()
+        self._raise_error()
+
+    def commit(self):
+        self.flush()
+        return self._writer.commit()
+
+    def rollback(self, output):
+        """書き込み中の行を待ち、まだ渡していない行とスレッドのエラーを破棄して writer.rollback() を呼び出す"""
+        self._buffer = []
+        self._queue.join()
+        self._error = None
+        self._writer.rollback(output)
+
+    def close(self):
+        if self._closed:
+            return
+        try:
+            self.flush()
+        finally:
+            self._closed = True
+            self._queue.put(None)
+            self._thread.join()
+            self._writer.close()
+
+    def __getattr__(self, name):
+        return getattr(self._writer, name)
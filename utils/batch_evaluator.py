@@ -0,0 +1,346 @@
+import ast
+import operator
+import itertools
+from array import array
+from utils.expression_evaluator import to_int
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+_BIN_OPS = {
+    ast.Add: 'add',
+    ast.Sub: 'sub',
+    ast.Mult: 'mul',
+    ast.Div: 'truediv',
+    ast.FloorDiv: 'floordiv',
+    ast.Mod: 'mod',
+}
+_CMP_OPS = {
+    ast.Eq: 'eq',
+    ast.NotEq: 'ne',
+    ast.Lt: 'lt',
+    ast.LtE: 'le',
+    ast.Gt: 'gt',
+    ast.GtE: 'ge',
+}
+
+# int64 で桁あふれしないことを保証する絶対値の上限
+_INT_LIMIT = 2 ** 62
+# float64 で正確に表せる整数の上限
+_EXACT_FLOAT_LIMIT = 2 ** 53
+
+class BatchFallback(Exception):
+    """このブロックは一括評価せず、行ごとの評価に戻す"""
+
+def analyze_expression(compiled, predicate):
+    """コンパイル済みの式が一括評価できる単純な数値式であれば構文木を返す
+
+    一括評価できるのは @[列名]、数値定数、四則演算(+ - * / // %)、比較演算、
+    フィルタ条件の場合の and/or/not の組み合わせのみ。関数呼び出し、$[列名]、
+    行番号(@#)などを含む場合は None を返す（行ごとの評価を使う）。
+    """
+    if compiled.error is not None or compiled.uses_sequence or compiled.names:
+        return None
+    try:
+        tree = ast.parse(compiled.source, mode='eval')
+        node = _convert(tree.body, predicate)
+    except (SyntaxError, _Unsupported):
+        return None
+    if not _has_column(node):
+        return None
+    if not predicate and node[0] in ('and', 'or', 'not'):
+        return None
+    return node
+
+class _Unsupported(Exception):
+    pass
+
+def _convert(node, predicate):
+    """Pythonの構文木を一括評価用の木 (種類, ...) に変換する"""
+    if isinstance(node, ast.Constant):
+        if isinstance(node.value, bool) or not isinstance(node.value, (int, float)):
+            raise _Unsupported()
+        return ('const', node.value)
+    if isinstance(node, ast.Call):
+        # __n(__c[k]) は @[列名] の参照
+        if (isinstance(node.func, ast.Name) and node.func.id == '__n' and len(node.args) == 1
+                and not node.keywords and isinstance(node.args[0], ast.Subscript)
+                and isinstance(node.args[0].value, ast.Name) and node.args[0].value.id == '__c'
+                and isinstance(node.args[0].slice, ast.Constant)):
+            return ('col', node.args[0].slice.value)
+        raise _Unsupported()
+    if isinstance(node, ast.BinOp) and type(node.op) in _BIN_OPS:
+        return ('bin', _BIN_OPS[type(node.op)], _numeric(node.left, predicate), _numeric(node.right, predicate))
+    if isinstance(node, ast.UnaryOp):
+        if isinstance(node.op, ast.USub):
+            return ('neg', _numeric(node.operand, predicate))
+        if isinstance(node.op, ast.UAdd):
+            return _numeric(node.operand, predicate)
+        if isinstance(node.op, ast.Not) and predicate:
+            return ('not', _convert(node.operand, predicate))
+        raise _Unsupported()
+    if isinstance(node, ast.Compare):
+        if not all(type(op) in _CMP_OPS for op in node.ops):
+            raise _Unsupported()
+        operands = [_numeric(n, predicate) for n in [node.left] + node.comparators]
+        return ('cmp', [_CMP_OPS[type(op)] for op in node.ops], operands)
+    if isinstance(node, ast.BoolOp) and predicate:
+        kind = 'and' if isinstance(node.op, ast.And) else 'or'
+        return (kind, [_convert(n, predicate) for n in node.values])
+    raise _Unsupported()
+
+def _numeric(node, predicate):
+    """数値を返す部分式のみ許可する（比較結果の算術演算などは行ごとに評価する）"""
+    converted = _convert(node, predicate)
+    if converted[0] in ('cmp', 'and', 'or', 'not'):
+        raise _Unsupported()
+    return converted
+
+def _has_column(node):
+    kind = node[0]
+    if kind == 'col':
+        return True
+    if kind == 'const':
+        return False
+    if kind == 'bin':
+        return _has_column(node[2]) or _has_column(node[3])
+    if kind in ('neg', 'not'):
+        return _has_column(node[1])
+    if kind == 'cmp':
+        return any(_has_column(n) for n in node[2])
+    return any(_has_column(n) for n in node[1])
+
+class _NumpyBackend:
+    """NumPyの配列で一括評価する
+
+    値は (種類, データ, 絶対値の上限) で表す。種類は 'i'(整数)、'f'(浮動小数点)、
+    'b'(真偽値)。整数の桁あふれやゼロ除算など、Pythonの整数演算と結果が
+    異なる可能性がある場合は BatchFallback を送出する。
+    """
+
+    name = 'numpy'
+
+    def column(self, values):
+        try:
+            data = numpy.fromiter(map(to_int, values), dtype=numpy.int64, count=len(values))
+        except OverflowError:
+            raise BatchFallback()
+        bound = max(int(data.max()), -int(data.min())) if len(data) else 0
+        if bound > _INT_LIMIT:
+            raise BatchFallback()
+        return ('i', data, bound)
+
+    def const(self, value):
+        if isinstance(value, int):
+            if abs(value) > _INT_LIMIT:
+                raise BatchFallback()
+            return ('i', value, abs(value))
+        return ('f', value, None)
+
+    def binop(self, op, left, right):
+        lkind, ldata, lbound = left
+        rkind, rdata, rbound = right
+        ints = lkind == 'i' and rkind == 'i'
+        if op in ('truediv', 'floordiv', 'mod'):
+            if numpy.any(numpy.asarray(rdata) == 0):
+                raise BatchFallback()
+        if op == 'add' or op == 'sub':
+            bound = lbound + rbound if ints else None
+            data = ldata + rdata if op == 'add' else ldata - rdata
+        elif op == 'mul':
+            bound = lbound * rbound if ints else None
+            data = ldata * rdata
+        elif op == 'truediv':
+            # 整数同士の真の除算は、float64で正確に表せる範囲でのみ一致する
+            if ints and max(lbound, rbound) > _EXACT_FLOAT_LIMIT:
+                raise BatchFallback()
+            return ('f', numpy.true_divide(ldata, rdata), None)
+        elif op == 'floordiv':
+            bound = lbound if ints else None
+            data = numpy.floor_divide(ldata, rdata)
+        else:
+            bound = rbound if ints else None
+            data = numpy.remainder(ldata, rdata)
+        if ints:
+            if bound > _INT_LIMIT:
+                raise BatchFallback()
+            return ('i', data, bound)
+        return ('f', data, None)
+
+    def neg(self, value):
+        kind, data, bound = value
+        return (kind, -data, bound)
+
+    def compare(self, op, left, right):
+        # 整数と浮動小数点の比較は、整数がfloat64で正確に表せる範囲でのみ一致する
+        for a, b in ((left, right), (right, left)):
+            if a[0] == 'i' and b[0] == 'f' and a[2] > _EXACT_FLOAT_LIMIT:
+                raise BatchFallback()
+        return ('b', getattr(operator, op)(left[1], right[1]), None)
+
+    def truth(self, value):
+        kind, data, bound = value
+        if kind == 'b':
+            return ('b', data, None)
+        return ('b', numpy.not_equal(data, 0), None)
+
+    def logical(self, op, values):
+        func = numpy.logical_and if op == 'and' else numpy.logical_or
+        result = values[0][1]
+        for value in values[1:]:
+            result = func(result, value[1])
+        return ('b', result, None)
+
+    def logical_not(self, value):
+        return ('b', numpy.logical_not(value[1]), None)
+
+    def tolist(self, value, size):
+        data = value[1]
+        if isinstance(data, numpy.ndarray):
+            return data.tolist()
+        return [data.item() if hasattr(data, 'item') else data] * size
+
+class _ArrayBackend:
+    """標準ライブラリの array と operator モジュールで一括評価する
+
+    演算は map() によりCのループで行う。Pythonの整数演算そのものを使うため、
+    結果は行ごとの評価と一致する（ゼロ除算などの例外は BatchFallback にする）。
+    """
+
+    name = 'array'
+
+    def column(self, values):
+        try:
+            return array('q', map(to_int, values))
+        except OverflowError:
+            raise BatchFallback()
+
+    def const(self, value):
+        return _Scalar(value)
+
+    def _map(self, func, *operands):
+        try:
+            if all(isinstance(o, _Scalar) for o in operands):
+                return _Scalar(func(*(o.value for o in operands)))
+            iterables = [itertools.repeat(o.value) if isinstance(o, _Scalar) else o for o in operands]
+            return list(map(func, *iterables))
+        except ArithmeticError:
+            raise BatchFallback()
+
+    def binop(self, op, left, right):
+        return self._map(getattr(operator, op), left, right)
+
+    def neg(self, value):
+        return self._map(operator.neg, value)
+
+    def compare(self, op, left, right):
+        return self._map(getattr(operator, op), left, right)
+
+    def truth(self, value):
+        return self._map(bool, value)
+
+    def logical(self, op, values):
+        func = operator.and_ if op == 'and' else operator.or_
+        result = values[0]
+        for value in values[1:]:
+            result = self._map(func, result, value)
+        return result
+
+    def logical_not(self, value):
+        return self._map(operator.not_, value)
+
+    def tolist(self, value, size):
+        if isinstance(value, _Scalar):
+            return [value.value] * size
+        return list(value)
+
+class _Scalar:
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+def get_backend():
+    """NumPyがインストールされていればNumPy、なければ標準ライブラリの一括評価を使う"""
+    if numpy is not None:
+        return _NumpyBackend()
+    return _ArrayBackend()
+
+def _evaluate(node, backend, columns):
+    kind = node[0]
+    if kind == 'col':
+        return columns[node[1]]
+    if kind == 'const':
+        return backend.const(node[1])
+    if kind == 'bin':
+        return backend.binop(node[1], _evaluate(node[2], backend, columns), _evaluate(node[3], backend, columns))
+    if kind == 'neg':
+        return backend.neg(_evaluate(node[1], backend, columns))
+    if kind == 'cmp':
+        operands = [_evaluate(n, backend, columns) for n in node[2]]
+        results = [backend.compare(op, operands[i], operands[i + 1]) for i, op in enumerate(node[1])]
+        if len(results) == 1:
+            return results[0]
+        return backend.logical('and', results)
+    if kind == 'not':
+        return backend.logical_not(backend.truth(_evaluate(node[1], backend, columns)))
+    return backend.logical(kind, [backend.truth(_evaluate(n, backend, columns)) for n in node[1]])
+
+class BatchEvaluator:
+    """ブロック単位で単純な数値式をまとめて評価する
+
+    参照される列はブロックごとに一度だけ replace_int と同じ規則（int()、
+    変換できない場合は0）で数値の配列に変換し、式をブロック全体に対して評価する。
+    """
+
+    def __init__(self, backend=None):
+        self.backend = backend or get_backend()
+        self.expressions = []
+
+    def add(self, compiled, predicate):
+        """式を登録する。一括評価できる場合は結果の番号、できない場合は None を返す"""
+        node = analyze_expression(compiled, predicate)
+        if node is None:
+            return None
+        self.expressions.append((compiled, node, predicate))
+        return len(self.expressions) - 1
+
+    def bind(self, header):
+        """ヘッダーの列位置に束縛し、ブロックを評価する関数を返す
+
+        返される関数は行(list)のリストを受け取り、式ごとの結果のリストを返す。
+        一括評価できなかった式の結果は None になる（行ごとに評価する）。
+        """
+        index = {}
+        for i, name in enumerate(header):
+            index[name.lower()] = i
+        bound = []
+        for compiled, node, predicate in self.expressions:
+            slots = [index.get(name) for name in compiled.columns]
+            bound.append((node, slots, predicate))
+        backend = self.backend
+
+        def evaluate_block(rows):
+            size = len(rows)
+            converted = {}
+            results = []
+            for node, slots, predicate in bound:
+                try:
+                    columns = []
+                    for slot in slots:
+                        if slot not in converted:
+                            if slot is None:
+                                converted[slot] = backend.column([None] * size)
+                            else:
+                                converted[slot] = backend.column([row[slot] for row in rows])
+                        columns.append(converted[slot])
+                    value = _evaluate(node, backend, columns)
+                    if predicate:
+                        value = backend.truth(value)
+                    results.append(backend.tolist(value, size))
+                except BatchFallback:
+                    results.append(None)
+            return results
+        return evaluate_block
@@ -0,0 +1,233 @@
+import ast
+
+# 列の値の変換（@[列名]、$[列名]、$#）と行番号・行の値の参照に使う内部の名前（utils.expression_evaluator）
+_INT_HELPER = '__n'
+_STR_HELPER = '__s'
+_SEQ_STR_HELPER = '__t'
+_SLOTS_NAME = '__c'
+_SEQ_NAME = '__seq'
+# 共通部分式の値を参照する列名（@[列名] として、変換せずに値を参照する）
+SHARED_PREFIX = '__csvsc_shared'
+
+# 書き換えた式（(書き換えた式, 元の式) -> CompiledExpression）
+_rewritten = {}
+
+class _Restore(ast.NodeTransformer):
+    """コンパイル用の構文木の列・行番号の参照を、@[列名]・$[列名]・@#・$# の名前に戻す"""
+
+    def __init__(self, columns):
+        self.columns = columns
+
+    def visit_Call(self, node):
+        func = node.func
+        if isinstance(func, ast.Name) and len(node.args) == 1 and not node.keywords:
+            arg = node.args[0]
+            if (func.id in (_INT_HELPER, _STR_HELPER) and isinstance(arg, ast.Subscript)
+                    and isinstance(arg.value, ast.Name) and arg.value.id == _SLOTS_NAME
+                    and isinstance(arg.slice, ast.Constant)):
+                mark = '@' if func.id == _INT_HELPER else '$'
+                return ast.Name(id=f"{mark}[{self.columns[arg.slice.value]}]", ctx=ast.Load())
+            if func.id == _SEQ_STR_HELPER and isinstance(arg, ast.Name) and arg.id == _SEQ_NAME:
+                return ast.Name(id='$#', ctx=ast.Load())
+        self.generic_visit(node)
+        return node
+
+    def visit_Name(self, node):
+        if node.id == _SEQ_NAME:
+            return ast.Name(id='@#', ctx=ast.Load())
+        return node
+
+def _syntax_tree(compiled):
+    """式の構文木（列・行番号の参照は @[列名] などの名前。構文エラーの式は None）"""
+    if compiled.error is not None:
+        return None
+    tree = ast.parse(compiled.source, mode='eval')
+    return _Restore(compiled.columns).visit(tree)
+
+def _uses_sequence(node):
+    return any(isinstance(n, ast.Name) and n.id in ('@#', '$#') for n in ast.walk(node))
+
+def _shareable(node, pure_names):
+    """共通部分式にできる呼び出し（pure の関数の呼び出しで、行番号を参照しないもの）"""
+    return (isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id in pure_names
+            and not _uses_sequence(node))
+
+def _always_evaluated(node):
+    """式を評価すると必ず評価される部分式（条件式・and/or・比較の連鎖の2番目以降・内包表記・lambda の中は除く）"""
+    pending = [node]
+    while pending:
+        node = pending.pop()
+        yield node
+        if isinstance(node, ast.IfExp):
+            pending.append(node.test)
+        elif isinstance(node, ast.BoolOp):
+            pending.append(node.values[0])
+        elif isinstance(node, ast.Compare):
+            pending.extend([node.left, node.comparators[0]])
+        elif isinstance(node, (ast.ListComp, ast.SetComp, ast.DictComp, ast.GeneratorExp)):
+            pending.append(node.generators[0].iter)
+        elif not isinstance(node, ast.Lambda):
+            pending.extend(ast.iter_child_nodes(node))
+
+class _Hoist(ast.NodeTransformer):
+    """共通部分式を @[共通部分式の名前] の参照に置き換える（内側の共通部分式から名前を付ける）"""
+
+    def __init__(self, shared, names):
+        self.shared = shared
+        self.names = names
+
+    def visit_Call(self, node):
+        key = ast.dump(node)
+        self.generic_visit(node)
+        if key not in self.shared:
+            return node
+        name = self.names.get(key)
+        if name is None:
+            name = self.names[key] = (f"{SHARED_PREFIX}{len(self.names)}", ast.unparse(node))
+        return ast.Name(id=f"@[{name[0]}]", ctx=ast.Load())
+
+def _compile_rewritten(source, expression):
+    """書き換えた式をコンパイルする（評価に失敗した場合のメッセージは元の式）"""
+    from utils.expression_evaluator import CompiledExpression
+    key = (source, expression)
+    compiled = _rewritten.get(key)
+    if compiled is None:
+        compiled = CompiledExpression(source)
+        compiled.expression = expression
+        _rewritten[key] = compiled
+    return compiled
+
+class AddColumnPlan:
+    """add_columns の評価の計画
+
+    steps は評価する順序の (種類, 名前, CompiledExpression, add_columns の番号) のリストで、種類は
+    'shared'（共通部分式）または 'column'（追加列）。add_columns の番号は共通部分式では None。
+    work_names は式を評価する行の後ろに追加する値の名前で、他の追加列から参照される追加列と共通部分式。
+    deferred は行番号を参照する（または参照する追加列に依存する）追加列の番号（defer_sequence の場合）。
+    """
+
+    def __init__(self, steps, work_names, deferred):
+        self.steps = steps
+        self.work_names = work_names
+        self.deferred = deferred
+
+def references(add_columns, header):
+    """(追加列ごとの参照する他の追加列の番号の集合, 他の追加列から参照できる追加列の名前（小文字） -> 番号)
+
+    入力の列（header）と同名の追加列への参照は、これまでどおり入力の値を参照する。
+    """
+    input_names = {name.lower() for name in header}
+    name_index = {}
+    for i, (col_name, c) in enumerate(add_columns):
+        if col_name.lower() not in input_names:
+            name_index[col_name.lower()] = i
+    deps = []
+    for i, (col_name, c) in enumerate(add_columns):
+        deps.append({name_index[name] for name in c.columns + c.names if name_index.get(name, i) != i})
+    return deps, name_index
+
+def plan_add_columns(add_columns, header, output_header, pure_names=(), targets=None, defer_sequence=False,
+                     hoist=True):
+    """add_columns の評価の計画を作成する（参照が循環している場合は ValueError）
+
+    add_columns は (列名, CompiledExpression) のリスト。他の追加列を参照する追加列は、参照先の後に評価する。
+    targets（add_columns の番号）を省略した場合は、出力列（output_header）にある追加列を対象とする。
+    対象の追加列と、その参照先の追加列だけを評価する。defer_sequence の場合、行番号を参照する追加列と
+    それに依存する追加列は評価せず deferred とする。hoist の場合、複数の箇所にある pure_names の関数の
+    呼び出しを共通部分式として1行に一度だけ評価する（行番号を参照する追加列と、条件式・and/or などで
+    評価しない場合がある箇所の呼び出しは対象外）。
+    """
+    deps, name_index = references(add_columns, header)
+    if targets is None:
+        output_names = set(output_header)
+        targets = [i for i, (col_name, c) in enumerate(add_columns) if col_name in output_names]
+    needed = set()
+    pending = list(targets)
+    while pending:
+        i = pending.pop()
+        if i not in needed:
+            needed.add(i)
+            pending.extend(deps[i])
+
+    deferred = set()
+    if defer_sequence:
+        # 行番号を参照する追加列に依存する追加列も、行番号が確定した後に計算する
+        changed = True
+        while changed:
+            changed = False
+            for i in needed:
+                if i not in deferred and (add_columns[i][1].uses_sequence or deps[i] & deferred):
+                    deferred.add(i)
+                    changed = True
+    columns = {i: add_columns[i][1] for i in needed if i not in deferred}
+
+    shared_names = {}
+    if hoist and pure_names:
+        trees = {}
+        counts = {}
+        always = {}
+        for i, c in columns.items():
+            if c.uses_sequence:
+                continue
+            tree = _syntax_tree(c)
+            if tree is None:
+                continue
+            trees[i] = tree
+            for node in ast.walk(tree):
+                if _shareable(node, pure_names):
+                    key = ast.dump(node)
+                    counts[key] = counts.get(key, 0) + 1
+            for node in _always_evaluated(tree):
+                if _shareable(node, pure_names):
+                    key = ast.dump(node)
+                    always[key] = always.get(key, 0) + 1
+        # 条件によって評価しない箇所がある呼び出しは、評価しない行で失敗しないように共通部分式にしない
+        shared = {key for key, count in counts.items() if count > 1 and always.get(key) == count}
+        if shared:
+            hoist_names = _Hoist(shared, shared_names)
+            for i, tree in sorted(trees.items()):
+                if any(ast.dump(node) in shared for node in ast.walk(tree)):
+                    source = ast.unparse(hoist_names.visit(tree))
+                    columns[i] = _compile_rewritten(source, columns[i].expression)
+
+    from utils.expression_evaluator import compile_expression
+    shared_steps = {name: compile_expression(source) for name, source in shared_names.values()}
+
+    def children(node):
+        kind, key = node
+        if kind == 'shared':
+            c = shared_steps[key]
+            column_deps = {name_index[name] for name in c.columns + c.names if name in name_index}
+        else:
+            c = columns[key]
+            column_deps = deps[key]
+        result = [('shared', name) for name in c.int_columns if name in shared_steps]
+        return [('column', i) for i in sorted(column_deps)] + result
+
+    # 参照先から順に並べる（深さ優先）
+    steps = []
+    derived = set()
+    state = {}
+
+    def visit(node, path):
+        if state.get(node) == 'done':
+            return
+        if state.get(node) == 'visiting':
+            cycle = [add_columns[key][0] for kind, key in path[path.index(node):] if kind == 'column']
+            raise ValueError(f"add_columns の列の参照が循環しています: {' -> '.join(cycle)}")
+        state[node] = 'visiting'
+        for child in children(node):
+            if child[0] == 'column':
+                derived.add(child[1])
+            visit(child, path + [child])
+        state[node] = 'done'
+        kind, key = node
+        if kind == 'shared':
+            steps.append(('shared', key, shared_steps[key], None))
+        else:
+            steps.append(('column', add_columns[key][0], columns[key], key))
+
+    for i in sorted(columns):
+        visit(('column', i), [('column', i)])
+    work_names = [add_columns[i][0] for i in sorted(derived)] + list(shared_steps)
+    return AddColumnPlan(steps, work_names, deferred)
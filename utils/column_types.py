@@ -0,0 +1,92 @@
+import datetime
+import decimal
+
+# column_types で指定できる型（date は "date:%Y/%m/%d" のように書式を指定できる）
+TYPE_NAMES = ('int', 'float', 'decimal', 'date', 'str', 'auto')
+DEFAULT_DATE_FORMAT = '%Y-%m-%d'
+# 推定する型の順序（すべての値を変換できる最初の型にする。decimal は推定しない）
+_INFER_ORDER = ('int', 'float', 'date')
+
+def normalize_column_types(column_types):
+    """column_types の設定値を {列名（小文字）: 型} に変換する（不正な型の場合は ValueError）
+
+    "auto" の場合は {} と True（式で @[列名] として参照するすべての列を推定する）を返す。
+    """
+    if not column_types:
+        return {}, False
+    if column_types == 'auto':
+        return {}, True
+    if not isinstance(column_types, dict):
+        raise ValueError(f"column_types は列名と型の辞書、または \"auto\" で指定してください: {column_types!r}")
+    types = {}
+    for column, type_name in column_types.items():
+        type_name = str(type_name).strip()
+        if type_name.split(':', 1)[0].lower() not in TYPE_NAMES:
+            raise ValueError(f"列[{column}]の型が不正です: {type_name}（{', '.join(TYPE_NAMES)} から選択）")
+        if not type_name.startswith('date:'):
+            type_name = type_name.lower()
+        types[column.lower()] = type_name
+    return types, False
+
+def converter(type_name):
+    """値（文字列）を型に変換する関数を返す（変換できない場合は ValueError・ArithmeticError を送出する）"""
+    if type_name == 'int':
+        return int
+    if type_name == 'float':
+        return float
+    if type_name == 'decimal':
+        return decimal.Decimal
+    if type_name == 'date' or type_name.startswith('date:'):
+        date_format = type_name[5:] or DEFAULT_DATE_FORMAT
+        strptime = datetime.datetime.strptime
+        return lambda value: strptime(value, date_format).date()
+    return str
+
+def blank_value(type_name):
+    """空文字の値（数値の型は 0、str は空文字。date は None で、変換できない値として扱う）"""
+    if type_name == 'int':
+        return 0
+    if type_name == 'float':
+        return 0.0
+    if type_name == 'decimal':
+        return decimal.Decimal(0)
+    if type_name == 'date' or type_name.startswith('date:'):
+        return None
+    return ''
+
+def infer_type(values):
+    """値（文字列）のリストから型を推定する（空文字は推定に使わない）"""
+    values = [value for value in values if value is not None and value != '']
+    if not values:
+        return 'str'
+    for type_name in _INFER_ORDER:
+        convert = converter(type_name)
+        try:
+            for value in values:
+                convert(value)
+        except (ValueError, ArithmeticError):
+            continue
+        return type_name
+    return 'str'
+
+def resolve_column_types(column_types, header, rows, columns=()):
+    """"auto" の列の型をサンプルの行から推定し、{列名（小文字）: 型} を返す
+
+    column_types は normalize_column_types() の結果。infer_all が True の場合は columns
+    （式で @[列名] として参照する列）のうち、型を指定していない列も推定する。
+    ヘッダーにない列は推定せずに除く。
+    """
+    types, infer_all = column_types
+    types = dict(types)
+    if infer_all:
+        for column in columns:
+            types.setdefault(column, 'auto')
+    positions = {name.lower(): i for i, name in enumerate(header)}
+    resolved = {}
+    for column, type_name in types.items():
+        if type_name != 'auto':
+            resolved[column] = type_name
+        elif column in positions:
+            position = positions[column]
+            resolved[column] = infer_type([row[position] for row in rows if len(row) == len(header)])
+    return resolved
@@ -0,0 +1,141 @@
+import io
+import gzip
+import bz2
+import lzma
+import queue
+import threading
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# 読み込み・書き込みのバッファサイズ
+BUFFER_SIZE = 1024 * 1024
+
+# 圧縮形式ごとの拡張子とデフォルトの圧縮レベル
+_CODECS = {
+    'gzip': ('.gz', 6),
+    'bz2': ('.bz2', 9),
+    'xz': ('.xz', 6),
+    'zstd': ('.zst', 3),
+}
+
+def available_codecs():
+    """使用できる圧縮形式の名前を返す（zstd は zstandard がインストールされている場合のみ）"""
+    return [name for name in _CODECS if name != 'zstd' or zstandard is not None]
+
+def compression_extension(codec):
+    """圧縮形式の拡張子（圧縮しない場合は空文字）"""
+    if not codec:
+        return ''
+    return _CODECS[codec][0]
+
+def split_compression(path):
+    """パスを (圧縮の拡張子を除いたパス, 圧縮形式) に分ける（圧縮されていない場合の圧縮形式は None）"""
+    lower = path.lower()
+    for codec in available_codecs():
+        extension = _CODECS[codec][0]
+        if lower.endswith(extension):
+            return path[:-len(extension)], codec
+    return path, None
+
+def normalize_codec(codec, codecs=None):
+    """output_compression の設定値を圧縮形式の名前に変換する
+
+    codecs（省略した場合は available_codecs()）に含まれない場合は ValueError。
+    """
+    if not codec or str(codec).lower() == 'none':
+        return None
+    codec = str(codec).lower()
+    codec = {'gz': 'gzip', 'bzip2': 'bz2', 'lzma': 'xz', 'zst': 'zstd'}.get(codec, codec)
+    if codec not in (available_codecs() if codecs is None else codecs):
+        raise ValueError(f"使用できない圧縮形式です: {codec}")
+    return codec
+
+def open_input(path):
+    """入力ファイルをバイナリで開く（圧縮されている場合は展開しながら読み込む）"""
+    codec = split_compression(path)[1]
+    if codec is None:
+        return open(path, 'rb', buffering=BUFFER_SIZE)
+    if codec == 'gzip':
+        stream = gzip.open(path, 'rb')
+    elif codec == 'bz2':
+        stream = bz2.open(path, 'rb')
+    elif codec == 'xz':
+        stream = lzma.open(path, 'rb')
+    else:
+        stream = zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'), closefd=True)
+    return io.BufferedReader(stream, buffer_size=BUFFER_SIZE)
+
+def _open_compressed(path, codec, level, mode):
+    if level is None:
+        level = _CODECS[codec][1]
+    if codec == 'gzip':
+        return gzip.open(path, mode, compresslevel=level)
+    if codec == 'bz2':
+        return bz2.open(path, mode, compresslevel=level)
+    if codec == 'xz':
+        return lzma.open(path, mode, preset=level)
+    return zstandard.ZstdCompressor(level=level).stream_writer(open(path, mode), closefd=True)
+
+class _ThreadedWriter(io.RawIOBase):
+    """書き込んだデータを別スレッドで圧縮してファイルに書き込む
+
+    キューが一杯の場合、書き込み側は空きができるまで待つ。
+    スレッドで発生したエラーは次の write() または close() で送出する。
+    """
+
+    def __init__(self, stream, queue_size=16):
+        self._stream = stream
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._error = None
+        self._thread = threading.Thread(target=self._run, name="CompressWriter", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            data = self._queue.get()
+            if data is None:
+                return
+            if self._error is None:
+                try:
+                    self._stream.write(data)
+                except Exception as e:
+                    self._error = e
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        if self._error is not None:
+            raise self._error
+        data = bytes(data)
+        self._queue.put(data)
+        return len(data)
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            self._queue.put(None)
+            self._thread.join()
+            self._stream.close()
+        finally:
+            super().close()
+        if self._error is not None:
+            raise self._error
+
+def open_output(path, encoding, codec=None, level=None, threaded=False, append=False):
+    """出力ファイルをテキストで開く
+
+    codec を指定した場合は圧縮して書き込む。threaded が True の場合、
+    圧縮は別スレッドで行い、CSVの処理と並行させる。
+    append が True の場合は既存のファイルに追記する（圧縮形式の場合は新しいストリームを連結する）。
+    """
+    if codec is None:
+        return open(path, 'a' if append else 'w', encoding=encoding, newline='', buffering=BUFFER_SIZE)
+    stream = _open_compressed(path, codec, level, 'ab' if append else 'wb')
+    if threaded:
+        stream = _ThreadedWriter(stream)
+    return io.TextIOWrapper(io.BufferedWriter(stream, buffer_size=BUFFER_SIZE), encoding=encoding, newline='')
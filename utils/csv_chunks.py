@@ -0,0 +1,88 @@
+import os
+import io
+import csv
+import codecs
+import mmap
+import itertools
+
+# チャンク末尾の検証用に追加するレコード（区切り文字・クォート・改行を含まない）
+CHUNK_SENTINEL = '\x1fcsvsc-chunk-end\x1f'
+
+def is_chunkable_encoding(encoding):
+    """バイト単位でレコード境界（改行・クォート）を判定できるエンコーディングか"""
+    try:
+        name = codecs.lookup(encoding).name
+    except LookupError:
+        return False
+    if name.startswith(('utf-16', 'utf-32', 'iso2022')):
+        return False
+    try:
+        return '"\n\r,\t'.encode(encoding) == b'"\n\r,\t'
+    except UnicodeError:
+        return False
+
+def _find_record_end(mm, pos, parity, quotechar=b'"'):
+    """pos以降で、クォートの外にある最初の改行の次の位置を返す
+
+    parity は先頭から pos までに現れたクォート文字の数の偶奇。
+    見つからない場合は (None, parity) を返す。
+    """
+    while True:
+        newline = mm.find(b'\n', pos)
+        if newline < 0:
+            return None, parity
+        parity = (parity + mm[pos:newline].count(quotechar)) & 1
+        if parity == 0:
+            return newline + 1, 0
+        pos = newline + 1
+
+def find_chunk_boundaries(file_path, chunk_size, quotechar=b'"'):
+    """ファイルをヘッダーとデータのチャンクに分割するバイト位置を求める
+
+    (ヘッダーの終了位置, [(開始位置, 終了位置), ...]) を返す。
+    境界はクォート文字の偶奇から推定したものであり、クォートされていない
+    フィールド内にクォート文字がある場合は誤る可能性があるため、
+    各チャンクの処理時に CHUNK_SENTINEL を使って検証する。
+    分割できない場合は None を返す。
+    """
+    file_size = os.path.getsize(file_path)
+    if file_size == 0:
+        return None
+    with open(file_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        header_end, parity = _find_record_end(mm, 0, 0, quotechar)
+        if header_end is None:
+            return None
+        chunks = []
+        start = header_end
+        while file_size - start > chunk_size:
+            target = start + chunk_size
+            parity = mm[start:target].count(quotechar) & 1
+            end, parity = _find_record_end(mm, target, parity, quotechar)
+            if end is None or end >= file_size:
+                break
+            chunks.append((start, end))
+            start = end
+        if start < file_size:
+            chunks.append((start, file_size))
+    return header_end, chunks
+
+def read_chunk_rows(file_path, encoding, delimiter, start, end, validate_end):
+    """ファイルの指定範囲をCSVとして読み込むreaderを返す
+
+    validate_end が True の場合は末尾に CHUNK_SENTINEL のレコードを追加する。
+    範囲の末尾がレコードの区切りになっていれば、最後に [CHUNK_SENTINEL] が
+    単独の行として読み込まれる。
+    """
+    with open(file_path, 'rb') as f:
+        f.seek(start)
+        data = f.read(end - start)
+    text = io.TextIOWrapper(io.BytesIO(data), encoding=encoding, newline='')
+    lines = itertools.chain(text, [CHUNK_SENTINEL + '\n']) if validate_end else text
+    return csv.reader(lines, delimiter=delimiter, quotechar='"')
+
+def read_chunk_header(file_path, encoding, delimiter, header_end):
+    """ヘッダー行をバイト範囲から読み込む（境界が正しくない場合は None）"""
+    rows = list(read_chunk_rows(file_path, encoding, delimiter, 0, header_end, True))
+    if len(rows) != 2 or rows[1] != [CHUNK_SENTINEL]:
+        return None
+    return rows[0]
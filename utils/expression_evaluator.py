@@ -1,8 +1,24 @@
 import re
 import os
 import sys
+import time
+import types
+import hashlib
 import importlib.util
-import inspect
+from operator import itemgetter
+
+from utils.function_cache import mark_pure_functions, is_pure, cached_function, cache_stats
+
+# 式の中で列参照・行番号を置き換えるための内部名
+_INT_HELPER = '__n'
+_STR_HELPER = '__s'
+_SEQ_STR_HELPER = '__t'
+_SLOTS_NAME = '__c'
+_SEQ_NAME = '__seq'
+_HELPER_NAMES = {_INT_HELPER, _STR_HELPER, _SEQ_STR_HELPER, _SLOTS_NAME, _SEQ_NAME}
+
+_INT_PATTERN = re.compile(r'@\[(\w+)\]')
+_STR_PATTERN = re.compile(r'\$\[(\w+)\]')
 
 def load_custom_functions(fn_dir):
     """fnディレクトリから関数をロードする"""
@@ -25,15 +41,448 @@ def load_custom_functions(fn_dir):
                 spec.loader.exec_module(module)
                 
                 # モジュール内の関数を取得
-                for name, obj in inspect.getmembers(module):
-                    if inspect.isfunction(obj) and not name.startswith('_'):
+                for name, obj in sorted(vars(module).items()):
+                    if isinstance(obj, types.FunctionType) and not name.startswith('_'):
                         custom_functions[name] = obj
                         
             except Exception as e:
-                print(f"関数のロード中にエラーが発生しました {module_path}: {e}")
+                print(f"関数のロード中にエラーが発生しました {module_path}: {e}", file=sys.stderr)
                 
     return custom_functions
 
+def default_fn_dir():
+    """実行ファイルのパスを基準にfnフォルダのパスを返す"""
+    base_path = os.path.dirname(os.path.abspath(sys.argv[0]))
+    return os.path.join(base_path, 'fn')
+
+def to_int(value):
+    """@[列名] の値を数値に変換する（変換できない場合は0）"""
+    if value is None:
+        return 0
+    try:
+        return int(value)
+    except ValueError:
+        return 0
+
+def to_str(value):
+    """$[列名] の値を文字列に変換する（列が存在しない場合は空文字）"""
+    if value is None:
+        return ''
+    return str(value)
+
+def build_namespace(custom_functions=None):
+    """コンパイル済みの式を評価するためのグローバル名前空間を作成する"""
+    namespace = {"__builtins__": {}}
+    namespace.update(custom_functions or {})
+    namespace[_INT_HELPER] = to_int
+    namespace[_STR_HELPER] = to_str
+    namespace[_SEQ_STR_HELPER] = str
+    return namespace
+
+def substitute_expression(expression, sequence_number, variables):
+    """数式内の列名・行番号を実際の値に置換した文字列を返す（表示・デバッグ用）"""
+    sequence_number = str(sequence_number)
+
+    def replace_str(match):
+        column_name = match.group(1).lower()
+        if column_name in variables:
+            value = str(variables[column_name])
+            return "'" + value.replace("'", "\\'") + "'"
+        else:
+            return "''"
+
+    def replace_int(match):
+        column_name = match.group(1).lower()
+        if column_name in variables:
+            try:
+                return str(int(variables[column_name]))
+            except ValueError:
+                return "0"
+        else:
+            return "0"
+    exp_ret = expression.replace('@#', sequence_number)
+    exp_ret = exp_ret.replace('$#', f"'{sequence_number}'")
+    exp_ret = _INT_PATTERN.sub(replace_int, exp_ret)
+    return _STR_PATTERN.sub(replace_str, exp_ret)
+
+def _slot_getter(slots):
+    """行(list)から指定位置の値をタプルで取り出す関数を作成する"""
+    if not slots:
+        return lambda row: ()
+    if None in slots:
+        return lambda row: tuple(None if i is None else row[i] for i in slots)
+    if len(slots) == 1:
+        index = slots[0]
+        return lambda row: (row[index],)
+    return itemgetter(*slots)
+
+class CompiledExpression:
+    """一度だけ解析・コンパイルされる式
+
+    `@[列名]`、`$[列名]` は行内の位置(スロット)の参照に、`@#`、`$#` は行番号の
+    引数に置き換えてコンパイルする。ヘッダーに対して bind() すると、
+    行(list)と行番号を受け取って評価結果を返す関数が得られる。
+    """
+
+    def __init__(self, expression):
+        import ast
+        self.expression = expression
+        # 行番号(@#、$#)を参照する式は、前の行のフィルタリング結果に依存する
+        self.uses_sequence = '@#' in expression or '$#' in expression
+        self.columns = []
+        # @[列名] として参照する列（column_types で型を指定した場合、変換済みの値に置き換える）
+        self.int_columns = []
+        column_slots = {}
+
+        def slot(match, helper):
+            column_name = match.group(1).lower()
+            if column_name not in column_slots:
+                column_slots[column_name] = len(self.columns)
+                self.columns.append(column_name)
+            if helper == _INT_HELPER and column_name not in self.int_columns:
+                self.int_columns.append(column_name)
+            return f"{helper}({_SLOTS_NAME}[{column_slots[column_name]}])"
+
+        source = expression.replace('@#', _SEQ_NAME)
+        source = source.replace('$#', f"{_SEQ_STR_HELPER}({_SEQ_NAME})")
+        source = _INT_PATTERN.sub(lambda m: slot(m, _INT_HELPER), source)
+        source = _STR_PATTERN.sub(lambda m: slot(m, _STR_HELPER), source)
+        self.source = source.replace('\r', '\\r').replace('\n', '\\n')
+
+        self.error = None
+        self.names = []
+        # フィルタ条件の評価コストの見積もり（estimate_cost が設定する）
+        self.cost = None
+        self._code_cache = {}
+        try:
+            tree = ast.parse(self.source, mode='eval')
+        except SyntaxError as e:
+            # 構文エラーは評価時に他のエラーと同様に報告する
+            self.error = ValueError(f"式の評価に失敗しました: {expression}, エラー: {str(e)}")
+            return
+        # 列名をそのまま変数として参照している名前
+        self.names = sorted({
+            node.id for node in ast.walk(tree)
+            if isinstance(node, ast.Name) and isinstance(node.ctx, ast.Load)
+            and node.id not in _HELPER_NAMES
+        })
+
+    def state(self):
+        """コンパイル結果を marshal で保存できる辞書で返す（plan_cache 用）"""
+        return {
+            "source": self.source,
+            "uses_sequence": self.uses_sequence,
+            "columns": list(self.columns),
+            "int_columns": list(self.int_columns),
+            "names": list(self.names),
+            "error": None if self.error is None else str(self.error),
+            "cost": self.cost,
+            "codes": dict(self._code_cache),
+        }
+
+    @classmethod
+    def from_state(cls, expression, state):
+        """state() の辞書から、式を解析・コンパイルせずに復元する"""
+        compiled = cls.__new__(cls)
+        compiled.expression = expression
+        compiled.source = state["source"]
+        compiled.uses_sequence = state["uses_sequence"]
+        compiled.columns = list(state["columns"])
+        compiled.int_columns = list(state["int_columns"])
+        compiled.names = list(state["names"])
+        compiled.error = None if state["error"] is None else ValueError(state["error"])
+        compiled.cost = state["cost"]
+        compiled._code_cache = dict(state["codes"])
+        return compiled
+
+    def _code(self, bare_names, typed_columns=()):
+        """列名の直接参照を引数に持つラムダ式のコードオブジェクトを返す
+
+        typed_columns の列の @[列名] は、変換せずにスロットの後ろに追加した変換済みの値を参照する。
+        """
+        key = (bare_names, typed_columns)
+        code = self._code_cache.get(key)
+        if code is None:
+            source = self.source
+            for i, name in enumerate(typed_columns):
+                slot = f"{_SLOTS_NAME}[{self.columns.index(name)}]"
+                source = source.replace(f"{_INT_HELPER}({slot})", f"{_SLOTS_NAME}[{len(self.columns) + i}]")
+            params = ''.join(f", {name}" for name in bare_names)
+            code = compile(f"lambda {_SLOTS_NAME}, {_SEQ_NAME}{params}: ({source})",
+                           '<expression>', 'eval')
+            self._code_cache[key] = code
+        return code
+
+    def bind(self, header, namespace, typed_positions=None):
+        """ヘッダーの列位置に束縛した評価関数を返す
+
+        typed_positions は {列名（小文字）: 行の位置} で、その列の @[列名] は行のその位置の値
+        （column_types で変換済みの値）をそのまま参照する。
+        """
+        if self.error is not None:
+            error = self.error
+
+            def evaluate(row, sequence_number):
+                raise error
+            return evaluate
+        index = {}
+        for i, name in enumerate(header):
+            index[name.lower()] = i
+        slots = [index.get(name) for name in self.columns]
+        typed_columns = ()
+        if typed_positions:
+            typed_columns = tuple(name for name in self.int_columns if name in typed_positions)
+            slots += [typed_positions[name] for name in typed_columns]
+        # カスタム関数と同名の場合はカスタム関数を優先する
+        bare_names = tuple(name for name in self.names if name in index and name not in namespace)
+        func = eval(self._code(bare_names, typed_columns), namespace)
+        get_slots = _slot_getter(slots)
+        expression = self.expression
+
+        if bare_names:
+            get_bare = _slot_getter([index[name] for name in bare_names])
+
+            def evaluate(row, sequence_number):
+                try:
+                    return func(get_slots(row), sequence_number, *get_bare(row))
+                except Exception as e:
+                    raise ValueError(f"式の評価に失敗しました: {expression}, エラー: {str(e)}")
+        else:
+            def evaluate(row, sequence_number):
+                try:
+                    return func(get_slots(row), sequence_number)
+                except Exception as e:
+                    raise ValueError(f"式の評価に失敗しました: {expression}, エラー: {str(e)}")
+        return evaluate
+
+_compiled_cache = {}
+
+def compile_expression(expression):
+    """式をコンパイルする（同じ式は再利用する）"""
+    compiled = _compiled_cache.get(expression)
+    if compiled is None:
+        compiled = CompiledExpression(expression)
+        _compiled_cache[expression] = compiled
+    return compiled
+
+def export_compiled(expressions):
+    """コンパイル済みの式の state() を式ごとに返す"""
+    return {expression: _compiled_cache[expression].state() for expression in expressions
+            if expression in _compiled_cache}
+
+def preload_compiled(states):
+    """export_compiled() の結果からコンパイル済みの式を復元する（コンパイル済みの式はそのまま）"""
+    for expression, state in states.items():
+        if expression not in _compiled_cache:
+            _compiled_cache[expression] = CompiledExpression.from_state(expression, state)
+
+class FunctionRegistry:
+    """fnフォルダのカスタム関数をプロセス全体で共有するレジストリ
+
+    fnフォルダの *.py は最初に一度だけロードし、以降は check_interval 秒ごとに
+    ファイルの更新日時・サイズを確認する。変更があり、内容のハッシュも
+    変わっている場合にのみそのモジュールを再ロードする。
+    namespace はコンパイル済みの式のグローバル名前空間としてそのまま使われ、
+    再ロード時はその場で更新されるため、束縛済みの式にも変更が反映される。
+
+    cached_namespace は、pure と宣言された関数を結果を最大 cache_size 件まで保持する
+    関数に置き換えた名前空間（cache_size が 0 の場合は namespace と同じ内容）。
+    関数が再ロードされた場合、その関数のキャッシュは破棄する。
+
+    code_cache はファイルの内容のハッシュをキーとするモジュールのコードオブジェクトで、
+    ある場合はソースをコンパイルせずに実行する（plan_cache で保存・復元する）。
+    """
+
+    def __init__(self, fn_dir, check_interval=1.0, cache_size=0):
+        self.fn_dir = fn_dir
+        self.check_interval = check_interval
+        self.cache_size = cache_size
+        self.functions = {}
+        self.namespace = build_namespace()
+        self.cached_namespace = dict(self.namespace)
+        self.load_count = 0
+        self.reload_count = 0
+        self._modules = {}
+        self.code_cache = {}
+        self._last_check = None
+        # 関数名 -> (元の関数, キャッシュする関数)
+        self._caches = {}
+        # 破棄したキャッシュの統計の累計
+        self._cache_totals = {}
+
+    def refresh(self, force=False):
+        """前回の確認から check_interval 秒以上経過していればfnフォルダを確認する
+
+        関数に変更があった場合は True を返す。
+        """
+        now = time.monotonic()
+        if not force and self._last_check is not None and now - self._last_check < self.check_interval:
+            return False
+        self._last_check = now
+        return self._scan()
+
+    def stats(self):
+        """ロード回数・再ロード回数を返す"""
+        return {
+            "modules": len(self._modules),
+            "functions": len(self.functions),
+            "load_count": self.load_count,
+            "reload_count": self.reload_count,
+            "cached_functions": len(self._caches),
+        }
+
+    def cache_stats(self):
+        """関数ごとのキャッシュのヒット・ミス・追い出しの回数（破棄したキャッシュの分を含む）"""
+        stats = {name: dict(totals) for name, totals in self._cache_totals.items()}
+        for name, (func, cached) in self._caches.items():
+            entry = stats.setdefault(name, {"hits": 0, "misses": 0, "evictions": 0})
+            for key, value in cache_stats(cached).items():
+                if key in entry:
+                    entry[key] += value
+        return stats
+
+    def module_codes(self):
+        """ロード済みのモジュールのコードオブジェクトを、内容のハッシュごとに返す"""
+        return {entry["hash"]: self.code_cache[entry["hash"]] for entry in self._modules.values()
+                if entry["hash"] in self.code_cache}
+
+    def set_cache_size(self, cache_size):
+        """キャッシュの最大件数を変更する（変更した場合はキャッシュを作り直す）"""
+        if cache_size != self.cache_size:
+            self.cache_size = cache_size
+            self._rebuild_cached(discard=True)
+
+    def _scan(self):
+        changed = False
+        paths = []
+        if os.path.isdir(self.fn_dir):
+            for filename in sorted(os.listdir(self.fn_dir)):
+                if filename.endswith('.py'):
+                    paths.append(os.path.join(self.fn_dir, filename))
+
+        for module_path in paths:
+            try:
+                stat = os.stat(module_path)
+            except OSError:
+                continue
+            entry = self._modules.get(module_path)
+            if entry and entry["mtime"] == stat.st_mtime_ns and entry["size"] == stat.st_size:
+                continue
+            try:
+                with open(module_path, 'rb') as f:
+                    source = f.read()
+                digest = hashlib.sha1(source).hexdigest()
+            except OSError as e:
+                print(f"関数のロード中にエラーが発生しました {module_path}: {e}", file=sys.stderr)
+                continue
+            if entry and entry["hash"] == digest:
+                # 更新日時のみ変わった場合は再ロードしない
+                entry["mtime"] = stat.st_mtime_ns
+                entry["size"] = stat.st_size
+                continue
+            functions = self._load_module(module_path, source, digest)
+            if functions is None:
+                # ロードに失敗した場合は前回の関数を使い続ける（次の変更時に再試行）
+                if entry:
+                    entry.update(mtime=stat.st_mtime_ns, size=stat.st_size, hash=digest)
+                    continue
+                functions = {}
+            if entry:
+                self.reload_count += 1
+            else:
+                self.load_count += 1
+            self._modules[module_path] = {
+                "mtime": stat.st_mtime_ns,
+                "size": stat.st_size,
+                "hash": digest,
+                "functions": functions,
+            }
+            changed = True
+
+        for module_path in list(self._modules):
+            if module_path not in paths:
+                del self._modules[module_path]
+                changed = True
+
+        if changed:
+            self._rebuild()
+        return changed
+
+    def _load_module(self, module_path, source, digest):
+        """モジュールを実行して公開関数を返す（失敗時は None）"""
+        module_name = os.path.splitext(os.path.basename(module_path))[0]
+        try:
+            code = self.code_cache.get(digest)
+            if code is None:
+                code = compile(source, module_path, 'exec', dont_inherit=True)
+                self.code_cache[digest] = code
+            spec = importlib.util.spec_from_file_location(module_name, module_path)
+            module = importlib.util.module_from_spec(spec)
+            exec(code, module.__dict__)
+        except Exception as e:
+            print(f"関数のロード中にエラーが発生しました {module_path}: {e}", file=sys.stderr)
+            return None
+        functions = {}
+        for name, obj in sorted(vars(module).items()):
+            if isinstance(obj, types.FunctionType) and not name.startswith('_'):
+                functions[name] = obj
+        mark_pure_functions(module, functions)
+        return functions
+
+    def _rebuild(self):
+        """関数一覧と名前空間を作り直す（名前空間は同じ辞書をその場で更新する）"""
+        functions = {}
+        for module_path in sorted(self._modules):
+            functions.update(self._modules[module_path]["functions"])
+        for name in self.functions:
+            if name not in functions:
+                self.namespace.pop(name, None)
+        self.functions = functions
+        namespace = build_namespace(functions)
+        self.namespace.update(namespace)
+        self._rebuild_cached()
+
+    def _rebuild_cached(self, discard=False):
+        """cached_namespace を作り直す（関数が変わっていないキャッシュは引き継ぐ）"""
+        caches = {}
+        if self.cache_size > 0:
+            for name, func in self.functions.items():
+                if not is_pure(func):
+                    continue
+                previous = self._caches.get(name)
+                if previous is not None and previous[0] is func and not discard:
+                    caches[name] = previous
+                else:
+                    caches[name] = (func, cached_function(func, self.cache_size))
+        for name, previous in self._caches.items():
+            if caches.get(name) is not previous:
+                totals = self._cache_totals.setdefault(name, {"hits": 0, "misses": 0, "evictions": 0})
+                for key, value in cache_stats(previous[1]).items():
+                    if key in totals:
+                        totals[key] += value
+        self._caches = caches
+        namespace = dict(self.namespace)
+        namespace.update((name, cached) for name, (func, cached) in caches.items())
+        for name in list(self.cached_namespace):
+            if name not in namespace:
+                del self.cached_namespace[name]
+        self.cached_namespace.update(namespace)
+
+_registries = {}
+
+def get_function_registry(fn_dir=None, check_interval=None, cache_size=None):
+    """fnフォルダごとに共有されるレジストリを返す"""
+    fn_dir = os.path.abspath(fn_dir or default_fn_dir())
+    registry = _registries.get(fn_dir)
+    if registry is None:
+        registry = FunctionRegistry(fn_dir)
+        _registries[fn_dir] = registry
+    if check_interval is not None:
+        registry.check_interval = check_interval
+    if cache_size is not None:
+        registry.set_cache_size(cache_size)
+    return registry
+
 class ExpressionEvaluator:
     def __init__(self, sequence_number, variables=None, fn_dir=None):
         self.variables = variables or {}
@@ -41,47 +490,26 @@ class ExpressionEvaluator:
         # 変数名を小文字に変換
         self.variables = {k.lower(): v for k, v in self.variables.items()}
         # 実行ファイルのパスを基準にfnフォルダを探す
-        base_path = os.path.dirname(os.path.abspath(sys.argv[0]))
-        self.fn_dir = fn_dir or os.path.join(base_path, 'fn')
-        # fnフォルダから関数をロード
-        self.custom_functions = load_custom_functions(self.fn_dir)
+        self.fn_dir = fn_dir or default_fn_dir()
+        # fnフォルダの関数は共有レジストリから取得する（変更があれば再ロードされる）
+        registry = get_function_registry(self.fn_dir)
+        registry.refresh()
+        self.custom_functions = registry.functions
+        self.namespace = registry.namespace
     def evaluate(self, expression):
-        """数式を評価する"""        
-        # カスタム関数とデータを組み合わせた評価環境を作成
-        eval_env = {
-            **self.variables,
-            **self.custom_functions
-        }
-        
-        # 安全な評価のために制限された環境で実行
+        """数式を評価する"""
+        # 表示用に置換後の式を保持する
         self.evaluate_expression = self._replace_column_names(expression)
+        compiled = compile_expression(expression)
+        header = list(self.variables.keys())
+        row = list(self.variables.values())
         try:
-            return eval(self.evaluate_expression.replace('\r','\\r').replace('\n','\\n'), {"__builtins__": {}}, eval_env)
-        except Exception as e:
-            raise ValueError(f"式の評価に失敗しました: {expression}, エラー: {str(e)}")
+            sequence_number = int(self.sequence_number)
+        except ValueError:
+            sequence_number = self.sequence_number
+        evaluate = compiled.bind(header, self.namespace)
+        return evaluate(row, sequence_number)
 
     def _replace_column_names(self, expression):
         """数式内の列名を実際の値に置換する"""
-        def replace_str(match):
-            column_name = match.group(1).lower()
-            if column_name in self.variables:
-                value = str(self.variables[column_name])
-                return f"'{value.replace('\'','\\\'')}'"
-            else:
-                return f"''"
-                
-        def replace_int(match):
-            column_name = match.group(1).lower()
-            if column_name in self.variables:
-                try:
-                    return str(int(self.variables[column_name]))
-                except ValueError:
-                    return "0"
-            else:
-                return "0"
-        exp_ret = expression.replace('@#', self.sequence_number)
-        exp_ret = exp_ret.replace('$#', f"'{self.sequence_number}'")
-        exp_ret = re.sub(r'@\[(\w+)\]', replace_int, exp_ret)
-        return re.sub(r'\$\[(\w+)\]', replace_str, exp_ret)
-
-
+        return substitute_expression(expression, self.sequence_number, self.variables)
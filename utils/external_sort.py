@@ -0,0 +1,346 @@
+import os
+import sys
+import datetime
+import heapq
+import pickle
+import shutil
+import tempfile
+
+DEFAULT_MEMORY_MB = 256
+# 一度に併合する一時ファイル（ラン）の数。超える場合は中間のランを作る
+DEFAULT_MERGE_FANIN = 64
+# 一時ファイルに pickle でまとめて書き込むレコード数
+_SPILL_BATCH = 4096
+
+class Descending:
+    """降順に並べるキー（比較を逆にする）"""
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __lt__(self, other):
+        return other.value < self.value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+    def __reduce__(self):
+        return Descending, (self.value,)
+
+def _column_positions(option, columns, header):
+    """列名のリストを出力列の位置に変換する（大文字・小文字は区別しない）"""
+    positions = {}
+    for i, name in enumerate(header):
+        positions.setdefault(name, i)
+        positions.setdefault(name.lower(), i)
+    result = []
+    for column in columns:
+        position = positions.get(column, positions.get(column.lower()))
+        if position is None:
+            raise ValueError(f"{option} の列[{column}]が出力列にありません。")
+        result.append(position)
+    return result
+
+def _typed_key(convert, descending=False):
+    """型に変換した値のキー（空文字と変換できない値は、昇順・降順とも変換した値の後に文字列の順で並べる）
+
+    降順は数値の符号・日付の通日を反転する。
+    """
+    def key(value):
+        value = str(value)
+        if value == '':
+            return (1, value)
+        try:
+            value = convert(value)
+        except (ValueError, ArithmeticError):
+            return (1, value)
+        if descending:
+            value = -value.toordinal() if isinstance(value, datetime.date) else -value
+        return (0, value)
+    return key
+
+def _descending_str(value):
+    return Descending(str(value))
+
+def sort_key(sort_by, header, column_types=None):
+    """sort_by（列名のリスト。先頭に "-" を付けると降順）から、行のキーを返す関数を作成する
+
+    column_types で型を指定した列は、その型の値で並べる（それ以外の列は文字列の順）。
+    """
+    from utils.column_types import converter
+    if isinstance(sort_by, str):
+        sort_by = [sort_by]
+    column_types = column_types or {}
+    specs = []
+    for column in sort_by:
+        descending = column.startswith('-')
+        column = column[1:] if descending else column
+        position, = _column_positions("sort_by", [column], header)
+        type_name = column_types.get(column.lower())
+        if type_name in (None, 'str'):
+            convert = _descending_str if descending else str
+        else:
+            convert = _typed_key(converter(type_name), descending)
+        specs.append((position, convert))
+
+    if len(specs) == 1:
+        (position, convert), = specs
+        return lambda row: convert(row[position])
+
+    def key(row):
+        return tuple([convert(row[position]) for position, convert in specs])
+    return key
+
+def distinct_key(distinct_on, header):
+    """distinct_on（列名のリスト）から、行のキー（値の文字列のタプル）を返す関数を作成する"""
+    if isinstance(distinct_on, str):
+        distinct_on = [distinct_on]
+    positions = _column_positions("distinct_on", distinct_on, header)
+
+    def key(row):
+        return tuple([str(row[position]) for position in positions])
+    return key
+
+def _write_run(path, records):
+    with open(path, 'wb') as f:
+        for start in range(0, len(records), _SPILL_BATCH):
+            pickle.dump(records[start:start + _SPILL_BATCH], f, protocol=pickle.HIGHEST_PROTOCOL)
+
+def _read_run(path):
+    with open(path, 'rb') as f:
+        while True:
+            try:
+                batch = pickle.load(f)
+            except EOFError:
+                return
+            yield from batch
+
+def _merge_run_files(task):
+    """ランを併合して1つのランにする（ワーカープロセスでも実行する）"""
+    paths, out_path = task
+    with open(out_path, 'wb') as f:
+        batch = []
+        for record in heapq.merge(*[_read_run(path) for path in paths]):
+            batch.append(record)
+            if len(batch) >= _SPILL_BATCH:
+                pickle.dump(batch, f, protocol=pickle.HIGHEST_PROTOCOL)
+                batch = []
+        if batch:
+            pickle.dump(batch, f, protocol=pickle.HIGHEST_PROTOCOL)
+    for path in paths:
+        os.remove(path)
+    return out_path
+
+class ExternalSorter:
+    """(キー, 値) をキーの順に並べ替える（メモリに収まらない場合は一時ファイルに書き出して併合する）
+
+    追加した値の大きさの見積もりが memory_limit バイトを超えると、並べ替えて一時ファイル（ラン）に書き出す。
+    キーが同じ値は追加した順になる。ランが merge_fanin 個を超える場合は merge_fanin 個ずつ
+    中間のランに併合する（workers が 2 以上の場合はワーカープロセスで並列に併合する）。
+    キーと値は pickle できる必要がある。
+    """
+
+    def __init__(self, memory_limit, temp_dir=None, merge_fanin=DEFAULT_MERGE_FANIN, workers=1):
+        self.memory_limit = memory_limit
+        self.temp_dir = temp_dir
+        self.merge_fanin = max(int(merge_fanin), 2)
+        self.workers = workers
+        self.spills = 0
+        self._buffer = []
+        self._size = 0
+        self._sequence = 0
+        self._runs = []
+        self._dir = None
+
+    def add(self, key, value, size):
+        """値を追加する（size は値の大きさの見積もり）"""
+        self._buffer.append((key, self._sequence, value))
+        self._sequence += 1
+        self._size += size
+        if self._size >= self.memory_limit:
+            self._spill()
+
+    def _run_path(self):
+        if self._dir is None:
+            if self.temp_dir:
+                os.makedirs(self.temp_dir, exist_ok=True)
+            self._dir = tempfile.mkdtemp(prefix="csvsc_sort_", dir=self.temp_dir or None)
+        return os.path.join(self._dir, f"run{self.spills:06d}")
+
+    def _spill(self):
+        # (キー, 追加した順) は重複しないため、値は比較しない
+        self._buffer.sort()
+        path = self._run_path()
+        self.spills += 1
+        _write_run(path, self._buffer)
+        self._runs.append(path)
+        self._buffer = []
+        self._size = 0
+
+    def _reduce_runs(self):
+        """ランが merge_fanin 個以下になるまで中間のランに併合する"""
+        while len(self._runs) > self.merge_fanin:
+            tasks = []
+            for start in range(0, len(self._runs), self.merge_fanin):
+                paths = self._runs[start:start + self.merge_fanin]
+                if len(paths) == 1:
+                    tasks.append((paths, None))
+                    continue
+                tasks.append((paths, self._run_path()))
+                self.spills += 1
+            merge = [task for task in tasks if task[1] is not None]
+            if self.workers > 1 and len(merge) > 1:
+                from concurrent.futures import ProcessPoolExecutor
+                with ProcessPoolExecutor(max_workers=min(self.workers, len(merge))) as executor:
+                    list(executor.map(_merge_run_files, merge))
+            else:
+                for task in merge:
+                    _merge_run_files(task)
+            self._runs = [paths[0] if out_path is None else out_path for paths, out_path in tasks]
+
+    def records(self):
+        """(キー, 追加した順, 値) をキーの順に返す"""
+        self._buffer.sort()
+        if not self._runs:
+            yield from self._buffer
+            return
+        self._reduce_runs()
+        yield from heapq.merge(*[_read_run(path) for path in self._runs], self._buffer)
+
+    def close(self):
+        """一時ファイルを削除する"""
+        self._buffer = []
+        self._runs = []
+        if self._dir is not None:
+            shutil.rmtree(self._dir, ignore_errors=True)
+            self._dir = None
+
+def row_size(row):
+    """行の大きさの見積もり（バイト）"""
+    return sys.getsizeof(row) + sum(map(sys.getsizeof, row))
+
+class SortedWriter:
+    """行を key の順に並べ替えて、close() で writer に書き出す（それ以外の属性は元の writer のもの）
+
+    キーが同じ行は書き込んだ順になる。メモリの使用量は memory_limit バイト程度まで。
+    """
+
+    def __init__(self, writer, key, memory_limit, temp_dir=None, workers=1, merge_fanin=DEFAULT_MERGE_FANIN,
+                 metrics=None):
+        self._writer = writer
+        self._key = key
+        self._sorter = ExternalSorter(memory_limit, temp_dir, merge_fanin, workers)
+        self._metrics = metrics
+        self._closed = False
+
+    def writerow(self, row):
+        # タプルにすると、文字列だけの行は循環参照のGCの対象から外れる
+        row = tuple(row)
+        self._sorter.add(self._key(row), row, row_size(row))
+
+    def writerows(self, rows):
+        for row in rows:
+            self.writerow(row)
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        try:
+            writerow = self._writer.writerow
+            for key, sequence, row in self._sorter.records():
+                writerow(row)
+        finally:
+            if self._metrics is not None:
+                self._metrics.counters["sort_spills"] += self._sorter.spills
+            self._sorter.close()
+            self._writer.close()
+
+    def __getattr__(self, name):
+        return getattr(self._writer, name)
+
+class DistinctWriter:
+    """key が同じ行のうち、最初の行だけを writer に書き出す（それ以外の属性は元の writer のもの）
+
+    書き出した行のキーは集合で保持する。集合の大きさの見積もりが memory_limit バイトを超えた場合は、
+    以降の行を外部ソートで重複を除く（キーの順に並べて同じキーの最初の行を残し、元の順に並べ直して close() で書き出す）。
+    """
+
+    def __init__(self, writer, key, memory_limit, temp_dir=None, workers=1, merge_fanin=DEFAULT_MERGE_FANIN,
+                 metrics=None):
+        self._writer = writer
+        self._key = key
+        self.memory_limit = memory_limit
+        self._sort_options = (memory_limit, temp_dir, merge_fanin, workers)
+        self._metrics = metrics
+        self._seen = set()
+        self._size = 0
+        self._sorter = None
+        self._closed = False
+        self.duplicates = 0
+
+    def writerow(self, row):
+        key = self._key(row)
+        if self._sorter is not None:
+            row = tuple(row)
+            self._sorter.add(key, row, row_size(row))
+            return
+        if key in self._seen:
+            self.duplicates += 1
+            return
+        self._seen.add(key)
+        self._writer.writerow(row)
+        self._size += row_size(key)
+        if self._size >= self.memory_limit:
+            self._spill_keys()
+
+    def writerows(self, rows):
+        for row in rows:
+            self.writerow(row)
+
+    def _spill_keys(self):
+        """書き出した行のキーを外部ソートに移し、以降の行は外部ソートで重複を除く"""
+        self._sorter = ExternalSorter(*self._sort_options)
+        # 書き出した行のキー（値は None）は以降の行より前に追加されるため、同じキーの最初のレコードになる
+        for key in self._seen:
+            self._sorter.add(key, None, row_size(key))
+        self._seen = set()
+
+    def _flush_sorted(self):
+        order = ExternalSorter(*self._sort_options)
+        try:
+            previous = None
+            first = True
+            for key, sequence, row in self._sorter.records():
+                if not first and key == previous:
+                    self.duplicates += 1
+                    continue
+                first = False
+                previous = key
+                if row is not None:
+                    order.add(sequence, row, row_size(row))
+            writerow = self._writer.writerow
+            for sequence, _, row in order.records():
+                writerow(row)
+        finally:
+            if self._metrics is not None:
+                self._metrics.counters["sort_spills"] += self._sorter.spills + order.spills
+            order.close()
+            self._sorter.close()
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        try:
+            if self._sorter is not None:
+                self._flush_sorted()
+        finally:
+            self._seen = set()
+            if self._metrics is not None:
+                self._metrics.counters["rows_duplicate"] += self.duplicates
+            self._writer.close()
+
+    def __getattr__(self, name):
+        return getattr(self._writer, name)
@@ -0,0 +1,143 @@
+import re
+import csv
+import mmap
+import codecs
+
+from utils.csv_chunks import CHUNK_SENTINEL
+
+# 区切り文字・クォート・改行のバイトが、マルチバイト文字の一部として現れないエンコーディング
+_FAST_ENCODINGS = {
+    'ascii', 'utf-8', 'utf-8-sig', 'latin-1', 'iso8859-1', 'iso8859-15', 'cp1252',
+    'shift_jis', 'cp932', 'shift_jis_2004', 'shift_jisx0213', 'euc_jp', 'euc_jis_2004', 'euc_jisx0213',
+    'gbk', 'gb2312', 'gb18030', 'big5', 'cp949', 'euc_kr',
+}
+
+_LINE_END = re.compile(rb'\r\n|\r|\n')
+
+def is_fast_encoding(encoding):
+    """FastCSVReader で読み込めるエンコーディングか"""
+    try:
+        return codecs.lookup(encoding).name in _FAST_ENCODINGS
+    except LookupError:
+        return False
+
+class _LineFeeder:
+    """mmap の指定位置から1行ずつ文字列を返す（クォートを含むレコードを csv.reader で読むため）
+
+    改行の扱いは newline='' で開いたテキストファイルと同じ（\\r\\n、\\r、\\n で区切る）。
+    範囲の末尾に達した後、sentinel があればそれを1行として返す。
+    """
+
+    def __init__(self, mm, end, encoding, sentinel=None):
+        self.mm = mm
+        self.pos = 0
+        self.end = end
+        self.encoding = encoding
+        self.sentinel = sentinel
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.pos >= self.end:
+            if self.sentinel is not None:
+                line, self.sentinel = self.sentinel, None
+                return line
+            raise StopIteration
+        match = _LINE_END.search(self.mm, self.pos, self.end)
+        line_end = match.end() if match else self.end
+        line = self.mm[self.pos:line_end].decode(self.encoding)
+        self.pos = line_end
+        return line
+
+class FastCSVReader:
+    """mmap でファイルを読み込み、バイト単位でレコードを区切るCSVリーダー
+
+    クォート・\\r・NULを含まない行は、バイト列のまま区切り文字で分割し、
+    used_columns に含まれる列だけを文字列に変換する（それ以外の列は空文字）。
+    それ以外の行は csv.reader で読み込むため、結果は csv.reader と同じになる。
+    ただし、変換しない列に不正なバイト列があってもエラーにはならない。
+
+    start、end でファイルの範囲を指定できる。validate_end が True の場合は、
+    範囲の末尾に [CHUNK_SENTINEL] を返す（read_chunk_rows と同じ）。
+    """
+
+    def __init__(self, file_path, encoding, delimiter, start=None, end=None, validate_end=False):
+        self.encoding = codecs.lookup(encoding).name
+        self.delimiter = delimiter
+        self.used_columns = None
+        self._file = open(file_path, 'rb')
+        try:
+            self._mm = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # 空のファイルは mmap できない
+            self._mm = b''
+        self.pos = start or 0
+        self.end = len(self._mm) if end is None else end
+        if self.encoding == 'utf-8-sig':
+            if self.pos == 0 and self._mm[:3] == codecs.BOM_UTF8:
+                self.pos = 3
+            self.encoding = 'utf-8'
+        self._validate_end = validate_end
+        self._feeder = _LineFeeder(self._mm, self.end, self.encoding,
+                                   CHUNK_SENTINEL + '\n' if validate_end else None)
+        self._csv = csv.reader(self._feeder, delimiter=delimiter, quotechar='"')
+        self._rows = self._iter_rows()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self._rows)
+
+    def _iter_rows(self):
+        mm = self._mm
+        end = self.end
+        encoding = self.encoding
+        delimiter = self.delimiter
+        delimiter_bytes = delimiter.encode(encoding)
+        feeder = self._feeder
+        pos = self.pos
+        try:
+            while pos < end:
+                newline = mm.find(b'\n', pos, end)
+                line_end = end if newline < 0 else newline + 1
+                content_end = line_end - 1 if newline >= 0 else line_end
+                if content_end > pos and mm[content_end - 1] == 0x0d:
+                    content_end -= 1
+                line = mm[pos:content_end]
+                if b'"' in line or b'\r' in line or b'\x00' in line:
+                    # クォートを含むレコード（複数行になる場合がある）は csv.reader で読み込む
+                    feeder.pos = pos
+                    row = next(self._csv, None)
+                    pos = feeder.pos
+                    if row is None:
+                        return
+                    yield row
+                    continue
+                pos = line_end
+                if not line:
+                    yield []
+                    continue
+                used = self.used_columns
+                if used is None:
+                    yield line.decode(encoding).split(delimiter)
+                    continue
+                fields = line.split(delimiter_bytes)
+                row = [''] * len(fields)
+                count = len(fields)
+                for i in used:
+                    if i < count:
+                        row[i] = fields[i].decode(encoding)
+                yield row
+            if feeder.sentinel is not None:
+                yield [feeder.sentinel.rstrip('\n')]
+        finally:
+            self.close()
+
+    def close(self):
+        if self._file is not None:
+            if isinstance(self._mm, mmap.mmap):
+                self._mm.close()
+            self._file.close()
+            self._file = None
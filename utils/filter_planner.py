@@ -0,0 +1,71 @@
+
+# 列の値の変換（@[列名]、$[列名]、$#）に使う内部の関数名
+_HELPER_CALLS = {'__n', '__s', '__t'}
+
+# 評価コストの見積もり（相対値）
+_NODE_COST = 0.2
+_HELPER_CALL_COST = 1.0
+_CALL_COST = 25.0
+_ERROR_COST = 1000.0
+# 一括評価の結果を参照するだけの条件のコストの比率
+_BATCHED_RATIO = 0.05
+
+def _parse_cost(source):
+    """式の構文木のノードごとのコストの合計"""
+    import ast
+    try:
+        tree = ast.parse(source, mode='eval')
+    except SyntaxError:
+        return _ERROR_COST
+    cost = 0.0
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Call):
+            if isinstance(node.func, ast.Name) and node.func.id in _HELPER_CALLS:
+                cost += _HELPER_CALL_COST
+            else:
+                cost += _CALL_COST
+        else:
+            cost += _NODE_COST
+    return cost
+
+def estimate_cost(compiled, batched=False):
+    """フィルタ条件の評価コストを式の構造から見積もる
+
+    fnフォルダの関数などの呼び出しは、列の参照や演算よりも大きく見積もる。
+    一括評価される条件は、行ごとには結果を参照するだけなので小さく見積もる。
+    見積もりは compiled.cost に保存し、次回からは式を解析しない。
+    """
+    cost = compiled.cost
+    if cost is None:
+        cost = _parse_cost(compiled.source)
+        compiled.cost = cost
+    if batched:
+        cost *= _BATCHED_RATIO
+    return cost
+
+class FilterPlanner:
+    """フィルタ条件を評価する順序を決める
+
+    すべての条件を満たす行だけを出力するため、条件の評価順序は結果に影響しない。
+    順序は「コスト / 行を除外する割合」の小さい順とし、除外する割合は
+    interval 行ごとに実際の評価結果から更新する。最初はコストの小さい順。
+    evaluated[i]、rejected[i] は条件 i を評価した回数と、条件 i で除外した回数。
+    """
+
+    def __init__(self, costs, adaptive=True, interval=1000):
+        self.costs = list(costs)
+        self.adaptive = adaptive
+        self.interval = interval
+        self.evaluated = [0] * len(self.costs)
+        self.rejected = [0] * len(self.costs)
+        self.order = sorted(range(len(self.costs)), key=lambda i: (self.costs[i], i))
+
+    def replan(self):
+        """評価結果から順序を更新し、更新後の順序を返す"""
+        def rank(i):
+            # 評価回数が少ない条件は、除外する割合を 1/2 とみなす
+            reject_rate = (self.rejected[i] + 1) / (self.evaluated[i] + 2)
+            return (self.costs[i] / reject_rate, i)
+        if self.adaptive:
+            self.order = sorted(range(len(self.costs)), key=rank)
+        return self.order
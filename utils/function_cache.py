@@ -0,0 +1,43 @@
+import functools
+
+# fnフォルダのモジュールで、結果をキャッシュしてよい関数名を列挙する変数名
+PURE_NAMES_ATTRIBUTE = '__pure__'
+
+def pure(func):
+    """同じ引数に対して常に同じ結果を返す（副作用のない）関数として宣言する"""
+    func.pure = True
+    return func
+
+def impure(func):
+    """結果をキャッシュしない関数として宣言する（__pure__ に含まれていても優先する）"""
+    func.pure = False
+    return func
+
+def mark_pure_functions(module, functions):
+    """モジュールの __pure__ に含まれる関数に pure を設定する（pure が設定済みの関数はそのまま）"""
+    for name in getattr(module, PURE_NAMES_ATTRIBUTE, ()):
+        func = functions.get(name)
+        if func is not None and getattr(func, 'pure', None) is None:
+            func.pure = True
+
+def is_pure(func):
+    return getattr(func, 'pure', None) is True
+
+def cached_function(func, maxsize):
+    """結果を最大 maxsize 件まで LRU で保持する関数を返す
+
+    引数の型も区別する（1 と 1.0、'1' はそれぞれ別にキャッシュする）。
+    引数はハッシュできる値（文字列・数値など）である必要がある。
+    """
+    return functools.lru_cache(maxsize=maxsize, typed=True)(func)
+
+def cache_stats(cached):
+    """ヒット・ミス・追い出しの回数と、保持している件数"""
+    info = cached.cache_info()
+    return {
+        "hits": info.hits,
+        "misses": info.misses,
+        # キャッシュを消去しないため、ミスした結果のうち保持していないものは追い出されたもの
+        "evictions": info.misses - info.currsize,
+        "size": info.currsize,
+    }
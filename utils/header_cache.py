@@ -0,0 +1,71 @@
+import os
+import marshal
+
+HEADER_CACHE_VERSION = 1
+HEADER_CACHE_FILENAME = "headers.marshal"
+
+def _file_state(path):
+    stat = os.stat(path)
+    return stat.st_size, stat.st_mtime_ns
+
+class HeaderCache:
+    """入力ファイルのヘッダー行のキャッシュ（plan_cache_dir）
+
+    入力ファイルの絶対パスとエンコーディングごとに、大きさ・更新日時とヘッダー行を保存する。
+    大きさ・更新日時が変わったファイルは読み直す。内容は marshal で保存する。
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        self.path = os.path.join(cache_dir, HEADER_CACHE_FILENAME)
+        self.entries = {}
+        self.changed = False
+
+    def load(self):
+        """キャッシュを読み込む（読み込めた場合は True）"""
+        try:
+            with open(self.path, 'rb') as f:
+                data = marshal.load(f)
+            if not isinstance(data, dict) or data.get("version") != HEADER_CACHE_VERSION:
+                return False
+            self.entries = dict(data["headers"])
+        except (OSError, EOFError, ValueError, TypeError, KeyError):
+            # 壊れたキャッシュは使わない（次の save() で作り直す）
+            return False
+        return True
+
+    def get(self, file_path, encoding):
+        """ファイルが変わっていなければヘッダー行を返す（ない場合は None）"""
+        entry = self.entries.get(f"{os.path.abspath(file_path)}\0{encoding}")
+        if entry is None:
+            return None
+        try:
+            state = _file_state(file_path)
+        except OSError:
+            return None
+        size, mtime_ns, header = entry
+        return list(header) if (size, mtime_ns) == state else None
+
+    def put(self, file_path, encoding, header):
+        try:
+            size, mtime_ns = _file_state(file_path)
+        except OSError:
+            return
+        self.entries[f"{os.path.abspath(file_path)}\0{encoding}"] = (size, mtime_ns, list(header))
+        self.changed = True
+
+    def save(self):
+        """変更があれば保存する（削除されたファイルの項目は除く）"""
+        for key in list(self.entries):
+            if not os.path.exists(key.split('\0', 1)[0]):
+                del self.entries[key]
+                self.changed = True
+        if not self.changed:
+            return False
+        os.makedirs(self.cache_dir, exist_ok=True)
+        temp_path = self.path + ".tmp"
+        with open(temp_path, 'wb') as f:
+            marshal.dump({"version": HEADER_CACHE_VERSION, "headers": self.entries}, f)
+        os.replace(temp_path, self.path)
+        self.changed = False
+        return True
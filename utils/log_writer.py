@@ -0,0 +1,154 @@
+import time
+import atexit
+import datetime
+import threading
+import queue
+
+# バッファの行数がこの値に達したら書き出す
+FLUSH_LINES = 1000
+
+_writers = set()
+
+def _close_all():
+    """終了時に未出力のログをすべて書き出す"""
+    for writer in list(_writers):
+        writer.close()
+
+atexit.register(_close_all)
+
+_timestamp_cache = [None, '']
+
+def timestamp():
+    """ログ用の時刻文字列（同じ秒の間は同じ文字列を再利用する）"""
+    now = int(time.time())
+    if _timestamp_cache[0] != now:
+        _timestamp_cache[0] = now
+        _timestamp_cache[1] = datetime.datetime.fromtimestamp(now).strftime("%Y-%m-%d %H:%M:%S")
+    return _timestamp_cache[1]
+
+class LogWriter:
+    """ログファイルへのバッファ付き書き込み
+
+    ファイルは開いたままにし、FLUSH_LINES 行ごと、または flush_interval 秒ごとにまとめて書き出す。
+    background が True の場合は書き込みをバックグラウンドのスレッドで行う。
+    キューが queue_size 行に達すると、書き込み側は空きができるまで待つ。
+    ファイルは最初に書き出す時に開く（ログがなければ作成しない）。
+    close() されていないログは終了時に書き出す。
+    """
+
+    def __init__(self, path, mode='a', encoding='utf-8', flush_interval=1.0, background=False, queue_size=10000):
+        self.path = path
+        self.mode = mode
+        self.encoding = encoding
+        self.flush_interval = flush_interval
+        self._file = None
+        self._closed = False
+        self._buffer = []
+        self._last_flush = time.monotonic()
+        self._lock = threading.Lock()
+        self._queue = None
+        self._thread = None
+        if background:
+            self._queue = queue.Queue(maxsize=queue_size)
+            self._thread = threading.Thread(target=self._run, name=f"LogWriter({path})", daemon=True)
+            self._thread.start()
+        _writers.add(self)
+
+    def write(self, line):
+        if self._queue is not None:
+            self._queue.put(line)
+            return
+        with self._lock:
+            if self._closed:
+                return
+            self._buffer.append(line)
+            if len(self._buffer) >= FLUSH_LINES or time.monotonic() - self._last_flush >= self.flush_interval:
+                self._flush_buffer()
+
+    def _flush_buffer(self):
+        self._last_flush = time.monotonic()
+        if not self._buffer:
+            return
+        if self._file is None:
+            self._file = open(self.path, self.mode, encoding=self.encoding)
+        self._file.write(''.join(self._buffer))
+        self._buffer.clear()
+        self._file.flush()
+
+    def _run(self):
+        """キューの行をまとめてファイルに書き出す（バックグラウンドのスレッド）
+
+        キューの要素は行の文字列、書き出しの要求(threading.Event)、終了を表す None。
+        """
+        while True:
+            try:
+                item = self._queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                item = ''
+            with self._lock:
+                # キューに溜まっている行をまとめて取り出す
+                while isinstance(item, str):
+                    if item:
+                        self._buffer.append(item)
+                    if len(self._buffer) >= FLUSH_LINES:
+                        self._flush_buffer()
+                    try:
+                        item = self._queue.get_nowait()
+                    except queue.Empty:
+                        break
+                if not isinstance(item, str) or time.monotonic() - self._last_flush >= self.flush_interval:
+                    self._flush_buffer()
+            if item is None:
+                return
+            if isinstance(item, threading.Event):
+                item.set()
+
+    def flush(self):
+        """バッファの行をファイルに書き出す"""
+        if self._thread is not None:
+            done = threading.Event()
+            self._queue.put(done)
+            done.wait()
+            return
+        with self._lock:
+            if not self._closed:
+                self._flush_buffer()
+
+    def close(self):
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+            self._queue = None
+        with self._lock:
+            if not self._closed:
+                self._closed = True
+                try:
+                    self._flush_buffer()
+                finally:
+                    if self._file is not None:
+                        self._file.close()
+                        self._file = None
+        _writers.discard(self)
+
+class RateLimiter:
+    """1秒あたりのメッセージ数を制限する（max_per_second が 0 の場合は制限しない）"""
+
+    def __init__(self, max_per_second=0):
+        self.max_per_second = max_per_second or 0
+        self.suppressed = 0
+        self._second = None
+        self._count = 0
+
+    def allow(self):
+        if not self.max_per_second:
+            return True
+        now = int(time.monotonic())
+        if now != self._second:
+            self._second = now
+            self._count = 0
+        if self._count < self.max_per_second:
+            self._count += 1
+            return True
+        self.suppressed += 1
+        return False
@@ -0,0 +1,311 @@
+import os
+import io
+import csv
+import atexit
+import shutil
+import marshal
+import hashlib
+import tempfile
+import functools
+
+from utils.compression import open_input, split_compression
+
+LOOKUP_INDEX_VERSION = 1
+DEFAULT_MEMORY_MB = 256
+# SQLite の索引で検索した行をキャッシュする件数
+SQLITE_CACHE_SIZE = 65536
+INDEX_TYPES = ('auto', 'memory', 'sqlite')
+JOIN_TYPES = ('inner', 'left')
+
+# プロセス内で読み込んだ表（索引の名前 -> 表）。同じ参照ファイルはファイルをまたいで再利用する
+_tables = {}
+_temp_dir = None
+
+def _as_list(value):
+    if value is None:
+        return []
+    return [value] if isinstance(value, str) else list(value)
+
+def parse_lookups(lookups, encoding='UTF-8', index_dir=None, memory_mb=DEFAULT_MEMORY_MB):
+    """lookups の設定値を検証し、表ごとの定義のリストを返す（不正な場合は ValueError）
+
+    定義は path・key（列名のリスト）・encoding・delimiter・index・join・on・columns の辞書で、
+    JSON に変換できる（ワーカープロセスに渡す）。
+    """
+    if not lookups:
+        return []
+    if not isinstance(lookups, dict):
+        raise ValueError("lookups は表の名前と定義の辞書で指定してください。")
+    specs = []
+    for name, definition in lookups.items():
+        if isinstance(definition, str):
+            raise ValueError(f"lookups の表[{name}]には path と key を指定してください。")
+        path = definition.get('path')
+        key = _as_list(definition.get('key'))
+        if not path or not key:
+            raise ValueError(f"lookups の表[{name}]には path と key を指定してください。")
+        index = definition.get('index', 'auto')
+        if index not in INDEX_TYPES:
+            raise ValueError(f"lookups の表[{name}]の index が不正です: {index}（{', '.join(INDEX_TYPES)} から選択）")
+        join = definition.get('join')
+        if join is not None and join not in JOIN_TYPES:
+            raise ValueError(f"lookups の表[{name}]の join が不正です: {join}（{', '.join(JOIN_TYPES)} から選択）")
+        on = _as_list(definition.get('on')) or key
+        if len(on) != len(key):
+            raise ValueError(f"lookups の表[{name}]の on と key の列数が一致しません。")
+        delimiter = definition.get('delimiter')
+        if delimiter is None:
+            delimiter = '\t' if split_compression(path)[0].lower().endswith('.tsv') else ','
+        specs.append({
+            "name": name,
+            "path": path,
+            "key": key,
+            "encoding": definition.get('encoding', encoding),
+            "delimiter": delimiter,
+            "index": index,
+            "join": join,
+            "on": on,
+            "columns": _as_list(definition.get('columns')) or None,
+            "index_dir": index_dir,
+            "memory_limit": int(memory_mb * 1024 * 1024),
+        })
+    return specs
+
+def join_columns(spec, columns):
+    """join で行に追加する列（columns を省略した場合は key 以外の列）"""
+    if spec["columns"] is not None:
+        return list(spec["columns"])
+    key = set(spec["key"])
+    return [column for column in columns if column not in key]
+
+def _file_state(path):
+    stat = os.stat(path)
+    return stat.st_size, stat.st_mtime_ns
+
+def fingerprint(specs):
+    """参照ファイルの大きさ・更新日時（incremental の記録に使う）"""
+    result = []
+    for spec in specs:
+        try:
+            size, mtime_ns = _file_state(spec["path"])
+        except OSError:
+            size = mtime_ns = None
+        result.append([spec["name"], size, mtime_ns])
+    return result
+
+def _hash(*values):
+    digest = hashlib.sha256()
+    for value in values:
+        digest.update(repr(value).encode('utf-8') + b'\0')
+    return digest.hexdigest()[:16]
+
+def _index_name(spec, size, mtime_ns):
+    """索引のファイル名の (接頭辞, 接頭辞を含む名前)
+
+    接頭辞は表の名前と参照ファイル・キー列・エンコーディング、名前はさらに参照ファイルの大きさ・更新日時から作る。
+    """
+    prefix = f"lookup-{spec['name']}-" + _hash(os.path.abspath(spec["path"]), spec["key"], spec["encoding"],
+                                                 spec["delimiter"])[:8] + "-"
+    return prefix, prefix + _hash(LOOKUP_INDEX_VERSION, size, mtime_ns)
+
+def _read_rows(spec):
+    """参照ファイルを開き、(ヘッダー, 行のイテレータ, ファイル) を返す"""
+    f = io.TextIOWrapper(open_input(spec["path"]), encoding=spec["encoding"], newline='')
+    reader = csv.reader(f, delimiter=spec["delimiter"], quotechar='"')
+    header = next(reader, None)
+    if header is None:
+        f.close()
+        raise ValueError(f"参照ファイルのヘッダー行を読み込めませんでした: {spec['path']}")
+    missing = [column for column in spec["key"] if column not in header]
+    if missing:
+        f.close()
+        raise ValueError(f"参照ファイルにキーの列がありません: {', '.join(missing)}（{spec['path']}）")
+    return header, reader, f
+
+def _key_function(header, key_columns):
+    positions = [header.index(column) for column in key_columns]
+    if len(positions) == 1:
+        position = positions[0]
+        return lambda row: row[position]
+    return lambda row: tuple([row[position] for position in positions])
+
+def _remove_old(index_dir, prefix, keep):
+    """参照ファイルが変わる前の同じ種類の索引を削除する"""
+    extension = os.path.splitext(keep)[1]
+    for filename in os.listdir(index_dir):
+        path = os.path.join(index_dir, filename)
+        if filename.startswith(prefix) and filename.endswith(extension) and path != keep:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+class MemoryTable:
+    """メモリ上のハッシュの索引（キー -> 行のタプル。キーが重複する場合は最初の行）"""
+
+    def __init__(self, columns, rows):
+        self.columns = list(columns)
+        self.positions = {column: i for i, column in enumerate(self.columns)}
+        self.rows = rows
+
+    @classmethod
+    def build(cls, spec):
+        header, reader, f = _read_rows(spec)
+        with f:
+            key = _key_function(header, spec["key"])
+            width = len(header)
+            rows = {}
+            for row in reader:
+                if len(row) == width:
+                    rows.setdefault(key(row), tuple(row))
+        return cls(header, rows)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as f:
+            data = marshal.load(f)
+        if data.get("version") != LOOKUP_INDEX_VERSION:
+            raise ValueError("version")
+        return cls(data["columns"], data["rows"])
+
+    def save(self, path):
+        temp_path = path + f".{os.getpid()}.tmp"
+        with open(temp_path, 'wb') as f:
+            marshal.dump({"version": LOOKUP_INDEX_VERSION, "columns": self.columns, "rows": self.rows}, f)
+        os.replace(temp_path, path)
+
+    def row(self, key):
+        return self.rows.get(key)
+
+class SQLiteTable:
+    """SQLite のファイルの索引（メモリに収まらない参照ファイル用。検索した行は SQLITE_CACHE_SIZE 件までキャッシュする）
+
+    キーの列ごとの値を主キーとし、行は marshal で保存する。
+    """
+
+    def __init__(self, path):
+        import sqlite3
+        self.path = path
+        self._connection = sqlite3.connect(f"file:{path}?mode=ro", uri=True, check_same_thread=False)
+        self.columns = [row[0] for row in self._connection.execute("SELECT name FROM columns ORDER BY position")]
+        self.positions = {column: i for i, column in enumerate(self.columns)}
+        key_count, = self._connection.execute("SELECT value FROM meta WHERE name = 'key_count'").fetchone()
+        self._multi_key = key_count > 1
+        condition = " AND ".join(f"k{i} = ?" for i in range(key_count))
+        self._sql = f"SELECT value FROM rows WHERE {condition}"
+        self.row = functools.lru_cache(maxsize=SQLITE_CACHE_SIZE)(self._query)
+
+    @staticmethod
+    def build(spec, path):
+        import sqlite3
+        header, reader, f = _read_rows(spec)
+        temp_path = path + f".{os.getpid()}.tmp"
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        with f:
+            positions = [header.index(column) for column in spec["key"]]
+            keys = [f"k{i}" for i in range(len(positions))]
+            width = len(header)
+            connection = sqlite3.connect(temp_path)
+            try:
+                connection.execute("PRAGMA journal_mode = OFF")
+                connection.execute("PRAGMA synchronous = OFF")
+                connection.execute("CREATE TABLE meta (name TEXT PRIMARY KEY, value)")
+                connection.execute("INSERT INTO meta VALUES ('key_count', ?)", (len(keys),))
+                connection.execute("CREATE TABLE columns (position INTEGER, name TEXT)")
+                connection.executemany("INSERT INTO columns VALUES (?, ?)", enumerate(header))
+                connection.execute(f"CREATE TABLE rows ({', '.join(k + ' TEXT' for k in keys)}, value BLOB, "
+                                   f"PRIMARY KEY ({', '.join(keys)})) WITHOUT ROWID")
+                rows = ([row[position] for position in positions] + [marshal.dumps(tuple(row))]
+                        for row in reader if len(row) == width)
+                # キーが重複する場合は最初の行を残す
+                connection.executemany(f"INSERT OR IGNORE INTO rows VALUES ({', '.join('?' * (len(keys) + 1))})",
+                                       rows)
+                connection.commit()
+            finally:
+                connection.close()
+        os.replace(temp_path, path)
+
+    def _query(self, key):
+        found = self._connection.execute(self._sql, key if self._multi_key else (key,)).fetchone()
+        return marshal.loads(found[0]) if found is not None else None
+
+def _index_dir(spec):
+    """索引を保存するフォルダ（lookup_index_dir を指定していない場合は、終了時に削除する一時フォルダ）"""
+    global _temp_dir
+    if spec["index_dir"]:
+        os.makedirs(spec["index_dir"], exist_ok=True)
+        return spec["index_dir"]
+    if _temp_dir is None:
+        _temp_dir = tempfile.mkdtemp(prefix="csvsc_lookup_")
+        atexit.register(shutil.rmtree, _temp_dir, True)
+    return _temp_dir
+
+def load_table(spec):
+    """表を読み込む（プロセス内・lookup_index_dir の索引が参照ファイルと一致する場合は再利用する）
+
+    index が "auto" の場合、参照ファイルが memory_limit バイトより大きければ SQLite の索引を使う。
+    """
+    try:
+        size, mtime_ns = _file_state(spec["path"])
+    except OSError as e:
+        raise ValueError(f"lookups の表[{spec['name']}]の参照ファイルを開けません: {e}")
+    index = spec["index"]
+    if index == 'auto':
+        index = 'sqlite' if size > spec["memory_limit"] else 'memory'
+    prefix, name = _index_name(spec, size, mtime_ns)
+    table = _tables.get((name, index))
+    if table is not None:
+        return table
+
+    if index == 'memory' and not spec["index_dir"]:
+        table = MemoryTable.build(spec)
+    else:
+        index_dir = _index_dir(spec)
+        path = os.path.join(index_dir, f"{name}.{'marshal' if index == 'memory' else 'sqlite'}")
+        table = None
+        if os.path.exists(path):
+            try:
+                table = MemoryTable.load(path) if index == 'memory' else SQLiteTable(path)
+            except Exception:
+                # 壊れた索引は作り直す
+                table = None
+        if table is None:
+            if index == 'memory':
+                table = MemoryTable.build(spec)
+                table.save(path)
+            else:
+                SQLiteTable.build(spec, path)
+                table = SQLiteTable(path)
+            _remove_old(index_dir, prefix, path)
+    for column in spec["columns"] or ():
+        if column not in table.positions:
+            raise ValueError(f"lookups の表[{spec['name']}]の参照ファイルに列[{column}]がありません。")
+    _tables[(name, index)] = table
+    return table
+
+def load_tables(specs):
+    """表の名前 -> 表"""
+    return {spec["name"]: load_table(spec) for spec in specs}
+
+def make_lookup(tables):
+    """式で使用する lookup(表の名前, キー, 列名=None, default=None) を作成する
+
+    列名を省略した場合は、キーの行があるかどうかを返す。キーの行がない場合は default を返す。
+    キーは文字列に変換して検索する（複数の列のキーはタプルで指定する）。
+    """
+    def lookup(name, key, column=None, default=None):
+        table = tables.get(name)
+        if table is None:
+            raise ValueError(f"lookups に定義されていない表です: {name}")
+        key = tuple([str(value) for value in key]) if isinstance(key, tuple) else str(key)
+        row = table.row(key)
+        if column is None:
+            return row is not None
+        if row is None:
+            return default
+        position = table.positions.get(column)
+        if position is None:
+            raise ValueError(f"表[{name}]に列[{column}]がありません。")
+        return row[position]
+    return lookup
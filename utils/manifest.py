@@ -0,0 +1,123 @@
+import os
+import json
+import hashlib
+
+MANIFEST_VERSION = 1
+
+# 出力結果に影響しない設定（変更しても処理済みのファイルをやり直さない）
+_RUNTIME_KEYS = {
+    'incremental', 'manifest_path', 'debug', 'debug_rate_limit', 'log_flush_interval', 'log_background',
+    'fn_reload_interval', 'workers', 'chunk_size', 'batch_size', 'output_compression_thread', 'filter_reorder',
+    'fast_reader', 'profile', 'profile_report', 'fn_cache_size', 'output_async', 'output_batch_rows',
+    'output_fsync', 'plan_cache_dir', 'watch_interval', 'watch_settle', 'watch_status_path',
+    'watch_status_interval', 'sort_memory_mb', 'sort_temp_dir', 'sort_workers', 'lookup_index_dir', 'lookup_memory_mb',
+    'aggregate_memory_mb', 'output_max_open_files', 'output_partition_buffer_rows',
+}
+
+def file_hash(path):
+    """ファイルの内容のハッシュ"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def config_hash(config):
+    """出力結果に影響する設定のハッシュ"""
+    relevant = {key: value for key, value in config.items() if key not in _RUNTIME_KEYS}
+    return hashlib.sha256(json.dumps(relevant, sort_keys=True, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+def fn_hash(fn_dir):
+    """fnフォルダの関数ファイルの内容のハッシュ"""
+    digest = hashlib.sha256()
+    if fn_dir and os.path.isdir(fn_dir):
+        for filename in sorted(os.listdir(fn_dir)):
+            if filename.endswith('.py'):
+                digest.update(filename.encode('utf-8'))
+                digest.update(file_hash(os.path.join(fn_dir, filename)).encode('ascii'))
+    return digest.hexdigest()
+
+class RunManifest:
+    """処理済みの入力ファイルと、出力の続きを書き込むための状態（incremental）
+
+    fingerprint（設定・fnフォルダのハッシュ、出力列）が記録と異なる場合は、記録を破棄する。
+    入力ファイルは大きさ・更新日時が記録と同じなら処理済みとし、更新日時だけが
+    異なる場合は内容のハッシュで判定する。記録は入力ファイルごとに commit() で保存する。
+    """
+
+    def __init__(self, path, fingerprint):
+        self.path = path
+        self.fingerprint = fingerprint
+        self.files = {}
+        self.output = None
+        # 前回の記録に含まれる出力ファイル（記録を破棄した場合に削除する）
+        self.previous_parts = []
+
+    @classmethod
+    def load(cls, path, fingerprint):
+        """記録を読み込む（ない場合・fingerprint が異なる場合は空の記録を返す）"""
+        manifest = cls(path, fingerprint)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return manifest
+        output = data.get("output") or {}
+        if data.get("version") != MANIFEST_VERSION or data.get("fingerprint") != fingerprint:
+            manifest.previous_parts = output.get("parts", [])
+            return manifest
+        manifest.files = data.get("files", {})
+        manifest.output = output or None
+        return manifest
+
+    def _stat(self, file_path):
+        stat = os.stat(file_path)
+        return stat.st_size, stat.st_mtime_ns
+
+    def is_processed(self, file_path):
+        """処理済みで、内容が変わっていない入力ファイルか"""
+        entry = self.files.get(file_path)
+        if entry is None:
+            return False
+        size, mtime = self._stat(file_path)
+        if size != entry["size"]:
+            return False
+        if mtime == entry["mtime"]:
+            return True
+        if file_hash(file_path) != entry["hash"]:
+            return False
+        entry["mtime"] = mtime
+        return True
+
+    def changed_files(self, input_files):
+        """処理済みのうち、内容が変わった入力ファイル（削除されたファイルは含まない）"""
+        existing = set(input_files)
+        return [file_path for file_path in self.files if file_path in existing and not self.is_processed(file_path)]
+
+    def reset(self):
+        """記録を破棄する（前回の出力ファイルを削除対象にする）"""
+        if self.output:
+            self.previous_parts = self.output.get("parts", [])
+        self.files = {}
+        self.output = None
+
+    def commit(self, file_path, output):
+        """入力ファイルを処理済みとして、出力の状態とともに保存する"""
+        size, mtime = self._stat(file_path)
+        self.files[file_path] = {"size": size, "mtime": mtime, "hash": file_hash(file_path)}
+        self.output = output
+        self.save()
+
+    def save(self):
+        data = {
+            "version": MANIFEST_VERSION,
+            "fingerprint": self.fingerprint,
+            "files": self.files,
+            "output": self.output,
+        }
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False, indent=1)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
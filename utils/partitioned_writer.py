@@ -0,0 +1,183 @@
+import os
+import re
+import collections
+
+from utils.compression import split_compression
+
+DEFAULT_MAX_OPEN_FILES = 64
+DEFAULT_BUFFER_ROWS = 100000
+# パーティションの値のうち、%XX に置き換える文字（ファイル名に使えない文字と、% と値の区切りの _）
+_ESCAPE = re.compile(r'[\\/:*?"<>|%_\x00-\x1f]')
+_EXPRESSION = re.compile(r'[@$]\[|[@$]#')
+
+def partition_key(partition_by, header):
+    """output_partition_by（列名または式のリスト）から、行のパーティションの値のタプルを返す関数を作成する
+
+    出力列（header）にない項目で `$[列名]`・`@[列名]` を含むものは、出力する行に対して評価する式とする
+    （fnフォルダの関数を使用できる。行番号は参照できない）。不正な場合は ValueError。
+    """
+    if isinstance(partition_by, str):
+        partition_by = [partition_by]
+    if not partition_by:
+        raise ValueError("output_partition_by には列名または式のリストを指定してください。")
+    positions = {}
+    for i, name in enumerate(header):
+        positions.setdefault(name, i)
+        positions.setdefault(name.lower(), i)
+    getters = []
+    for item in partition_by:
+        position = positions.get(item, positions.get(item.lower()))
+        if position is not None:
+            getters.append((position, None))
+            continue
+        if not _EXPRESSION.search(item):
+            raise ValueError(f"output_partition_by の列[{item}]が出力列にありません。")
+        from utils.expression_evaluator import compile_expression, get_function_registry
+        compiled = compile_expression(item)
+        if compiled.uses_sequence:
+            raise ValueError(f"output_partition_by の式では行番号(@#、$#)を参照できません: {item}")
+        registry = get_function_registry()
+        registry.refresh()
+        getters.append((None, compiled.bind(header, registry.namespace)))
+
+    if len(getters) == 1 and getters[0][1] is None:
+        position = getters[0][0]
+        return lambda row: (row[position],)
+
+    def key(row):
+        return tuple([row[position] if evaluate is None else evaluate(row, 0) for position, evaluate in getters])
+    return key
+
+def partition_name(values):
+    """パーティションの値から出力ファイル名に付ける名前を作成する
+
+    値を _ でつなぐ。ファイル名に使えない文字と %・_ は %XX（文字コードの16進数）に置き換えるため、
+    異なる値が同じ名前になることはない（例: ("a/b", "c_d") は a%2Fb_c%5Fd）。
+    """
+    return "_".join(_ESCAPE.sub(lambda m: f"%{ord(m.group()):02X}", str(value)) for value in values)
+
+class PartitionedWriter:
+    """行をパーティションの値ごとの出力ファイルに振り分ける（それぞれのファイルの分割は make_writer の writer で行う）
+
+    出力ファイル名は output_filename の拡張子の前にパーティションの名前を付けたもの（例: output_2024-01.csv）。
+    行はパーティションごとにバッファに溜め、合計が buffer_rows 行になるとパーティションごとにまとめて書き込む。
+    開いたままにする出力ファイルは max_open_files 個までで、超える場合は最も前に使ったファイルを閉じ、
+    次に書き込む時に追記で開き直す（appendable が False の出力形式は閉じずにすべて開いたままにする）。
+    key が送出した ValueError は errors に数え、その行は空の値のパーティションに書き込む。
+    """
+
+    def __init__(self, make_writer, key, output_filename, key_size=1, max_open_files=DEFAULT_MAX_OPEN_FILES,
+                 buffer_rows=DEFAULT_BUFFER_ROWS, appendable=True):
+        self._make_writer = make_writer
+        self._key = key
+        self._error_values = ('',) * key_size
+        stem = os.path.splitext(split_compression(output_filename)[0])[0]
+        self._stem, self._suffix = stem, output_filename[len(stem):]
+        self.max_open_files = max(int(max_open_files), 1)
+        self.buffer_rows = max(int(buffer_rows), 1)
+        self.appendable = appendable
+        # パーティションの名前 -> writer
+        self.writers = {}
+        self._names = {}
+        self._open = collections.OrderedDict()
+        self._buffers = {}
+        self._buffered = 0
+        self.total_rows = 0
+        # 閉じた出力ファイルを開き直した回数
+        self.reopens = 0
+        self.errors = 0
+
+    def writerow(self, row):
+        try:
+            values = self._key(row)
+        except ValueError:
+            self.errors += 1
+            values = self._error_values
+        # バッファはパーティションの値ごと（名前はバッファを書き込む時に作成する）
+        buffer = self._buffers.get(values)
+        if buffer is None:
+            buffer = self._buffers[values] = []
+        # タプルにすると、文字列だけの行は循環参照のGCの対象から外れる
+        buffer.append(tuple(row))
+        self._buffered += 1
+        if self._buffered >= self.buffer_rows:
+            self.flush()
+
+    def writerows(self, rows):
+        for row in rows:
+            self.writerow(row)
+
+    def _name(self, values):
+        name = self._names.get(values)
+        if name is None:
+            name = self._names[values] = partition_name(values)
+        return name
+
+    def _writer(self, name):
+        writer = self._open.get(name)
+        if writer is not None:
+            self._open.move_to_end(name)
+            return writer
+        writer = self.writers.get(name)
+        if writer is None:
+            writer = self.writers[name] = self._make_writer(f"{self._stem}_{name}{self._suffix}")
+        elif writer.row_count > 0:
+            self.reopens += 1
+        if self.appendable and len(self._open) >= self.max_open_files:
+            _, evicted = self._open.popitem(last=False)
+            evicted.close()
+        self._open[name] = writer
+        return writer
+
+    def flush(self):
+        """バッファの行を書き込む（開いている出力ファイルのパーティションから書き込む）"""
+        buffers, self._buffers = self._buffers, {}
+        self.total_rows += self._buffered
+        self._buffered = 0
+        names = [(self._name(values), rows) for values, rows in buffers.items()]
+        names.sort(key=lambda item: item[0] not in self._open)
+        for name, rows in names:
+            self._writer(name).writerows(rows)
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            for writer in self.writers.values():
+                writer.close()
+            self._open.clear()
+
+    @property
+    def parts(self):
+        """作成した出力ファイルのパス"""
+        return [path for writer in self.writers.values() for path in writer.parts]
+
+    def commit(self):
+        """書き込み済みの行をファイルに確定し、続きを書き込むための状態を返す（incremental）"""
+        self.flush()
+        partitions = {name: writer.commit() for name, writer in self.writers.items()}
+        self._open.clear()
+        return {"partitions": partitions, "parts": self.parts}
+
+    def rollback(self, output):
+        """commit() の後に書き込んだ行を取り除く（記録にないパーティションの出力ファイルは削除する）"""
+        self._buffers = {}
+        self._buffered = 0
+        for writer in self.writers.values():
+            writer.close()
+        self._open.clear()
+        partitions = output.get("partitions", {})
+        for name in list(self.writers):
+            if name not in partitions:
+                for path in self.writers.pop(name).parts:
+                    if os.path.exists(path):
+                        os.remove(path)
+        self.restore(output)
+
+    def restore(self, output):
+        """commit() の状態から続きを書き込めるようにする（記録にないパーティションのファイルは書き込む時に作り直す）"""
+        for name, state in output.get("partitions", {}).items():
+            writer = self.writers.get(name)
+            if writer is None:
+                writer = self.writers[name] = self._make_writer(f"{self._stem}_{name}{self._suffix}")
+            writer.restore(state)
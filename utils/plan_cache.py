@@ -0,0 +1,80 @@
+import os
+import marshal
+import hashlib
+import importlib.util
+
+from utils.manifest import config_hash
+from utils.expression_evaluator import export_compiled, preload_compiled, get_function_registry
+
+PLAN_CACHE_VERSION = 2
+
+def _environment_hash(fn_dir):
+    """Pythonのバージョンと、fnフォルダの関数ファイルの更新日時・大きさのハッシュ"""
+    digest = hashlib.sha256(importlib.util.MAGIC_NUMBER)
+    digest.update(str(PLAN_CACHE_VERSION).encode('ascii'))
+    if fn_dir and os.path.isdir(fn_dir):
+        for filename in sorted(os.listdir(fn_dir)):
+            if filename.endswith('.py'):
+                try:
+                    stat = os.stat(os.path.join(fn_dir, filename))
+                except OSError:
+                    continue
+                digest.update(f"{filename}\0{stat.st_mtime_ns}\0{stat.st_size}\0".encode('utf-8'))
+    return digest.hexdigest()
+
+class PlanCache:
+    """設定ごとのコンパイル済みの式と、fnフォルダの関数のバイトコードのキャッシュ（plan_cache_dir）
+
+    キャッシュファイルは設定の式（filter_conditions・add_columns）のハッシュと、
+    fnフォルダの関数ファイルの更新日時・大きさ・Pythonのバージョンのハッシュを名前に持つ。どちらかが変わった場合は別のファイルになり、
+    同じ式の古いファイルは save() で削除する。内容は marshal で保存する。
+    """
+
+    def __init__(self, cache_dir, config, fn_dir, expressions):
+        self.cache_dir = cache_dir
+        self.fn_dir = fn_dir
+        self.expressions = list(expressions)
+        # 入出力のフォルダなどが異なる設定でも、式が同じならキャッシュを共有する
+        plan_config = {key: config.get(key) for key in ('filter_conditions', 'add_columns')}
+        self.prefix = f"plan-{config_hash(plan_config)[:16]}-"
+        self.path = os.path.join(cache_dir, f"{self.prefix}{_environment_hash(fn_dir)[:16]}.marshal")
+        self.loaded = None
+
+    def load(self):
+        """キャッシュを読み込み、式と fnフォルダの関数のロードに使う（読み込めた場合は True）"""
+        try:
+            with open(self.path, 'rb') as f:
+                data = marshal.load(f)
+            if not isinstance(data, dict) or data.get("version") != PLAN_CACHE_VERSION:
+                return False
+            preload_compiled(data["expressions"])
+            get_function_registry(self.fn_dir).code_cache.update(data["modules"])
+        except (OSError, EOFError, ValueError, TypeError, KeyError):
+            # 壊れたキャッシュは使わない（次の save() で作り直す）
+            return False
+        self.loaded = data
+        return True
+
+    def save(self):
+        """現在のコンパイル結果を保存する（読み込んだ内容と同じ場合は保存しない）"""
+        data = {
+            "version": PLAN_CACHE_VERSION,
+            "expressions": export_compiled(self.expressions),
+            "modules": get_function_registry(self.fn_dir).module_codes(),
+        }
+        if data == self.loaded:
+            return False
+        os.makedirs(self.cache_dir, exist_ok=True)
+        temp_path = self.path + ".tmp"
+        with open(temp_path, 'wb') as f:
+            marshal.dump(data, f)
+        os.replace(temp_path, self.path)
+        for filename in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, filename)
+            if filename.startswith(self.prefix) and filename.endswith(".marshal") and path != self.path:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+        self.loaded = data
+        return True
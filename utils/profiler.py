@@ -0,0 +1,159 @@
+import json
+import time
+import functools
+
+# 処理の段階（parse: 入力の読み込み、bind: 式のヘッダーへの束縛、batch: 一括評価、write: 出力の書き込み）
+# フィルタ条件・追加列の評価時間は式ごとの時間の合計
+STAGES = ('parse', 'bind', 'batch', 'write')
+
+class RunMetrics:
+    """処理の段階ごと・式ごと・fnフォルダの関数ごとの累積時間と、行数のカウンタ
+
+    式・関数の時間は評価関数・関数を包んで計測する（関数の時間は、それを呼び出す式の時間にも含まれる）。
+    並列処理では、ワーカーごとの値を take() で取り出し、親プロセスで merge() する。
+    """
+
+    def __init__(self):
+        self.counters = {
+            "rows_read": 0, "rows_filtered": 0, "rows_invalid": 0, "rows_written": 0, "evaluation_errors": 0,
+            "rows_duplicate": 0, "sort_spills": 0,
+        }
+        self.stages = dict.fromkeys(STAGES, 0.0)
+        # (種類, 式) -> [評価回数, 秒]
+        self.expressions = {}
+        # 関数名 -> [呼び出し回数, 秒]
+        self.functions = {}
+        # 関数名 -> キャッシュのヒット・ミス・追い出しの回数
+        self.function_cache = {}
+
+    def timed_rows(self, reader):
+        """reader の行を返しながら、読み込みの時間と行数を数える"""
+        perf_counter = time.perf_counter
+        stages = self.stages
+        counters = self.counters
+        rows = iter(reader)
+        while True:
+            start = perf_counter()
+            row = next(rows, None)
+            stages['parse'] += perf_counter() - start
+            if row is None:
+                return
+            counters["rows_read"] += 1
+            yield row
+
+    def timed_expression(self, kind, expression, evaluate):
+        """式の評価関数を、評価回数と時間を数える関数で包む"""
+        entry = self.expressions.setdefault((kind, expression), [0, 0.0])
+        perf_counter = time.perf_counter
+
+        def timed(row, sequence_number):
+            start = perf_counter()
+            try:
+                return evaluate(row, sequence_number)
+            finally:
+                entry[0] += 1
+                entry[1] += perf_counter() - start
+        return timed
+
+    def timed_function(self, name, func):
+        """fnフォルダの関数を、呼び出し回数と時間を数える関数で包む"""
+        entry = self.functions.setdefault(name, [0, 0.0])
+        perf_counter = time.perf_counter
+
+        @functools.wraps(func)
+        def timed(*args, **kwargs):
+            start = perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                entry[0] += 1
+                entry[1] += perf_counter() - start
+        return timed
+
+    def take(self):
+        """現在の値を辞書で返し、カウンタを 0 に戻す（包んだ関数は引き続き使える）"""
+        data = {
+            "counters": dict(self.counters),
+            "stages": dict(self.stages),
+            "expressions": [[kind, expression, entry[0], entry[1]]
+                            for (kind, expression), entry in self.expressions.items()],
+            "functions": [[name, entry[0], entry[1]] for name, entry in self.functions.items()],
+            "function_cache": {name: dict(entry) for name, entry in self.function_cache.items()},
+        }
+        for key in self.counters:
+            self.counters[key] = 0
+        for key in self.stages:
+            self.stages[key] = 0.0
+        for entry in list(self.expressions.values()) + list(self.functions.values()):
+            entry[0] = 0
+            entry[1] = 0.0
+        self.function_cache = {}
+        return data
+
+    def merge(self, data):
+        """take() の値を加算する"""
+        for key, value in data["counters"].items():
+            self.counters[key] += value
+        for key, value in data["stages"].items():
+            self.stages[key] += value
+        for kind, expression, calls, seconds in data["expressions"]:
+            entry = self.expressions.setdefault((kind, expression), [0, 0.0])
+            entry[0] += calls
+            entry[1] += seconds
+        for name, calls, seconds in data["functions"]:
+            entry = self.functions.setdefault(name, [0, 0.0])
+            entry[0] += calls
+            entry[1] += seconds
+        for name, values in data["function_cache"].items():
+            entry = self.function_cache.setdefault(name, {"hits": 0, "misses": 0, "evictions": 0})
+            for key, value in values.items():
+                entry[key] += value
+
+    def report(self, elapsed, bytes_in=0, bytes_out=0, **extra):
+        """レポートの辞書を作成する"""
+        expressions = [
+            {"kind": kind, "expression": expression, "calls": calls, "sec": seconds}
+            for (kind, expression), (calls, seconds) in self.expressions.items()
+        ]
+        expressions.sort(key=lambda e: -e["sec"])
+        stages = dict(self.stages)
+        for kind, stage in (('filter', 'filter'), ('add_column', 'add_columns')):
+            stages[stage] = sum(e["sec"] for e in expressions if e["kind"] == kind)
+        functions = [{"name": name, "calls": calls, "sec": seconds}
+                     for name, (calls, seconds) in self.functions.items()]
+        functions.sort(key=lambda f: -f["sec"])
+        report = {
+            "elapsed_sec": elapsed,
+            **self.counters,
+            "bytes_in": bytes_in,
+            "bytes_out": bytes_out,
+            "rows_per_sec": self.counters["rows_read"] / elapsed if elapsed else None,
+            "bytes_per_sec": bytes_in / elapsed if elapsed else None,
+            "stages": stages,
+            "expressions": expressions,
+            "functions": functions,
+            "function_cache": self.function_cache,
+        }
+        report.update(extra)
+        return report
+
+class TimedWriter:
+    """出力の writerow() の時間と行数を数える（それ以外の属性は元の writer のもの）"""
+
+    def __init__(self, writer, metrics):
+        self._writer = writer
+        self._metrics = metrics
+
+    def writerow(self, row):
+        start = time.perf_counter()
+        self._writer.writerow(row)
+        self._metrics.stages['write'] += time.perf_counter() - start
+        self._metrics.counters["rows_written"] += 1
+
+    def __getattr__(self, name):
+        return getattr(self._writer, name)
+
+def write_report(path, report):
+    """レポートをJSONで保存する"""
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
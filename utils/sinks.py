@@ -0,0 +1,264 @@
+import os
+import csv
+import json
+import pickle
+import tempfile
+import importlib.util
+
+from utils.compression import open_output
+
+# pyarrow は読み込みに時間がかかるため、arrow・parquet 形式で出力する場合のみ _arrow() で読み込む
+pyarrow = None
+
+# 出力形式ごとの、分割した出力ファイルの拡張子
+_FORMATS = {
+    'csv': '.csv',
+    'jsonl': '.jsonl',
+    'arrow': '.arrow',
+    'parquet': '.parquet',
+}
+# ファイル内で圧縮する形式で使用できる圧縮形式
+_INTERNAL_COMPRESSION = {
+    'arrow': ('zstd',),
+    'parquet': ('gzip', 'zstd'),
+}
+
+def available_formats():
+    """使用できる出力形式の名前を返す（arrow・parquet は pyarrow がインストールされている場合のみ）"""
+    has_pyarrow = pyarrow is not None or importlib.util.find_spec('pyarrow') is not None
+    return [name for name in _FORMATS if name not in _INTERNAL_COMPRESSION or has_pyarrow]
+
+def _arrow():
+    """pyarrow を読み込む"""
+    global pyarrow
+    if pyarrow is None:
+        import pyarrow.ipc
+        import pyarrow.parquet
+    return pyarrow
+
+def normalize_format(name):
+    """output_format の設定値を出力形式の名前に変換する（使用できない場合は ValueError）"""
+    name = str(name or 'csv').lower()
+    name = {'json': 'jsonl', 'ndjson': 'jsonl', 'feather': 'arrow', 'ipc': 'arrow'}.get(name, name)
+    if name not in available_formats():
+        raise ValueError(f"使用できない出力形式です: {name}")
+    return name
+
+def format_extension(output_format):
+    return _FORMATS[output_format]
+
+def is_text_format(output_format):
+    """テキストの出力形式か（ファイル全体を圧縮し、既存のファイルに追記できる）"""
+    return output_format not in _INTERNAL_COMPRESSION
+
+def format_codecs(output_format):
+    """ファイル内で圧縮する出力形式で使用できる圧縮形式（テキストの出力形式の場合は None）"""
+    return _INTERNAL_COMPRESSION.get(output_format)
+
+class CSVSink:
+    """CSVの出力ファイル"""
+
+    def __init__(self, path, header, encoding, quotechar, quoting, compression=None, compression_level=None,
+                 compression_thread=False, append=False):
+        self._file = open_output(path, encoding, compression, compression_level, compression_thread, append=append)
+        writer = csv.writer(self._file, quotechar=quotechar, quoting=quoting)
+        if not append:
+            writer.writerow(header)
+        self.writerow = writer.writerow
+        self.writerows = writer.writerows
+
+    def close(self):
+        self._file.close()
+
+class JSONLinesSink:
+    """JSON Lines の出力ファイル（1行に列名をキーとする1つのオブジェクト）"""
+
+    def __init__(self, path, header, encoding, compression=None, compression_level=None, compression_thread=False,
+                 append=False):
+        self._file = open_output(path, encoding, compression, compression_level, compression_thread, append=append)
+        self._header = header
+        self._encoder = json.JSONEncoder(ensure_ascii=False, default=str)
+
+    def writerow(self, row):
+        self._file.write(self._encoder.encode(dict(zip(self._header, row))) + '\n')
+
+    def writerows(self, rows):
+        encode = self._encoder.encode
+        header = self._header
+        self._file.write(''.join([encode(dict(zip(header, row))) + '\n' for row in rows]))
+
+    def close(self):
+        self._file.close()
+
+def _column_kind(values, kind=None):
+    """列の値の種類（'bool'・'int'・'float'・'string'、値がない場合は None）を kind と合わせて判定する
+
+    空文字・None は判定に使わない。整数と小数が混ざる場合は 'float'、それ以外の異なる種類が混ざる場合は 'string'。
+    """
+    if kind == 'string':
+        return kind
+    for value in values:
+        if value is None or value == '':
+            continue
+        if isinstance(value, bool):
+            value_kind = 'bool'
+        elif isinstance(value, int):
+            value_kind = 'int'
+        elif isinstance(value, float):
+            value_kind = 'float'
+        else:
+            return 'string'
+        if kind is None or kind == value_kind:
+            kind = value_kind
+        elif {kind, value_kind} == {'int', 'float'}:
+            kind = 'float'
+        else:
+            return 'string'
+    return kind
+
+def _arrow_type(kind):
+    if kind == 'bool':
+        return pyarrow.bool_()
+    if kind == 'int':
+        return pyarrow.int64()
+    if kind == 'float':
+        return pyarrow.float64()
+    return pyarrow.string()
+
+def _to_array(name, values, arrow_type):
+    """列の値を Arrow の配列に変換する
+
+    文字列の列では文字列以外の値を str() で変換し、数値・真偽値の列では空文字を null にする。
+    """
+    try:
+        return pyarrow.array(values, type=arrow_type)
+    except (pyarrow.ArrowInvalid, pyarrow.ArrowTypeError):
+        pass
+    if pyarrow.types.is_string(arrow_type):
+        converted = [value if value is None or isinstance(value, str) else str(value) for value in values]
+    else:
+        is_boolean = pyarrow.types.is_boolean(arrow_type)
+        converted = []
+        for value in values:
+            if value is None or value == '':
+                value = None
+            elif not isinstance(value, (bool, int, float)) or isinstance(value, bool) != is_boolean:
+                raise ValueError(f"列[{name}]の値を{arrow_type}に変換できません: {value!r}")
+            elif pyarrow.types.is_floating(arrow_type):
+                value = float(value)
+            converted.append(value)
+    return pyarrow.array(converted, type=arrow_type)
+
+class _ArrowTableSink:
+    """行を batch_rows 行ずつ列に変換して書き込む出力ファイル（arrow・parquet）
+
+    列の型はファイルのすべての行の値から決め、ファイル内で共通にする（_column_kind）。
+    batch_rows 行を超える行は型が決まるまで一時ファイルに書き出し、close() で変換して書き込む。
+    """
+
+    def __init__(self, path, header, compression=None, compression_level=None, batch_rows=10000):
+        _arrow()
+        self.path = path
+        self.header = list(header)
+        self.compression = compression
+        self.compression_level = compression_level
+        self.batch_rows = max(int(batch_rows), 1)
+        self.schema = None
+        self._kinds = [None] * len(self.header)
+        self._rows = []
+        self._spill = None
+        self._writer = None
+
+    def writerow(self, row):
+        self._rows.append(row)
+        if len(self._rows) >= self.batch_rows:
+            self._flush()
+
+    def writerows(self, rows):
+        self._rows.extend(rows)
+        if len(self._rows) >= self.batch_rows:
+            self._flush()
+
+    def _update_kinds(self, rows):
+        if rows:
+            self._kinds = [_column_kind(values, kind) for values, kind in zip(zip(*rows), self._kinds)]
+
+    def _flush(self):
+        """バッファの行を一時ファイルに書き出す"""
+        rows, self._rows = self._rows, []
+        self._update_kinds(rows)
+        if self._spill is None:
+            self._spill = tempfile.TemporaryFile(dir=os.path.dirname(os.path.abspath(self.path)))
+        pickle.dump(rows, self._spill, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def _iter_batches(self):
+        if self._spill is not None:
+            self._spill.seek(0)
+            while True:
+                try:
+                    yield pickle.load(self._spill)
+                except EOFError:
+                    break
+        if self._rows or self._spill is None:
+            yield self._rows
+
+    def _write_rows(self, rows):
+        columns = list(zip(*rows)) if rows else [()] * len(self.header)
+        arrays = [_to_array(field.name, list(values), field.type) for field, values in zip(self.schema, columns)]
+        self._write(pyarrow.RecordBatch.from_arrays(arrays, schema=self.schema))
+
+    def close(self):
+        if self._writer is not None:
+            return
+        try:
+            self._update_kinds(self._rows)
+            self.schema = pyarrow.schema([(name, _arrow_type(kind)) for name, kind in zip(self.header, self._kinds)])
+            self._writer = self._open_writer()
+            try:
+                for rows in self._iter_batches():
+                    self._write_rows(rows)
+            finally:
+                self._writer.close()
+        finally:
+            self._rows = []
+            if self._spill is not None:
+                self._spill.close()
+                self._spill = None
+
+class ArrowSink(_ArrowTableSink):
+    """Arrow IPC（ファイル形式）の出力ファイル。行は batch_rows 行ごとのレコードバッチにする"""
+
+    def _open_writer(self):
+        options = pyarrow.ipc.IpcWriteOptions(compression=self.compression)
+        return pyarrow.ipc.new_file(self.path, self.schema, options=options)
+
+    def _write(self, batch):
+        self._writer.write_batch(batch)
+
+class ParquetSink(_ArrowTableSink):
+    """Parquet の出力ファイル。行は batch_rows 行ごとの行グループにする"""
+
+    def _open_writer(self):
+        options = {}
+        if self.compression:
+            options["compression"] = self.compression
+            if self.compression_level is not None:
+                options["compression_level"] = self.compression_level
+        return pyarrow.parquet.ParquetWriter(self.path, self.schema, **options)
+
+    def _write(self, batch):
+        self._writer.write_batch(batch, row_group_size=self.batch_rows)
+
+def open_sink(output_format, path, header, encoding, quotechar, quoting, compression=None, compression_level=None,
+              compression_thread=False, append=False, batch_rows=10000):
+    """出力形式の出力ファイルを開く（append は csv・jsonl のみ）"""
+    if output_format == 'csv':
+        return CSVSink(path, header, encoding, quotechar, quoting, compression, compression_level,
+                       compression_thread, append)
+    if output_format == 'jsonl':
+        return JSONLinesSink(path, header, encoding, compression, compression_level, compression_thread, append)
+    if append:
+        raise ValueError(f"{output_format} 形式の出力ファイルには追記できません")
+    if output_format == 'arrow':
+        return ArrowSink(path, header, compression, compression_level, batch_rows)
+    return ParquetSink(path, header, compression, compression_level, batch_rows)
@@ -0,0 +1,163 @@
+import os
+import json
+import time
+import stat
+import collections
+
+try:
+    import inotify_simple
+except ImportError:
+    inotify_simple = None
+
+class DirectoryWatcher:
+    """フォルダに到着したファイルを検出する
+
+    inotify_simple がインストールされている場合は inotify で変更を待ち、ない場合（または
+    inotify を使用できない場合）は poll_interval 秒ごとにフォルダを確認する。
+    書き込み中のファイルを読み込まないように、書き込みを閉じた（または移動してきた）ファイルか、
+    大きさ・更新日時が settle 秒以上変わっていないファイルを到着したファイルとする。
+    match(ファイル名) が True のファイルのみを対象にする。
+    """
+
+    def __init__(self, path, match, poll_interval=1.0, settle=1.0, use_inotify=True):
+        self.path = path
+        self.match = match
+        self.poll_interval = poll_interval
+        self.settle = settle
+        # パス -> ((大きさ, 更新日時), その値を最初に確認した時刻)
+        self._seen = {}
+        # inotify で書き込みの完了を検出したファイル
+        self._closed = set()
+        self._inotify = None
+        if use_inotify and inotify_simple is not None:
+            try:
+                self._inotify = inotify_simple.INotify()
+                flags = inotify_simple.flags
+                self._inotify.add_watch(path, flags.CREATE | flags.MODIFY | flags.CLOSE_WRITE | flags.MOVED_TO)
+            except OSError:
+                self.close()
+
+    @property
+    def uses_inotify(self):
+        return self._inotify is not None
+
+    def wait(self, timeout=None):
+        """フォルダに変更があるか、timeout 秒（省略時は poll_interval 秒）経過するまで待つ"""
+        timeout = self.poll_interval if timeout is None else timeout
+        if self._inotify is None:
+            time.sleep(timeout)
+            return
+        flags = inotify_simple.flags
+        for event in self._inotify.read(timeout=int(timeout * 1000)):
+            path = os.path.join(self.path, event.name)
+            if event.mask & (flags.CLOSE_WRITE | flags.MOVED_TO):
+                self._closed.add(path)
+            else:
+                self._closed.discard(path)
+
+    def ready_files(self):
+        """到着したファイルのパスをファイル名順で返す（処理済みのファイルも含む）"""
+        now = time.monotonic()
+        seen = {}
+        ready = []
+        try:
+            filenames = sorted(os.listdir(self.path))
+        except OSError:
+            return ready
+        for filename in filenames:
+            if not self.match(filename):
+                continue
+            path = os.path.join(self.path, filename)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            if not stat.S_ISREG(st.st_mode):
+                continue
+            key = (st.st_size, st.st_mtime_ns)
+            previous = self._seen.get(path)
+            since = previous[1] if previous is not None and previous[0] == key else now
+            seen[path] = (key, since)
+            if path in self._closed or now - since >= self.settle:
+                ready.append(path)
+        self._seen = seen
+        self._closed &= seen.keys()
+        return ready
+
+    def close(self):
+        if self._inotify is not None:
+            self._inotify.close()
+            self._inotify = None
+
+class WatchStatus:
+    """watch の状態をJSONファイルに書き出す
+
+    処理待ち・処理中のファイル数、処理済み・失敗したファイル数、出力した行数と、
+    起動からと直近 window 秒の1秒あたりの行数・1分あたりのファイル数を出力する。
+    ファイルは interval 秒ごとに、一時ファイルから置き換えて更新する。
+    """
+
+    def __init__(self, path, interval=5.0, window=60.0):
+        self.path = path
+        self.interval = interval
+        self.window = window
+        self.started_at = time.time()
+        self._start = time.monotonic()
+        self._last_write = None
+        self.queued = 0
+        self.in_flight = 0
+        self.files_done = 0
+        self.files_failed = 0
+        self.rows_written = 0
+        self.last_file = None
+        self.last_error = None
+        # 直近のファイルの (完了時刻, 行数)
+        self._recent = collections.deque()
+
+    def record(self, file_path, rows, error=None):
+        """ファイルの処理結果を記録する"""
+        now = time.monotonic()
+        self.last_file = file_path
+        if error is not None:
+            self.files_failed += 1
+            self.last_error = error
+            return
+        self.files_done += 1
+        self.rows_written += rows
+        self._recent.append((now, rows))
+
+    def report(self):
+        now = time.monotonic()
+        while self._recent and now - self._recent[0][0] > self.window:
+            self._recent.popleft()
+        uptime = now - self._start
+        recent_span = min(self.window, uptime)
+        recent_rows = sum(rows for t, rows in self._recent)
+        return {
+            "pid": os.getpid(),
+            "started_at": self.started_at,
+            "updated_at": time.time(),
+            "uptime_sec": uptime,
+            "queued": self.queued,
+            "in_flight": self.in_flight,
+            "files_done": self.files_done,
+            "files_failed": self.files_failed,
+            "rows_written": self.rows_written,
+            "rows_per_sec": self.rows_written / uptime if uptime else None,
+            "files_per_min": self.files_done * 60 / uptime if uptime else None,
+            "recent_rows_per_sec": recent_rows / recent_span if recent_span else None,
+            "recent_files_per_min": len(self._recent) * 60 / recent_span if recent_span else None,
+            "last_file": self.last_file,
+            "last_error": self.last_error,
+        }
+
+    def write(self, force=False):
+        """前回の書き出しから interval 秒以上経過していれば書き出す"""
+        now = time.monotonic()
+        if not force and self._last_write is not None and now - self._last_write < self.interval:
+            return
+        self._last_write = now
+        temp_path = self.path + ".tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.report(), f, ensure_ascii=False, indent=2)
+        os.replace(temp_path, self.path)